@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Streaming band-limited RMS of magnetometer runs.
+
+Each axis is cut into segments ending every `interval` seconds, windowed
+with a Hann window and transformed once; the PSD bins are then summed into
+all requested bands in a single matrix product. The output is a low-rate
+series (one value per interval per band per axis) small enough to hold a
+whole campaign in memory for trend plots. Segments restart after the gap
+rows of the resilient scan, no value covers a discontinuity.
+"""
+import os
+import argparse
+import h5py
+import numpy as np
+from magcore import calibrate_data, gap_rows, VOLT_TO_UT, AXIS_COLUMNS
+from magio import iter_hdf5_blocks, load_gaps
+
+DEFAULT_BANDS = [(0.1, 1.), (1., 10.), (10., 100.)]
+DEFAULT_BLOCKSIZE = 65536
+MIN_CYCLES = 10.    # default segment: this many periods of the lowest band edge
+
+
+def band_matrix(f, bands):
+    """
+    Boolean selection (nbands, nf) of the frequency bins inside each band.
+
+    Args:
+        f (numpy.ndarray): bin frequencies in Hz.
+        bands (list[tuple]): (f_low, f_high) pairs in Hz, f_low inclusive.
+
+    Returns:
+        numpy.ndarray: bool array of shape (len(bands), len(f)).
+    """
+    bands = np.asarray(bands, dtype=float).reshape(-1, 2)
+    f = np.asarray(f)
+    return (f[None, :] >= bands[:, 0:1]) & (f[None, :] < bands[:, 1:2])
+
+
+class BandPowerStream:
+    """
+    Band-power stage fed with calibrated blocks of shape (n, naxes).
+
+    A value is emitted every `interval` seconds and covers the preceding
+    `segment` seconds (default: MIN_CYCLES / lowest band edge, at least the
+    interval), so the lowest band holds several bins. Bands without any bin
+    at the resulting resolution raise ValueError.
+    """
+
+    def __init__(self, fs, bands=DEFAULT_BANDS, interval=1.0, segment=None, naxes=3):
+        self.fs = float(fs)
+        self.bands = np.asarray(bands, dtype=float).reshape(-1, 2)
+        self.naxes = naxes
+        self.hop = max(int(round(interval * self.fs)), 1)
+        if segment is None:
+            f_low = self.bands[:, 0][self.bands[:, 0] > 0]
+            segment = MIN_CYCLES / f_low.min() if len(f_low) else 0.
+        seglen = int(round(segment * self.fs))
+        self.seglen = max(seglen, self.hop)
+
+        self.window = np.hanning(self.seglen)
+        f = np.fft.rfftfreq(self.seglen, 1. / self.fs)
+        # same one-sided psd normalization as compute_psd, times bin width
+        scale = np.full(len(f), 2. / self.fs / np.sum(self.window**2))
+        scale[0] /= 2.
+        if self.seglen % 2 == 0:
+            scale[-1] /= 2.
+        df = self.fs / self.seglen
+        self.weights = band_matrix(f, self.bands) * (scale * df)[None, :]
+        empty = ~self.weights.any(axis=1)
+        if np.any(empty):
+            raise ValueError(f"bands {self.bands[empty].tolist()} contain no bins at df={df:.3g} Hz, "
+                             f"use a longer segment")
+
+        self._tail = np.zeros((0, naxes))
+        self.nsamples = 0
+        self._restart = 0
+
+    def update(self, block):
+        """
+        Consume a block and return the band RMS values that became complete.
+
+        Args:
+            block (numpy.ndarray): calibrated samples, shape (n, naxes).
+
+        Returns:
+            tuple: (end_sample, rms), end_sample (nout,) is the index one past
+            the last sample of each segment, rms has shape (nout, naxes, nbands).
+        """
+        block = np.asarray(block, dtype=float).reshape(-1, self.naxes)
+        data = np.concatenate([self._tail, block]) if len(self._tail) else block
+        data_start = self.nsamples - len(self._tail)
+        self.nsamples += len(block)
+
+        first = (self.nsamples - len(block)) // self.hop + 1
+        last = self.nsamples // self.hop
+        ends = np.arange(first, last + 1) * self.hop
+        ends = ends[ends >= self._restart + self.seglen]
+
+        if len(ends):
+            idx = (ends - self.seglen - data_start)[:, None] + np.arange(self.seglen)[None, :]
+            frames = data[idx]
+            frames = frames - frames.mean(axis=1, keepdims=True)
+            frames *= self.window[None, :, None]
+            spec = np.fft.rfft(frames, axis=1)
+            power = np.einsum('bf,nfa->nab', self.weights, spec.real**2 + spec.imag**2)
+            rms = np.sqrt(power)
+        else:
+            rms = np.zeros((0, self.naxes, len(self.bands)))
+
+        self._tail = data[-(self.seglen - 1):] if self.seglen > 1 else data[:0]
+        return ends, rms
+
+    def reset(self):
+        '''
+        drop the pending samples, the next segment starts after a discontinuity
+        '''
+        self._tail = np.zeros((0, self.naxes))
+        self._restart = self.nsamples
+
+
+def band_power_run(paths, outpath, bands=DEFAULT_BANDS, interval=1.0, segment=None,
+                   blocksize=DEFAULT_BLOCKSIZE):
+    """
+    Compute the band RMS series of consecutive hdf5 parts of one run and
+    save it to outpath.
+
+    Args:
+        paths (list[str]): part files in acquisition order.
+        outpath (str): output hdf5 file.
+        bands (list[tuple]): (f_low, f_high) pairs in Hz.
+        interval (float): output cadence in seconds.
+        segment (float): analysis segment length in seconds (default from
+            the lowest band edge, see BandPowerStream).
+        blocksize (int): rows read per block (rounded up to whole chunks).
+    """
+    with h5py.File(paths[0], 'r') as f:
+        attrs = f['voltage'].attrs
+        fs = float(attrs['sample_rate'])
+        start_time = attrs.get('start_time', '')
+        ncols = f['voltage'].shape[1] if f['voltage'].ndim > 1 else 1
+
+    if ncols == 1:
+        axes, cols = ['x'], [0]
+    else:
+        axes = ['x', 'y', 'z']
+        cols = [AXIS_COLUMNS[a] for a in axes]
+
+    stream = BandPowerStream(fs, bands, interval, segment, naxes=len(axes))
+
+    with h5py.File(outpath, 'w') as out:
+        tset = out.create_dataset('time', shape=(0,), maxshape=(None,), dtype='float64')
+        rset = out.create_dataset(
+            'rms', shape=(0, len(axes), len(stream.bands)),
+            maxshape=(None, len(axes), len(stream.bands)), dtype='float32'
+        )
+        rset.attrs['units'] = 'uT'
+        out.attrs['bands'] = stream.bands
+        out.attrs['axes'] = axes
+        out.attrs['interval'] = stream.hop / fs
+        out.attrs['segment'] = stream.seglen / fs
+        out.attrs['sample_rate'] = fs
+        out.attrs['start_time'] = start_time
+        out.attrs['sources'] = [os.path.basename(p) for p in paths]
+
+        def append(ends, rms):
+            old = tset.shape[0]
+            tset.resize((old + len(ends),))
+            tset[old:] = ends / fs
+            rset.resize((old + len(ends),) + rset.shape[1:])
+            rset[old:] = rms
+
+        for path in paths:
+            print('->band power ' + path, end='\r')
+            rows = list(gap_rows(load_gaps(path)))
+            # chunk-aligned blocks, the next one is read during the FFTs of this one
+            for start, raw in iter_hdf5_blocks(path, blocksize, columns=cols, align=True):
+                data = calibrate_data(raw) * VOLT_TO_UT
+                # split the block at gap rows, segments never straddle a gap
+                edges = [0] + [g - start for g in rows if start < g < start + len(raw)] + [len(raw)]
+                for a, b in zip(edges[:-1], edges[1:]):
+                    if a > 0:
+                        stream.reset()
+                    ends, rms = stream.update(data[a:b])
+                    if len(ends):
+                        append(ends, rms)
+                if start + len(raw) in rows:
+                    stream.reset()
+        print(f"band power saved to {outpath}        ")
+
+
+def load_band_power(path):
+    '''
+    load a band power file written by band_power_run, rms per axis has shape (nt, nbands)
+    '''
+    with h5py.File(path, 'r') as f:
+        dset = {}
+        dset['time'] = f['time'][:]
+        dset['bands'] = f.attrs['bands']
+        dset['start_time'] = f.attrs['start_time']
+        rms = f['rms'][:]
+        for i, ax in enumerate(f.attrs['axes']):
+            dset[str(ax)] = rms[:, i, :]
+    return dset
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Band power',
+        description='Band-limited RMS time series of hdf5 magnetometer parts.'
+    )
+    parser.add_argument('outfile', type=str, help='Output hdf5 file')
+    parser.add_argument('parts', type=str, nargs='+', help='Part files in acquisition order')
+    parser.add_argument('-b', '--band', type=float, nargs=2, action='append', metavar=('FLOW', 'FHIGH'),
+                        help='Frequency band in Hz, may be repeated (default 0.1-1, 1-10, 10-100)')
+    parser.add_argument('-i', '--interval', type=float, default=1.0,
+                        help='Output cadence in seconds')
+    parser.add_argument('-S', '--segment', type=float, default=None,
+                        help=f'Analysis segment length in seconds (default: {MIN_CYCLES:g} / lowest band edge)')
+    args = parser.parse_args()
+
+    band_power_run(args.parts, args.outfile, args.band or DEFAULT_BANDS,
+                   args.interval, args.segment)
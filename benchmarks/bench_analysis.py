@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Throughput and memory regression benchmark of the loaders and spectral routines.
+
+Synthetic records (benchmarks/synthetic.py, same layout as the acquisition
+output) are generated once per (rate, length, channels) into a data
+directory and reused. Every case is timed best-of-n, then run once more
+under tracemalloc for the peak allocation (numpy and h5py buffers; polars
+allocates outside Python and shows up only in its numpy result). Results
+are compared against a stored baseline per host: a case fails if it is
+slower than baseline x (1 + tolerance) or allocates more than baseline x
+(1 + memory tolerance).
+
+    python benchmarks/bench_analysis.py --save          # record a baseline
+    python benchmarks/bench_analysis.py                 # compare with it
+    python benchmarks/bench_analysis.py -g full -o run.json
+    python benchmarks/bench_analysis.py -k psd          # cases matching 'psd'
+"""
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import argparse
+import tracemalloc
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+from synthetic import write_hdf5, write_csv, CHANNELS
+
+# record grids: sample rates (Hz), lengths (s), channel counts, segment lengths (s)
+GRIDS = {
+    'quick': dict(rates=[1000., 10000.], durations=[60., 600.], channels=[3], lbins=[10.]),
+    'full': dict(rates=[1000., 10000., 100000.], durations=[60., 600., 3600.], channels=[1, 3],
+                 lbins=[1., 10., 100.]),
+}
+
+# cases above this many samples (rows x channels) are skipped, text parsing
+# and the dense stft output do not scale to hour-long fast records
+MAX_SAMPLES = {
+    'load_csv': 2e6,
+    'load_csv_pl': 2e7,
+    'gaussian_stft': 4e7,
+}
+
+# gaussian_stft window: one second at 1 kHz, mfft must cover g_length
+STFT = dict(g_std=100, g_length=1000, mfft=1000, hop=1000)
+
+TOLERANCE = 0.25            # allowed relative slowdown
+MEMORY_TOLERANCE = 0.10     # allowed relative growth of the peak allocation
+MEMORY_SLACK_MB = 1.0       # ignore growth below this
+
+
+def default_baseline():
+    return os.path.join(HERE, 'baselines', f"analysis_{platform.node() or 'host'}.json")
+
+
+def measure(func, repeats=3, memory=True):
+    '''
+    best-of-n seconds and peak traced MB (None without memory) of func()
+    '''
+    best = np.inf
+    for _ in range(repeats):
+        t = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    return best, peak
+
+
+def record_files(datadir, fs, duration, nch, csv=False):
+    '''
+    synthetic hdf5 (and csv) record of the grid point, generated if missing
+    '''
+    os.makedirs(datadir, exist_ok=True)
+    stem = os.path.join(datadir, f"synth_{fs:g}Hz_{duration:g}s_{nch}ch")
+    h5 = stem + '.hdf5'
+    if not os.path.exists(h5):
+        print(f"generating {h5}")
+        write_hdf5(h5 + '.tmp', duration, fs, nch)
+        os.replace(h5 + '.tmp', h5)
+    csvpath = None
+    if csv:
+        csvpath = stem + '.csv'
+        if not os.path.exists(csvpath):
+            print(f"generating {csvpath}")
+            write_csv(csvpath + '.tmp', duration, fs, CHANNELS[:nch])
+            os.replace(csvpath + '.tmp', csvpath)
+    return h5, csvpath
+
+
+def _has_polars():
+    try:
+        import polars  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def iter_cases(grid, datadir):
+    """
+    Yields (name, params, samples, func) for every case of the grid.
+    Records are loaded once per grid point for the spectral cases.
+    """
+    from magio import load_hdf5, load_csv, load_csv_pl
+    from magcore import compute_averaged_psd, compute_ps, gaussian_stft
+    polars = _has_polars()
+    for fs in grid['rates']:
+        for duration in grid['durations']:
+            for nch in grid['channels']:
+                rows = int(round(fs * duration))
+                samples = rows * nch
+
+                def fits(name):
+                    return samples <= MAX_SAMPLES.get(name, np.inf)
+
+                csv = fits('load_csv') or (polars and fits('load_csv_pl'))
+                h5, csvpath = record_files(datadir, fs, duration, nch, csv)
+                params = dict(fs=fs, t=duration, nch=nch)
+
+                yield 'load_hdf5', params, samples, lambda: load_hdf5(h5)
+                if fits('load_csv'):
+                    yield 'load_csv', params, samples, lambda: load_csv(csvpath)
+                if polars and fits('load_csv_pl'):
+                    yield 'load_csv_pl', params, samples, lambda: load_csv_pl(csvpath)
+
+                dset = load_hdf5(h5)
+                axes = [dset[ax] for ax in ('x', 'y', 'z') if ax in dset]
+                for lbin in grid['lbins']:
+                    Lbin = int(round(lbin * fs))
+                    if Lbin > rows:
+                        continue
+                    yield ('compute_averaged_psd', dict(params, Lbin=lbin), samples,
+                           lambda Lbin=Lbin: [compute_averaged_psd(x, fs, Lbin) for x in axes])
+                yield 'compute_ps', params, samples, lambda: [compute_ps(x, fs) for x in axes]
+                yield ('compute_full_ps', params, samples,
+                       lambda: compute_ps(axes, fs, size='trim', workers=-1))
+                if fits('gaussian_stft') and rows >= STFT['g_length']:
+                    yield 'gaussian_stft', params, samples, lambda: [gaussian_stft(x, fs, **STFT) for x in axes]
+                del dset
+
+
+def case_key(name, params):
+    return name + '|' + ','.join(f"{k}={v:g}" for k, v in params.items())
+
+
+def run(grid, datadir, repeats=3, memory=True, match=None):
+    results = {}
+    for name, params, samples, func in iter_cases(grid, datadir):
+        key = case_key(name, params)
+        if match and match not in key:
+            continue
+        seconds, peak = measure(func, repeats, memory)
+        results[key] = {'seconds': seconds, 'peak_mb': peak, 'samples': samples,
+                        'throughput': samples / seconds}
+        mem = f"{peak:9.1f} MB" if peak is not None else ''
+        print(f"{key:60s} {seconds:9.4f} s {samples / seconds / 1e6:9.2f} MS/s {mem}")
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE, memory_tolerance=MEMORY_TOLERANCE):
+    '''
+    list of regression messages against the baseline results
+    '''
+    problems = []
+    for key, res in results.items():
+        ref = baseline.get(key)
+        if ref is None:
+            continue
+        if res['seconds'] > ref['seconds'] * (1 + tolerance):
+            problems.append(f"{key}: {res['seconds']:.4f} s vs {ref['seconds']:.4f} s "
+                            f"({res['seconds'] / ref['seconds'] - 1:+.0%})")
+        if res['peak_mb'] is not None and ref.get('peak_mb') is not None:
+            if res['peak_mb'] > ref['peak_mb'] * (1 + memory_tolerance) + MEMORY_SLACK_MB:
+                problems.append(f"{key}: peak {res['peak_mb']:.1f} MB vs {ref['peak_mb']:.1f} MB")
+    return problems
+
+
+def machine():
+    return {'node': platform.node(), 'machine': platform.machine(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'cpus': os.cpu_count()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Loader and spectral routine benchmark with baselines.')
+    parser.add_argument('-g', '--grid', choices=sorted(GRIDS), default='quick', help='Size grid')
+    parser.add_argument('-n', '--repeats', type=int, default=3, help='Timed runs per case')
+    parser.add_argument('-k', '--match', type=str, default=None, help='Only cases containing this text')
+    parser.add_argument('-d', '--data', type=str, default=os.path.join(tempfile.gettempdir(), 'magnetofft_bench'),
+                        help='Directory for the synthetic records')
+    parser.add_argument('-b', '--baseline', type=str, default=None, help='Baseline JSON (default per host)')
+    parser.add_argument('--save', action='store_true', help='Store the results as (or into) the baseline')
+    parser.add_argument('-t', '--tolerance', type=float, default=TOLERANCE, help='Allowed relative slowdown')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the tracemalloc run')
+    parser.add_argument('-o', '--out', type=str, default=None, help='Also write the results here')
+    args = parser.parse_args()
+
+    baseline_path = args.baseline or default_baseline()
+    results = run(GRIDS[args.grid], args.data, args.repeats, not args.no_memory, args.match)
+    report = {'machine': machine(), 'date': time.strftime("%Y_%m_%d_%H_%M"), 'results': results}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    if args.save:
+        if os.path.exists(baseline_path):
+            with open(baseline_path) as f:
+                stored = json.load(f)
+            stored['results'].update(results)
+            report['results'] = stored['results']
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, 'w') as f:
+            json.dump(report, f, indent=1)
+        print(f"baseline saved to {baseline_path}")
+        return
+
+    if not os.path.exists(baseline_path):
+        print(f"no baseline at {baseline_path}, run with --save first")
+        return
+    with open(baseline_path) as f:
+        stored = json.load(f)
+    if stored['machine'] != machine():
+        print(f"warning: baseline recorded on {stored['machine']}")
+    problems = compare(results, stored['results'], args.tolerance)
+    for p in problems:
+        print('REGRESSION ' + p)
+    compared = sum(key in stored['results'] for key in results)
+    print(f"{compared} of {len(results)} cases compared, {len(problems)} regressions")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Block reading strategies of a part, each feeding an FFT per block and axis.
+
+    slice     h5py defaults, one column slice per axis and block (the old
+              single-axis pattern)
+    rows      h5py defaults, whole rows in blocks of exactly blocksize
+    aligned   BlockReader, chunk-aligned blocks, tuned cache, no prefetch
+    prefetch  BlockReader, as aligned with the next block read in the background
+
+With --cold the file is dropped from the page cache (posix_fadvise) before
+every run, so the reads come from the disk as on a fresh analysis.
+
+    python benchmarks/bench_blockreader.py                   # synthetic 10 kHz, 10 min
+    python benchmarks/bench_blockreader.py run/mag_x_part0.hdf5 --cold -b 1000000
+"""
+import os
+import sys
+import time
+import tempfile
+import argparse
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+from synthetic import write_hdf5
+from blockreader import BlockReader
+
+STRATEGIES = ['slice', 'rows', 'aligned', 'prefetch']
+
+
+def drop_cache(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def iter_strategy(path, strategy, blocksize, columns):
+    '''
+    (start, (n, len(columns)) block) of the strategy
+    '''
+    import h5py
+    if strategy in ('slice', 'rows'):
+        with h5py.File(path, 'r', swmr=True) as f:
+            dset = f['voltage']
+            for start in range(0, dset.shape[0], blocksize):
+                if strategy == 'slice':
+                    yield start, np.stack([dset[start:start + blocksize, c] for c in columns], axis=1)
+                else:
+                    yield start, dset[start:start + blocksize][:, columns]
+        return
+    prefetch = 1 if strategy == 'prefetch' else 0
+    yield from BlockReader(path, blocksize, columns, prefetch=prefetch)
+
+
+def run(path, strategy, blocksize, columns, cold=False):
+    '''
+    (seconds, rows) of reading the part and taking the rfft of every block and axis
+    '''
+    if cold:
+        drop_cache(path)
+    t = time.perf_counter()
+    rows = 0
+    for _, raw in iter_strategy(path, strategy, blocksize, columns):
+        np.fft.rfft(raw.astype(np.float64), axis=0)
+        rows += len(raw)
+    return time.perf_counter() - t, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Block reading strategies of a part with an FFT per block.')
+    parser.add_argument('path', type=str, nargs='?', default=None, help='Part file (default: synthetic record)')
+    parser.add_argument('-b', '--blocksize', type=int, default=1 << 18, help='Rows per block')
+    parser.add_argument('-c', '--columns', type=int, nargs='+', default=[0], help='Columns read')
+    parser.add_argument('-n', '--repeats', type=int, default=3, help='Runs per strategy, best is shown')
+    parser.add_argument('--cold', action='store_true', help='Drop the file from the page cache before each run')
+    args = parser.parse_args()
+
+    path = args.path
+    if path is None:
+        path = os.path.join(tempfile.gettempdir(), 'magnetofft_bench', 'synth_10000Hz_600s_3ch.hdf5')
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            print(f"generating {path}")
+            write_hdf5(path + '.tmp', 600., 10000., 3)
+            os.replace(path + '.tmp', path)
+    size = os.path.getsize(path)
+    print(f"{path}: {size / 1e6:.1f} MB, blocks of {args.blocksize} rows, columns {args.columns}")
+    for strategy in STRATEGIES:
+        best, rows = min(run(path, strategy, args.blocksize, args.columns, args.cold) for _ in range(args.repeats))
+        print(f"  {strategy:9s} {best:8.3f} s  {rows / best / 1e6:8.2f} Mrows/s  {size / best / 1e6:8.1f} MB/s")
+
+
+if __name__ == '__main__':
+    main()
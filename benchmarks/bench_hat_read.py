@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Per-sample cost of the HAT scan read paths.
+
+    list      a_in_scan_read, np.array of the list (the old raw scripts)
+    rows      a_in_scan_read, csv rows built element by element (the old csv script)
+    numpy     a_in_scan_read_numpy, astype + reshape
+    buffer    a_in_scan_read_numpy, ScanBuffer.append into preallocated rows (hatread.py)
+
+Two measurements per path: the conversion alone, repeated on one captured
+read of `--block` samples per channel, and end to end during a scan of
+`--time` seconds (read call plus conversion, per sample of the scan). Raw
+codes (NOSCALEDATA), as the acquisition scripts read them.
+
+    python benchmarks/bench_hat_read.py                      # simhat.py
+    python benchmarks/bench_hat_read.py --device real -r 50000 -t 10
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+from hatread import ScanBuffer, READ_ALL_AVAILABLE
+
+PATHS = ['list', 'rows', 'numpy', 'buffer']
+
+
+def open_hat(device):
+    '''
+    (hat, OptionFlags) of the simulated or the first real MCC 128
+    '''
+    if device == 'sim':
+        import simhat
+        return simhat.SimulatedHat(0), simhat.OptionFlags
+    from daqhats import mcc128, OptionFlags, HatIDs
+    from daqhats_utils import select_hat_device
+    return mcc128(select_hat_device(HatIDs.MCC_128)), OptionFlags
+
+
+def converter(path, nch, capacity):
+    '''
+    function of one read's data -> (n, nch) block (or csv rows) for the path
+    '''
+    if path == 'list':
+        return lambda data: np.array(data, dtype=np.uint16).reshape(-1, nch)
+    if path == 'rows':
+        def rows(data):
+            out = []
+            for i in range(len(data) // nch):
+                row = []
+                for c in range(nch):
+                    row.append(data[i * nch + c])
+                out.append(row)
+            return out
+        return rows
+    if path == 'numpy':
+        return lambda data: data.astype(np.uint16).reshape(-1, nch)
+    buffer = ScanBuffer(nch, capacity)
+
+    def append(data):
+        buffer.clear()
+        return buffer.append(data)
+    return append
+
+
+def reader(hat, path):
+    return hat.a_in_scan_read if path in ('list', 'rows') else hat.a_in_scan_read_numpy
+
+
+def start(hat, flags, nch, rate):
+    hat.a_in_scan_start((1 << nch) - 1, 0, rate,
+                        flags.CONTINUOUS | flags.NOSCALEDATA | flags.NOCALIBRATEDATA)
+
+
+def stop(hat):
+    hat.a_in_scan_stop()
+    hat.a_in_scan_cleanup()
+
+
+def bench_conversion(hat, flags, nch, rate, block, repeats):
+    '''
+    (best-of-n ns per sample of converting one captured read per path, samples
+    per channel of the read: at most half the host buffer)
+    '''
+    captured = {}
+    for kind in ('list', 'numpy'):
+        start(hat, flags, nch, rate)
+        # a read as large as the host buffer overruns before it completes
+        n = min(block, hat.a_in_scan_buffer_size() // 2)
+        captured[kind] = reader(hat, kind)(n, 5.0 + n / rate).data
+        stop(hat)
+    res = {}
+    for path in PATHS:
+        data = captured['list' if path in ('list', 'rows') else 'numpy']
+        func = converter(path, nch, block)
+        best = np.inf
+        for _ in range(repeats):
+            t = time.perf_counter()
+            func(data)
+            best = min(best, time.perf_counter() - t)
+        res[path] = best / len(data) * 1e9
+    return res, n
+
+
+def bench_scan(hat, flags, nch, rate, seconds, path):
+    '''
+    ns per sample spent in read + conversion over a scan, and whether it overran
+    '''
+    func = converter(path, nch, 2 * int(rate))
+    read = reader(hat, path)
+    busy = 0.
+    samples = 0
+    overrun = False
+    start(hat, flags, nch, rate)
+    t_end = time.monotonic() + seconds
+    while time.monotonic() < t_end:
+        t = time.perf_counter()
+        result = read(READ_ALL_AVAILABLE, 5.0)
+        func(result.data)
+        busy += time.perf_counter() - t
+        samples += len(result.data)
+        if result.hardware_overrun or result.buffer_overrun:
+            overrun = True
+            break
+        # the acquisition loops read about ten times per second
+        time.sleep(0.1)
+    stop(hat)
+    return busy / max(samples, 1) * 1e9, samples, overrun
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-sample cost of the HAT scan read paths.')
+    parser.add_argument('--device', choices=['sim', 'real'], default='sim', help='simhat.py or a real MCC 128')
+    parser.add_argument('-r', '--rate', type=float, default=10000., help='Sample rate per channel (Hz)')
+    parser.add_argument('-c', '--channels', type=int, default=3, help='Channels scanned')
+    parser.add_argument('-b', '--block', type=int, default=10000, help='Samples per channel of the captured read')
+    parser.add_argument('-t', '--time', type=float, default=3., help='Seconds of scan per path, 0 to skip')
+    parser.add_argument('-n', '--repeats', type=int, default=5, help='Timed conversions per path')
+    args = parser.parse_args()
+
+    hat, flags = open_hat(args.device)
+    rate = hat.a_in_scan_actual_rate(args.channels, args.rate)
+    print(f"{args.device}: {args.channels} channels at {rate:g} Hz")
+
+    conv, n = bench_conversion(hat, flags, args.channels, rate, args.block, args.repeats)
+    print(f"conversion of one read ({n} x {args.channels}):")
+    for path in PATHS:
+        print(f"  {path:8s} {conv[path]:9.1f} ns/sample  {conv['list'] / conv[path]:6.1f}x list")
+
+    if args.time > 0:
+        print(f"scan of {args.time:g} s (read + conversion):")
+        for path in PATHS:
+            ns, samples, overrun = bench_scan(hat, flags, args.channels, rate, args.time, path)
+            note = '  OVERRUN' if overrun else ''
+            print(f"  {path:8s} {ns:9.1f} ns/sample over {samples} samples{note}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Import-time and RSS guard for the analysis modules.
+
+Each import is measured in a fresh interpreter, relative to a plain
+`import numpy` measured the same way, so the budgets hold on the Pi and on
+desktops alike. The run fails if a light import pulls in a heavy package
+(matplotlib, scipy, h5py, polars, pandas) or exceeds its budget.
+
+    python benchmarks/bench_import.py            # check
+    python benchmarks/bench_import.py -n 5 -v    # more repeats, show modules
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY = ['matplotlib', 'scipy', 'h5py', 'polars', 'pandas']
+
+# statement, heavy packages it may load, extra seconds and MB over numpy
+CASES = [
+    ('import magcore', [], 0.05, 5.0),
+    ('import magnetofft', [], 0.05, 5.0),
+    ('from magnetofft import compute_psd, compute_averaged_psd', [], 0.05, 5.0),
+    ('import bandpower', ['h5py'], None, None),
+]
+
+PROBE = r'''
+import sys, time, json, resource
+sys.path.insert(0, {repo!r})
+rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+t = time.perf_counter()
+{stmt}
+dt = time.perf_counter() - t
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+heavy = sorted(m for m in {heavy!r} if m in sys.modules)
+print(json.dumps({{'seconds': dt, 'rss_mb': (rss - rss0) / 1024., 'heavy': heavy}}))
+'''
+
+
+def measure(stmt, repeats=3):
+    '''
+    best-of-n import time and RSS increase of stmt in fresh interpreters
+    '''
+    best = None
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-c', PROBE.format(repo=REPO, stmt=stmt, heavy=HEAVY)],
+                             capture_output=True, text=True, check=True, cwd=REPO)
+        res = json.loads(out.stdout.strip().splitlines()[-1])
+        if best is None or res['seconds'] < best['seconds']:
+            best = res
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time / RSS regression guard.')
+    parser.add_argument('-n', '--repeats', type=int, default=3, help='Interpreter runs per case')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    base = measure('import numpy', args.repeats)
+    print(f"{'import numpy':60s} {base['seconds'] * 1000:8.1f} ms {base['rss_mb']:7.1f} MB")
+
+    failed = False
+    for stmt, allowed, dt_budget, mb_budget in CASES:
+        res = measure('import numpy\n' + stmt, args.repeats)
+        extra_s = res['seconds'] - base['seconds']
+        extra_mb = res['rss_mb'] - base['rss_mb']
+        problems = [m for m in res['heavy'] if m not in allowed]
+        if dt_budget is not None and extra_s > dt_budget:
+            problems.append(f"+{extra_s * 1000:.0f} ms > {dt_budget * 1000:.0f} ms")
+        if mb_budget is not None and extra_mb > mb_budget:
+            problems.append(f"+{extra_mb:.1f} MB > {mb_budget:.1f} MB")
+        status = 'FAIL ' + ', '.join(problems) if problems else 'ok'
+        failed |= bool(problems)
+        print(f"{stmt:60s} {res['seconds'] * 1000:8.1f} ms {res['rss_mb']:7.1f} MB  {status}")
+        if args.verbose:
+            print(f"    heavy modules loaded: {res['heavy']}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
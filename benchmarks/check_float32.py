@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Float32 analysis path check.
+
+Synthetic 16 bit codes (a quiet sensor near mid-scale plus a few lines) are
+calibrated and run through compute_averaged_psd in float64 and float32. The
+single precision spectrum must agree with the double precision one to well
+below the ADC quantization floor, otherwise float32 would hide signal that
+the 16 bit converter can resolve. Far above the floor (strongest lines,
+drift at the lowest frequencies) float32 cannot do better than its own
+round-off, which grows through the log2(Lbin) butterfly stages of the fft
+as about eps32 x log2(Lbin) of the bin power (2e-6 at Lbin 1e5). Each bin
+is therefore allowed TOLERANCE x floor + eps32 x log2(Lbin) x psd64; the
+check fails, and reports the bins, where float32 does worse than that.
+Peak memory of the working arrays and run time of both paths are reported.
+
+    python benchmarks/check_float32.py              # 1 h at 1 kHz, Lbin 100 s
+    python benchmarks/check_float32.py -t 600 -s 10000
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from magcore import calibrate_data, compute_averaged_psd, adc_quantization_psd, VOLT_TO_UT
+from synthetic import synthetic_codes
+
+# allowed |psd32 - psd64|: TOLERANCE x quantization floor + fft round-off (eps32 x log2(Lbin) x psd64)
+TOLERANCE = 1e-2
+EPS32 = float(np.finfo(np.float32).eps)
+
+
+def run(raw, fs, Lbin, dtype):
+    tracemalloc.start()
+    t = time.perf_counter()
+    data = calibrate_data(raw, dtype)
+    data *= dtype(VOLT_TO_UT)
+    f, psd = compute_averaged_psd(data, fs, Lbin, dtype=dtype)
+    dt = time.perf_counter() - t
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return f, psd, dt, peak / 1024.**2
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Float32 check',
+        description='Compare the float32 and float64 averaged psd against the ADC quantization floor.'
+    )
+    parser.add_argument('-t', '--time', type=float, default=3600., help='Synthetic record length in s')
+    parser.add_argument('-s', '--scan_rate', type=float, default=1000., help='Sample rate in Hz')
+    parser.add_argument('-L', '--lbin', type=float, default=100., help='Segment length in s')
+    args = parser.parse_args()
+
+    fs = args.scan_rate
+    raw = synthetic_codes(int(args.time * fs), fs)
+    Lbin = int(args.lbin * fs)
+
+    f, psd64, t64, m64 = run(raw, fs, Lbin, np.float64)
+    _, psd32, t32, m32 = run(raw, fs, Lbin, np.float32)
+
+    floor = adc_quantization_psd(fs)
+    diff = np.abs(psd32.astype(np.float64) - psd64)
+    err = np.max(diff)
+    rel = np.max(diff / psd64)
+    roundoff = EPS32 * np.log2(Lbin)
+    bad = diff > TOLERANCE * floor + roundoff * psd64
+    print(f"samples {len(raw)}, Lbin {Lbin}, quantization floor {floor:.3e} uT^2/Hz")
+    print(f"float64: {t64:7.2f} s, peak {m64:8.1f} MB")
+    print(f"float32: {t32:7.2f} s, peak {m32:8.1f} MB")
+    print(f"max |psd32-psd64| {err:.3e} uT^2/Hz = {err / floor:.2e} x floor, max relative {rel:.2e} "
+          f"(round-off bound {roundoff:.2e})")
+
+    if np.any(bad):
+        print(f"FAIL: {np.sum(bad)} of {len(f)} bins above {TOLERANCE} x floor + {roundoff:.2e} x psd, "
+              f"first at {f[bad][0]:.4g} Hz")
+        sys.exit(1)
+    print("OK")
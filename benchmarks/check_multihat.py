@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Multi-HAT writer check on simulated devices (simhat.py).
+
+Short runs of multihat.multi_hat_scan on two simulated boards:
+
+    clean      every sample read is stored, timeref ends at the stored rows
+    rotation   parts of one second, rows of all parts add up, first_sample
+               continues across parts
+    hardware   hardware overrun injected on one board: the run stops, the
+               flag is stored with the device and the part is closed cleanly
+    buffer     the same with a buffer overrun
+
+    python benchmarks/check_multihat.py
+"""
+import os
+import sys
+import glob
+import tempfile
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import multihat
+from simhat import SimulatedHat
+from recover_parts import superblock_open
+
+ADDRESSES = [0, 1]
+CHANNELS = [0, 1, 4]
+
+
+def run(savedir, rate, seconds, overruns=None, chunk_duration=None):
+    '''
+    (stats, parts) of one simulated run; overruns: address -> simhat overruns
+    '''
+    hats = {a: SimulatedHat(a, overruns=(overruns or {}).get(a, ())) for a in ADDRESSES}
+    saved = multihat.CHUNK_DURATION
+    if chunk_duration is not None:
+        multihat.CHUNK_DURATION = chunk_duration
+    try:
+        stats = multihat.multi_hat_scan(ADDRESSES, CHANNELS, rate, seconds, savedir, 'check', hats=hats)
+    finally:
+        multihat.CHUNK_DURATION = saved
+    parts = sorted(glob.glob(os.path.join(savedir, 'check_part*.hdf5')),
+                   key=lambda p: int(p.rsplit('part', 1)[1].split('.')[0]))
+    return stats, parts
+
+
+def check_run(name, stats, parts, overrun=None):
+    '''
+    list of failure messages of a run; overrun: (address, 'hardware' or 'buffer') injected
+    '''
+    failed = []
+    for path in parts:
+        if superblock_open(path):
+            failed.append(f"{os.path.basename(path)} not closed")
+    for a in ADDRESSES:
+        devs = [multihat.load_multi_hat(p, a) for p in parts]
+        rows = sum(len(d['voltage']) for d in devs)
+        if rows != stats[a]['samples']:
+            failed.append(f"hat{a}: {rows} rows stored, {stats[a]['samples']} read")
+        first = np.cumsum([0] + [len(d['voltage']) for d in devs[:-1]])
+        if any(int(d['first_sample']) != n for d, n in zip(devs, first)):
+            failed.append(f"hat{a}: first_sample does not continue across parts")
+        refs = np.concatenate([d['timeref'] for d in devs])
+        if len(refs) and int(refs[-1, 0]) != rows:
+            failed.append(f"hat{a}: timeref ends at {int(refs[-1, 0])}, {rows} rows")
+        for kind in ('hardware', 'buffer'):
+            want = overrun == (a, kind)
+            if bool(stats[a][f'{kind}_overrun']) != want or bool(devs[-1][f'{kind}_overrun']) != want:
+                failed.append(f"hat{a}: {kind}_overrun {stats[a][f'{kind}_overrun']}, expected {want}")
+    status = 'FAIL' if failed else 'ok'
+    print(f"  {name:9s} {len(parts)} parts, samples "
+          + ', '.join(f"hat{a} {stats[a]['samples']}" for a in ADDRESSES) + f"  {status}")
+    for msg in failed:
+        print(f"    {msg}")
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Multi-HAT check',
+        description='Run the multi-HAT writer on simulated boards, with rotation and injected overruns.'
+    )
+    parser.add_argument('-s', '--scan_rate', type=float, default=1000., help='Sample rate in Hz')
+    parser.add_argument('-t', '--time', type=float, default=3., help='Seconds per run')
+    args = parser.parse_args()
+
+    failed = []
+    t_fault = args.time / 3
+    with tempfile.TemporaryDirectory() as tmp:
+        cases = [
+            ('clean', {}, None, None),
+            ('rotation', {}, None, 1.),
+            ('hardware', {1: [(t_fault, 'hardware')]}, (1, 'hardware'), None),
+            ('buffer', {0: [(t_fault, 'buffer')]}, (0, 'buffer'), None),
+        ]
+        for name, overruns, expected, chunk in cases:
+            savedir = os.path.join(tmp, name)
+            stats, parts = run(savedir, args.scan_rate, args.time, overruns, chunk)
+            failed += check_run(name, stats, parts, expected)
+            if name == 'rotation' and len(parts) < 2:
+                failed.append('rotation: no part was rotated')
+
+    if failed:
+        print(f"FAIL: {len(failed)} checks")
+        sys.exit(1)
+    print("OK")
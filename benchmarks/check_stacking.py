@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Quality-gated stacking check on synthetic parts (stacking.py).
+
+A clean synthetic part is stacked as reference, then copies with faults
+that the inverse-power weights must not follow:
+
+    flat     one Lbin stretch of constant codes (stuck or saturated adc):
+             rejected as 'quiet', the weighted stack stays at the reference
+    clamp    the same with the quiet rule off: the weight clamp alone keeps
+             the weighted stack within a factor of the reference
+    marked   a zero-filled corrupt tail marked by recover_parts.py --mark
+             (valid_rows): not stacked, the result equals the reference
+
+    python benchmarks/check_stacking.py
+"""
+import os
+import sys
+import shutil
+import tempfile
+import argparse
+import h5py
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stacking import stack_campaign, DEFAULT_RULES
+from synthetic import write_hdf5
+
+TOLERANCE = 0.1     # relative deviation of the weighted stack, quiet rule on
+CLAMP_FACTOR = 2.   # bound with the weight clamp only
+
+
+def flatten(src, dst, t0, t1):
+    '''
+    copy of part `src` with codes between t0 and t1 s held constant
+    '''
+    shutil.copyfile(src, dst)
+    with h5py.File(dst, 'r+') as f:
+        dset = f['voltage']
+        fs = float(dset.attrs['sample_rate'])
+        a, b = int(t0 * fs), int(t1 * fs)
+        dset[a:b] = np.full((b - a, dset.shape[1]), 32768, dtype=np.uint16)
+    return dst
+
+
+def mark_tail(src, dst, seconds):
+    '''
+    copy of part `src` with `seconds` of zero rows appended and marked invalid
+    '''
+    shutil.copyfile(src, dst)
+    with h5py.File(dst, 'r+') as f:
+        dset = f['voltage']
+        n = dset.shape[0]
+        dset.resize(n + int(seconds * float(dset.attrs['sample_rate'])), axis=0)
+        dset[n:] = 0
+        dset.attrs['valid_rows'] = n
+    return dst
+
+
+def deviation(res, ref):
+    '''
+    largest |log10| ratio of the weighted stack to the reference, per axis
+    over all bins (single bins scatter with the segments left out)
+    '''
+    return float(np.max(np.abs(np.log10(res['psd'].sum(axis=1) / ref['psd'].sum(axis=1)))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Stacking check',
+        description='Stack synthetic parts with a flat stretch and compare with the clean stack.'
+    )
+    parser.add_argument('-s', '--scan_rate', type=float, default=200., help='Sample rate in Hz')
+    parser.add_argument('-t', '--time', type=float, default=400., help='Part length in s')
+    parser.add_argument('-L', '--lbin', type=float, default=20., help='Segment length in s')
+    args = parser.parse_args()
+
+    failed = []
+    with tempfile.TemporaryDirectory() as tmp:
+        clean = write_hdf5(os.path.join(tmp, 'clean.hdf5'), args.time, args.scan_rate, summary=False)
+        flat = flatten(clean, os.path.join(tmp, 'flat.hdf5'), 0., args.lbin)
+        ref = stack_campaign([clean], args.lbin, workers=1)
+        cases = [
+            ('flat', DEFAULT_RULES, 10**TOLERANCE),
+            ('clamp', {**DEFAULT_RULES, 'quiet_mad': None}, CLAMP_FACTOR),
+        ]
+        for name, rules, bound in cases:
+            res = stack_campaign([flat], args.lbin, rules=rules, workers=1)
+            dev = deviation(res, ref)
+            reason = res['table']['reason'][0].decode()
+            ok = dev <= np.log10(bound)
+            if name == 'flat' and reason != 'quiet':
+                ok = False
+                failed.append(f"{name}: flat segment not rejected (reason '{reason}')")
+            if dev > np.log10(bound):
+                failed.append(f"{name}: weighted stack off by x{10**dev:.3g}, bound x{bound:.3g}")
+            print(f"  {name:6s} segment 0 reason '{reason}', weight {res['table']['weight'][0].max():.3g}, "
+                  f"weighted stack within x{10**dev:.3f} of clean  {'ok' if ok else 'FAIL'}")
+        marked = mark_tail(clean, os.path.join(tmp, 'marked.hdf5'), 2 * args.lbin)
+        res = stack_campaign([marked], args.lbin, workers=1)
+        ok = len(res['table']) == len(ref['table']) and np.allclose(res['psd'], ref['psd'])
+        if not ok:
+            failed.append(f"marked: {len(res['table'])} segments scored, {len(ref['table'])} valid")
+        print(f"  {'marked':6s} {len(res['table'])} segments scored, {len(ref['table'])} valid  {'ok' if ok else 'FAIL'}")
+
+    if failed:
+        for msg in failed:
+            print(f"    {msg}")
+        print(f"FAIL: {len(failed)} checks")
+        sys.exit(1)
+    print("OK")
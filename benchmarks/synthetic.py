@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Synthetic magnetometer records in the formats the acquisition scripts write.
+
+Codes are a quiet sensor near mid-scale: white noise of `sigma` codes, a
+random-walk drift and two lines (7.3 Hz, 50 Hz), generated block by block
+with continuous phase and drift so hour-long 100 kS/s files never need the
+whole record in memory.
+
+    write_hdf5   part file as scan_save_rawh5_fault_tolerant.py: uint16
+                 `voltage` (rows, nch) with its attributes, `gaps` and
+                 `summary` tables
+    write_csv    csv as continuous_scan_savecsv.py: Channel_<n> header and
+                 calibrated volts
+
+    python benchmarks/synthetic.py out.hdf5 -s 10000 -t 600
+    python benchmarks/synthetic.py out.csv -s 1000 -t 60
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BLOCK = 1 << 20     # rows generated at a time
+CHANNELS = [0, 1, 4]
+
+
+def iter_codes(n, fs, nch=3, sigma=20., seed=0, block=BLOCK):
+    '''
+    yields (rows, nch) uint16 code blocks adding up to n rows
+    '''
+    rng = np.random.default_rng(seed)
+    # every channel gets its own line phases and drift
+    phase = rng.uniform(0, 2 * np.pi, size=(2, nch))
+    drift = np.zeros(nch)
+    for start in range(0, n, block):
+        m = min(block, n - start)
+        t = (start + np.arange(m))[:, None] / fs
+        codes = 32768. + sigma * rng.standard_normal((m, nch))
+        codes += 5. * np.sin(2 * np.pi * 7.3 * t + phase[0]) + 2. * np.sin(2 * np.pi * 50. * t + phase[1])
+        walk = np.cumsum(rng.standard_normal((m, nch)), axis=0) * 0.05
+        codes += drift + walk
+        drift += walk[-1]
+        yield np.clip(np.round(codes), 0, 65535).astype(np.uint16)
+
+
+def synthetic_codes(n, fs, nch=1, sigma=20., seed=0):
+    '''
+    whole record of codes, shape (n,) for one channel, (n, nch) otherwise
+    '''
+    codes = np.concatenate(list(iter_codes(n, fs, nch, sigma, seed)))
+    return codes[:, 0] if nch == 1 else codes
+
+
+def write_hdf5(path, duration, fs, nch=3, chunksize=8192, seed=0, summary=True):
+    """
+    Write a synthetic part file.
+
+    Args:
+        path (str): output file.
+        duration (float): record length in s.
+        fs (float): sample rate in Hz.
+        nch (int): channels, columns are in acquisition order (0, 1, 4 -> x, z, y).
+        chunksize (int): hdf5 chunk rows, as the writer's --chunksize.
+        seed (int): random seed.
+        summary (bool): add the per-second summary table.
+
+    Returns:
+        str: path
+    """
+    import h5py
+    from blockstats import BlockSummarizer, create_summary, append_summary
+    from magio import PART_GAP_DTYPE
+    n = int(round(duration * fs))
+    start_ts = time.strftime("%Y_%m_%d_%H_%M", time.localtime())
+    summary_block = max(int(round(fs)), 1)
+    with h5py.File(path, 'w', libver='latest') as f:
+        dset = f.create_dataset('voltage', shape=(n, nch), maxshape=(None, nch),
+                                chunks=(min(chunksize, max(n, 1)), nch), dtype='uint16')
+        dset.attrs['dtype'] = 'uint16'
+        dset.attrs['sample_rate'] = fs
+        dset.attrs['start_time'] = start_ts
+        dset.attrs['measure_time'] = duration
+        dset.attrs['end_time'] = start_ts
+        f.create_dataset('gaps', shape=(0,), maxshape=(None,), chunks=(64,), dtype=PART_GAP_DTYPE)
+        summarizer = BlockSummarizer(nch, summary_block) if summary else None
+        if summary:
+            sdset = create_summary(f, nch, summary_block, fs)
+        row = 0
+        for codes in iter_codes(n, fs, nch, seed=seed):
+            dset[row:row + len(codes)] = codes
+            row += len(codes)
+            if summary:
+                append_summary(sdset, summarizer.update(codes))
+        if summary:
+            append_summary(sdset, summarizer.flush())
+    return path
+
+
+def write_csv(path, duration, fs, channels=CHANNELS, seed=0):
+    '''
+    synthetic csv in volts with the Channel_<n> header of continuous_scan_savecsv.py
+    '''
+    from magcore import calibrate_data
+    n = int(round(duration * fs))
+    with open(path, 'w', newline='') as f:
+        f.write(','.join(f"Channel_{ch}" for ch in channels) + '\r\n')
+        for codes in iter_codes(n, fs, len(channels), seed=seed):
+            np.savetxt(f, calibrate_data(codes), fmt='%.16g', delimiter=',', newline='\r\n')
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Synthetic data',
+        description='Write a synthetic magnetometer record as hdf5 part or csv.'
+    )
+    parser.add_argument('path', type=str, help='Output .hdf5 or .csv file')
+    parser.add_argument('-t', '--time', type=float, default=60.0, help='Record length in s')
+    parser.add_argument('-s', '--scan_rate', type=float, default=1000.0, help='Sample rate in Hz')
+    parser.add_argument('-c', '--channels', type=int, default=3, help='Number of channels')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.path.endswith('.csv'):
+        write_csv(args.path, args.time, args.scan_rate, CHANNELS[:args.channels], args.seed)
+    else:
+        write_hdf5(args.path, args.time, args.scan_rate, args.channels, seed=args.seed)
+    print(f"{args.path}: {os.path.getsize(args.path) / 1e6:.1f} MB")
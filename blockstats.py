@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Per-block summary statistics of raw magnetometer codes.
+
+Every `blocksize` stored rows (one second by default) get one row in the
+`summary` dataset of the part: first row, count, and per channel mean, M2
+(sum of squared deviations), min and max of the uint16 codes. The
+acquisition writer fills it as data arrives; `summarize_part` adds it to
+existing files. Summaries merge exactly (Chan et al. pairwise update), so the
+mean, std and standard error of any block-aligned time range, or a week of
+DC drift, come out of a few kB per part without touching the raw data.
+"""
+import argparse
+import h5py
+import numpy as np
+from magcore import _CODE_ZERO, _CODE_TO_VOLT, VOLT_TO_UT, AXIS_COLUMNS
+from magio import iter_hdf5_blocks
+from blockreader import stored_rows
+
+# μT per adc code, the calibration (magcore.calibrate_data) is affine
+CODE_TO_UT = _CODE_TO_VOLT * VOLT_TO_UT
+
+
+def summary_dtype(nch):
+    return np.dtype([
+        ('row', 'i8'),
+        ('count', 'i8'),
+        ('mean', 'f8', (nch,)),
+        ('m2', 'f8', (nch,)),
+        ('min', 'u2', (nch,)),
+        ('max', 'u2', (nch,)),
+    ])
+
+
+def block_rows(codes, first_row):
+    '''
+    summary rows of consecutive equal blocks, codes has shape (nblocks, blocksize, nch)
+    '''
+    nblocks, blocksize, nch = codes.shape
+    rows = np.zeros(nblocks, dtype=summary_dtype(nch))
+    rows['row'] = first_row + np.arange(nblocks) * blocksize
+    rows['count'] = blocksize
+    if blocksize == 0:
+        return rows
+    mean = codes.mean(axis=1, dtype=np.float64)
+    dev = codes - mean[:, None, :]
+    rows['mean'] = mean
+    rows['m2'] = np.einsum('bnc,bnc->bc', dev, dev)
+    rows['min'] = codes.min(axis=1)
+    rows['max'] = codes.max(axis=1)
+    return rows
+
+
+class BlockSummarizer:
+    """
+    Cuts a stream of (n, nch) code blocks into fixed blocks of stored rows
+    and returns one summary row per completed block.
+
+    Args:
+        nch (int): channels per row.
+        blocksize (int): rows per summary block.
+        first_row (int): stored row of the first sample fed.
+    """
+
+    def __init__(self, nch, blocksize, first_row=0):
+        self.nch = nch
+        self.blocksize = int(blocksize)
+        self.row = first_row
+        self._pending = np.zeros((0, nch), dtype=np.uint16)
+
+    def update(self, codes):
+        codes = np.asarray(codes).reshape(-1, self.nch)
+        if len(self._pending):
+            codes = np.concatenate([self._pending, codes])
+        nblocks = len(codes) // self.blocksize
+        full = nblocks * self.blocksize
+        rows = block_rows(codes[:full].reshape(nblocks, self.blocksize, self.nch), self.row)
+        self.row += full
+        self._pending = codes[full:].copy()
+        return rows
+
+    def flush(self):
+        '''
+        summary row of the incomplete last block, empty if there is none
+        '''
+        n = len(self._pending)
+        if n == 0:
+            return np.zeros(0, dtype=summary_dtype(self.nch))
+        rows = block_rows(self._pending[None], self.row)
+        self.row += n
+        self._pending = self._pending[:0]
+        return rows
+
+
+def create_summary(h5file, nch, blocksize, sample_rate):
+    '''
+    empty resizable summary dataset in an open part file
+    '''
+    dset = h5file.create_dataset('summary', shape=(0,), maxshape=(None,), chunks=(256,),
+                                 dtype=summary_dtype(nch))
+    dset.attrs['blocksize'] = blocksize
+    dset.attrs['sample_rate'] = sample_rate
+    return dset
+
+
+def append_summary(dset, rows):
+    if len(rows):
+        old = dset.shape[0]
+        dset.resize((old + len(rows),))
+        dset[old:] = rows
+
+
+def merge_summary(rows):
+    """
+    Exact statistics of the samples covered by summary rows.
+
+    Returns:
+        dict: 'count', and per channel 'mean', 'm2', 'var', 'std', 'sem',
+        'min', 'max' in adc codes.
+    """
+    rows = rows[rows['count'] > 0]
+    n = np.sum(rows['count'])
+    w = rows['count'][:, None].astype(np.float64)
+    mean = np.sum(w * rows['mean'], axis=0) / n
+    m2 = np.sum(rows['m2'], axis=0) + np.sum(w * (rows['mean'] - mean)**2, axis=0)
+    res = {}
+    res['count'] = int(n)
+    res['mean'] = mean
+    res['m2'] = m2
+    res['var'] = m2 / n
+    res['std'] = np.sqrt(res['var'])
+    res['sem'] = res['std'] / np.sqrt(n)
+    res['min'] = rows['min'].min(axis=0)
+    res['max'] = rows['max'].max(axis=0)
+    return res
+
+
+def stats_to_ut(stats):
+    '''
+    convert merged code statistics into μT (affine calibration), adds 'x', 'y', 'z' dicts
+    '''
+    out = dict(stats)
+    for key in ('mean', 'min', 'max'):
+        code = np.asarray(stats[key], dtype=np.float64)
+        out[key] = (code - _CODE_ZERO) * CODE_TO_UT
+    for key in ('std', 'sem'):
+        out[key] = stats[key] * CODE_TO_UT
+    out['var'] = stats['var'] * CODE_TO_UT**2
+    out['m2'] = stats['m2'] * CODE_TO_UT**2
+    nch = len(out['mean'])
+    axes = {'x': 0} if nch == 1 else AXIS_COLUMNS
+    for ax, col in axes.items():
+        out[ax] = {key: out[key][col] for key in ('mean', 'std', 'sem', 'min', 'max')}
+    return out
+
+
+def summarize_part(path, blocksize=None, overwrite=False):
+    """
+    Post-pass: add the summary dataset to a closed part file.
+
+    Args:
+        path (str): part file.
+        blocksize (int): rows per block, default one second of samples.
+        overwrite (bool): replace an existing summary.
+    """
+    with h5py.File(path, 'r') as f:
+        if 'summary' in f and not overwrite:
+            print(f"{path}: summary exists")
+            return
+        data = f['voltage']
+        fs = float(data.attrs['sample_rate'])
+        nch = data.shape[1] if data.ndim > 1 else 1
+    blocksize = blocksize or max(int(round(fs)), 1)
+    summarizer = BlockSummarizer(nch, blocksize)
+    parts = [summarizer.update(raw) for _, raw in iter_hdf5_blocks(path, 64 * blocksize, align=True)]
+    parts.append(summarizer.flush())
+    with h5py.File(path, 'r+') as f:
+        if 'summary' in f:
+            del f['summary']
+        append_summary(create_summary(f, nch, blocksize, fs), np.concatenate(parts))
+    print(f"{path}: {summarizer.row} rows in {sum(len(p) for p in parts)} blocks")
+
+
+def load_summary(path):
+    '''
+    summary table and block size of a part, (None, None) if it has none
+    '''
+    with h5py.File(path, 'r', swmr=True) as f:
+        if 'summary' not in f:
+            return None, None
+        dset = f['summary']
+        return dset[:], int(dset.attrs['blocksize'])
+
+
+def _part_summary(path, sample_rate=None):
+    '''
+    (summary rows inside the stored rows, sample rate, stored rows) of a part
+    '''
+    rows, _ = load_summary(path)
+    if rows is None:
+        raise ValueError(f"{path} has no summary, run blockstats.py on it first")
+    with h5py.File(path, 'r', swmr=True) as f:
+        fs = sample_rate or float(f['voltage'].attrs['sample_rate'])
+        # a tail marked by recover_parts.py is not part of the run clock
+        nrows = stored_rows(f['voltage'])
+    return rows[rows['row'] < nrows], fs, nrows
+
+
+def range_stats(paths, t_start=0., t_stop=np.inf, sample_rate=None):
+    """
+    Exact statistics of a time range over consecutive parts from their
+    summaries. t_start/t_stop are seconds of stored samples from the start
+    of the first part and are rounded to the enclosing blocks.
+
+    Returns:
+        dict: merge_summary result in μT (see stats_to_ut), with 't_start'
+        and 't_stop' of the blocks actually covered.
+    """
+    selected = []
+    offset = 0
+    for path in paths:
+        rows, fs, nrows = _part_summary(path, sample_rate)
+        t0 = (rows['row'] + offset) / fs
+        t1 = (rows['row'] + rows['count'] + offset) / fs
+        selected.append(rows[(t1 > t_start) & (t0 < t_stop)])
+        # keep the block start times on the run clock
+        selected[-1]['row'] += offset
+        offset += nrows
+    rows = np.concatenate(selected)
+    if len(rows) == 0:
+        raise ValueError('no blocks in the requested range')
+    res = stats_to_ut(merge_summary(rows))
+    res['t_start'] = rows['row'][0] / fs
+    res['t_stop'] = (rows['row'][-1] + rows['count'][-1]) / fs
+    return res
+
+
+def dc_drift(paths):
+    """
+    Per-block mean and std in μT over consecutive parts, for drift plots.
+
+    Returns:
+        dict: 't' block start in s from the first part, and per axis
+        {'mean', 'std'} arrays.
+    """
+    ts, means, stds = [], [], []
+    offset = 0
+    for path in paths:
+        rows, fs, nrows = _part_summary(path)
+        ts.append((rows['row'] + offset) / fs)
+        means.append(rows['mean'])
+        stds.append(np.sqrt(rows['m2'] / np.maximum(rows['count'], 1)[:, None]))
+        offset += nrows
+    mean = (np.concatenate(means) - _CODE_ZERO) * CODE_TO_UT
+    std = np.concatenate(stds) * CODE_TO_UT
+    dset = {'t': np.concatenate(ts)}
+    axes = {'x': 0} if mean.shape[1] == 1 else AXIS_COLUMNS
+    for ax, col in axes.items():
+        dset[ax] = {'mean': mean[:, col], 'std': std[:, col]}
+    return dset
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Block stats',
+        description='Add per-block summary statistics to hdf5 parts, or print range statistics.'
+    )
+    parser.add_argument('parts', type=str, nargs='+', help='Part files in acquisition order')
+    parser.add_argument('-b', '--blocksize', type=int, default=None,
+                        help='Rows per block (default one second)')
+    parser.add_argument('-f', '--force', action='store_true', help='Recompute existing summaries')
+    parser.add_argument('-r', '--range', type=float, nargs=2, default=None, metavar=('T0', 'T1'),
+                        help='Print statistics of this time range (s) instead of summarizing')
+    args = parser.parse_args()
+
+    if args.range is None:
+        for path in args.parts:
+            summarize_part(path, args.blocksize, args.force)
+    else:
+        res = range_stats(args.parts, *args.range)
+        print(f"Ns: {res['count']}  t: {res['t_start']:.1f}-{res['t_stop']:.1f} s")
+        for ax in ('x', 'y', 'z'):
+            if ax in res:
+                s = res[ax]
+                print(f" {ax}: mean {s['mean']:.6f} std {s['std']:.6f} sem {s['sem']:.3e} uT")
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Exact statistics of raw adc codes from per-channel code histograms.
+
+A part is read block by block and every channel's uint16 codes are counted
+into 65536 bins with one `np.bincount` per block, parts in parallel; the
+histograms add up exactly across blocks and parts, so memory stays at
+nch x 65536 counters for any run length. From the histogram:
+
+    mean, variance (integer sums, exact up to the final division), min,
+    max, exact percentiles (same interpolation as np.percentile)
+    clipping: samples at the rails 0 and 65535
+    missing codes and DNL: code density test against the histogram smoothed
+    (quadratic Savitzky-Golay over DNL_WIDTH codes) where counts are high enough
+
+Only the final numbers are calibrated to μT (blockstats.stats_to_ut).
+
+    python codestats.py mag_2025_*_part*.hdf5 -j 4 -o hist.hdf5
+"""
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import h5py
+import numpy as np
+from magcore import _CODE_ZERO, AXIS_COLUMNS
+from magio import iter_hdf5_blocks
+from blockstats import stats_to_ut, CODE_TO_UT
+
+NCODES = 65536
+DEFAULT_BLOCKSIZE = 1 << 20
+DNL_WIDTH = 33          # codes in the smooth reference of the density test
+DNL_MIN_COUNT = 100     # smoothed counts per code needed to judge it
+
+
+def code_to_ut(code):
+    return (np.asarray(code, dtype=np.float64) - _CODE_ZERO) * CODE_TO_UT
+
+
+def code_histogram(codes):
+    '''
+    (nch, 65536) int64 counts of a (n, nch) block of uint16 codes, one bincount for all channels
+    '''
+    codes = np.asarray(codes)
+    codes = codes.reshape(len(codes), -1)
+    nch = codes.shape[1]
+    idx = codes.astype(np.int64) + np.arange(nch, dtype=np.int64) * NCODES
+    return np.bincount(idx.ravel(), minlength=nch * NCODES).reshape(nch, NCODES)
+
+
+def histogram_part(path, blocksize=DEFAULT_BLOCKSIZE):
+    '''
+    code histogram of one hdf5 part, read in blocks
+    '''
+    hist = None
+    for _, raw in iter_hdf5_blocks(path, blocksize, align=True):
+        h = code_histogram(raw)
+        hist = h if hist is None else hist + h
+    return hist
+
+
+def histogram_parts(paths, blocksize=DEFAULT_BLOCKSIZE, workers=None):
+    """
+    Summed code histogram of many parts, one worker process per part.
+
+    Returns:
+        numpy.ndarray: (nch, 65536) int64 counts
+
+    Raises:
+        ValueError: if the parts hold no samples.
+    """
+    total = None
+    if workers == 1 or len(paths) == 1:
+        hists = (histogram_part(p, blocksize) for p in paths)
+        for h in hists:
+            if h is not None:
+                total = h if total is None else total + h
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for p, h in zip(paths, pool.map(histogram_part, paths, [blocksize] * len(paths))):
+                print('->histogram ' + p, end='\r')
+                if h is not None:
+                    total = h if total is None else total + h
+    if total is None or not total.any():
+        raise ValueError(f"no samples in {len(paths)} parts")
+    return total
+
+
+def hist_percentiles(hist, q):
+    '''
+    exact percentiles in codes per channel, linear interpolation between
+    order statistics as np.percentile; shape (nch, len(q))
+    '''
+    q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+    out = np.zeros((hist.shape[0], len(q)))
+    for c, h in enumerate(hist):
+        cum = np.cumsum(h)
+        rank = q / 100. * (cum[-1] - 1)
+        lo = np.floor(rank).astype(np.int64)
+        # code of the j-th smallest sample (0-based)
+        vlo = np.searchsorted(cum, lo, side='right')
+        vhi = np.searchsorted(cum, np.minimum(lo + 1, cum[-1] - 1), side='right')
+        out[c] = vlo + (rank - lo) * (vhi - vlo)
+    return out
+
+
+def hist_stats(hist):
+    """
+    Exact moments and range per channel from code histograms.
+
+    Returns:
+        dict: 'count', and per channel 'mean', 'm2', 'var', 'std', 'sem',
+        'min', 'max' in adc codes (same keys as blockstats.merge_summary).
+    """
+    codes = np.arange(NCODES, dtype=object)
+    nch = hist.shape[0]
+    res = {key: np.zeros(nch) for key in ('mean', 'm2', 'var', 'std', 'sem')}
+    res['min'] = np.zeros(nch, dtype=np.uint16)
+    res['max'] = np.zeros(nch, dtype=np.uint16)
+    n = int(hist[0].sum())
+    for c, h in enumerate(hist):
+        h_obj = h.astype(object)
+        # python integers, no overflow however long the run
+        s1 = int(np.dot(codes, h_obj))
+        s2 = int(np.dot(codes * codes, h_obj))
+        m2 = (n * s2 - s1 * s1) / n
+        res['mean'][c] = s1 / n
+        res['m2'][c] = m2
+        nz = np.flatnonzero(h)
+        res['min'][c], res['max'][c] = nz[0], nz[-1]
+    res['count'] = n
+    res['var'] = res['m2'] / n
+    res['std'] = np.sqrt(res['var'])
+    res['sem'] = res['std'] / np.sqrt(n)
+    return res
+
+
+def clipping(hist):
+    '''
+    samples at the lower and upper rail per channel, and their fraction
+    '''
+    n = hist.sum(axis=1)
+    return {'low': hist[:, 0], 'high': hist[:, -1], 'fraction': (hist[:, 0] + hist[:, -1]) / n}
+
+
+def dnl(hist, width=DNL_WIDTH, min_count=DNL_MIN_COUNT):
+    """
+    Code density test against the histogram smoothed with a quadratic
+    Savitzky-Golay filter over `width` codes, which follows the curvature of
+    a noise peak without bias.
+
+    The signal must cover the judged codes smoothly (noise several codes
+    wide, or a ramp); lines and spikes in the distribution show up as DNL.
+
+    Returns:
+        dict: per channel 'dnl' (nch, 65536) in LSB (nan where not judged),
+        'judged' code count, 'missing' list of codes with no count,
+        'max' |DNL| and 'rms' DNL over the judged codes.
+    """
+    from scipy.signal import savgol_filter
+    ref = savgol_filter(hist.astype(np.float64), width, 2, axis=1, mode='constant')
+    judged = ref >= min_count
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = np.where(judged, hist / ref - 1., np.nan)
+    res = {'dnl': d, 'judged': judged.sum(axis=1), 'missing': [], 'max': np.zeros(len(hist)),
+           'rms': np.zeros(len(hist))}
+    for c in range(len(hist)):
+        sel = judged[c]
+        res['missing'].append(np.flatnonzero(sel & (hist[c] == 0)))
+        if np.any(sel):
+            res['max'][c] = np.max(np.abs(d[c, sel]))
+            res['rms'][c] = np.sqrt(np.mean(d[c, sel]**2))
+    return res
+
+
+def qualify(hist, percentiles=(0.1, 1., 50., 99., 99.9), dnl_width=DNL_WIDTH):
+    """
+    Full report of a code histogram.
+
+    Returns:
+        dict: stats_to_ut of the exact moments (per axis under 'x', 'y', 'z'),
+        'percentiles' {q: μT per channel}, 'percentile_codes' (nch, nq),
+        'clipping' and 'dnl' (see clipping, dnl).
+
+    Raises:
+        ValueError: if the histogram holds no samples.
+    """
+    if not np.any(hist):
+        raise ValueError('no samples in the histogram')
+    res = stats_to_ut(hist_stats(hist))
+    pc = hist_percentiles(hist, percentiles)
+    res['percentile_codes'] = pc
+    res['percentiles'] = {q: code_to_ut(pc[:, i]) for i, q in enumerate(percentiles)}
+    res['clipping'] = clipping(hist)
+    res['dnl'] = dnl(hist, dnl_width)
+    return res
+
+
+def save_histogram(path, hist, sources=()):
+    with h5py.File(path, 'w') as f:
+        dset = f.create_dataset('histogram', data=hist, compression='gzip', compression_opts=4)
+        dset.attrs['units'] = 'counts per adc code'
+        f.attrs['sources'] = [os.path.basename(p) for p in sources]
+
+
+def load_histogram(path):
+    with h5py.File(path, 'r') as f:
+        return f['histogram'][:]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Code stats',
+        description='Exact statistics, clipping and DNL of raw adc codes from code histograms.'
+    )
+    parser.add_argument('parts', type=str, nargs='+', help='Part files (or one saved histogram with -l)')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='Worker processes')
+    parser.add_argument('-b', '--blocksize', type=int, default=DEFAULT_BLOCKSIZE, help='Rows per read block')
+    parser.add_argument('-o', '--out', type=str, default=None, help='Save the summed histogram here')
+    parser.add_argument('-l', '--load', action='store_true', help='Read a histogram saved with -o')
+    args = parser.parse_args()
+
+    if args.load:
+        hist = sum(load_histogram(p) for p in args.parts)
+    else:
+        hist = histogram_parts(args.parts, args.blocksize, args.workers)
+        if args.out:
+            save_histogram(args.out, hist, args.parts)
+    res = qualify(hist)
+    print(f"Ns: {res['count']}")
+    axes = [ax for ax in ('x', 'y', 'z') if ax in res]
+    cols = {'x': 0} if len(axes) == 1 else AXIS_COLUMNS
+    for ax in axes:
+        c = cols[ax]
+        s = res[ax]
+        pc = '  '.join(f"p{q:g} {v[c]:.6f}" for q, v in res['percentiles'].items())
+        print(f" {ax}: mean {s['mean']:.6f} std {s['std']:.6f} min {s['min']:.6f} max {s['max']:.6f} uT")
+        print(f"    {pc} uT")
+        print(f"    clipped {res['clipping']['low'][c]} low / {res['clipping']['high'][c]} high, "
+              f"DNL max {res['dnl']['max'][c]:.3f} rms {res['dnl']['rms'][c]:.3f} LSB over "
+              f"{res['dnl']['judged'][c]} codes, {len(res['dnl']['missing'][c])} missing")
@@ -3,6 +3,7 @@ import os
 import time
 from daqhats import mcc128, OptionFlags, HatIDs, HatError, AnalogInputMode, AnalogInputRange
 from daqhats_utils import select_hat_device, chan_list_to_mask
+from hatread import ScanBuffer, read_numpy
 import argparse
 import h5py
 import numpy as np
@@ -54,10 +55,11 @@ def continuous_scan_givedata(channels, scan_rate, t_measure):
         timeout = 5.0
         start_time = time.time()
 
-        data_blocks = []  # list to store data chunks
+        # rows for the whole measurement plus one read, grows if the scan runs longer
+        buffer = ScanBuffer(num_channels, int(actual_scan_rate * t_measure) + 2 * int(actual_scan_rate), np.float64)
 
         while True:
-            read_result = hat.a_in_scan_read(read_request_size, timeout)
+            read_result = read_numpy(hat, read_request_size, timeout)
 
             if read_result.hardware_overrun:
                 print("\nHardware overrun!")
@@ -66,13 +68,7 @@ def continuous_scan_givedata(channels, scan_rate, t_measure):
                 print("\nBuffer overrun!")
                 break
 
-            data_pack = np.array(read_result.data)
-            samples_read_per_channel = int(len(data_pack) / num_channels)
-            
-            # Reshape into (samples_read_per_channel, num_channels)
-            data_block = data_pack.reshape((samples_read_per_channel, num_channels))
-            
-            data_blocks.append(data_block)
+            buffer.append(read_result.data)
 
             if (time.time() - start_time) >= t_measure:
                 print("Measurement complete.")
@@ -81,13 +77,7 @@ def continuous_scan_givedata(channels, scan_rate, t_measure):
         hat.a_in_scan_stop()
         hat.a_in_scan_cleanup()
 
-        # Stack all blocks into one array
-        if data_blocks:
-            data = np.vstack(data_blocks)
-        else:
-            data = np.empty((0, num_channels))
-
-        return data
+        return buffer.view()
 
     except (HatError, ValueError) as err:
         print("\n", err)
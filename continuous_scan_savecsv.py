@@ -3,6 +3,7 @@ import os
 import time
 from daqhats import mcc128, OptionFlags, HatIDs, HatError, AnalogInputMode, AnalogInputRange
 from daqhats_utils import select_hat_device, chan_list_to_mask
+from hatread import read_numpy
 import argparse
 
 parser = argparse.ArgumentParser(
@@ -57,7 +58,7 @@ def continuous_scan_save(file_path, channels, scan_rate, t_measure):
             writer.writerow([f"Channel_{ch}" for ch in channels])
 
             while True:
-                read_result = hat.a_in_scan_read(read_request_size, timeout)
+                read_result = read_numpy(hat, read_request_size, timeout)
 
                 if read_result.hardware_overrun:
                     print("\nHardware overrun!")
@@ -66,17 +67,11 @@ def continuous_scan_save(file_path, channels, scan_rate, t_measure):
                     print("\nBuffer overrun!")
                     break
 
-                samples_read_per_channel = int(len(read_result.data) / num_channels)
-
-                for sample_index in range(samples_read_per_channel):
-                    row = []
-                    current_sample = total_samples_read + sample_index + 1
-                    base = sample_index * num_channels
-                    
-                    for i in range(num_channels):
-                        row.append(read_result.data[base + i])
-                    
-                    writer.writerow(row)
+                samples_read_per_channel = len(read_result.data) // num_channels
+
+                # one row per sample, all rows of the read in one call
+                block = read_result.data[:samples_read_per_channel * num_channels]
+                writer.writerows(block.reshape(samples_read_per_channel, num_channels).tolist())
 
                 total_samples_read += samples_read_per_channel
 
@@ -3,6 +3,7 @@ import os
 import time
 from daqhats import mcc128, OptionFlags, HatIDs, HatError, AnalogInputMode, AnalogInputRange
 from daqhats_utils import select_hat_device, chan_list_to_mask
+from hatread import ScanBuffer, read_numpy
 import argparse
 import h5py
 import numpy as np
@@ -59,10 +60,13 @@ def continuous_scan_givedata(channels, scan_rate, t_measure, dtype):
         timeout = 5.0
         start_time = time.time()
 
-        data_blocks = []  # list to store data chunks
+        # rows for the whole measurement plus one read, grows if the scan runs longer;
+        # raw codes go up to 65535, uint16 holds them (int16 wrapped the upper half)
+        buffer = ScanBuffer(num_channels, int(actual_scan_rate * t_measure) + 2 * int(actual_scan_rate),
+                            np.uint16 if dtype == 'int' else np.float64)
 
         while True:
-            read_result = hat.a_in_scan_read(read_request_size, timeout)
+            read_result = read_numpy(hat, read_request_size, timeout)
 
             if read_result.hardware_overrun:
                 print("\nHardware overrun!")
@@ -71,16 +75,7 @@ def continuous_scan_givedata(channels, scan_rate, t_measure, dtype):
                 print("\nBuffer overrun!")
                 break
 
-            data_pack = np.array(read_result.data)
-            if dtype == 'int':
-                data_pack = data_pack.astype(np.int16)
-            
-            samples_read_per_channel = int(len(data_pack) / num_channels)
-            
-            # Reshape into (samples_read_per_channel, num_channels)
-            data_block = data_pack.reshape((samples_read_per_channel, num_channels))
-            
-            data_blocks.append(data_block)
+            buffer.append(read_result.data)
 
             if (time.time() - start_time) >= t_measure:
                 print("Measurement complete.")
@@ -89,13 +84,7 @@ def continuous_scan_givedata(channels, scan_rate, t_measure, dtype):
         hat.a_in_scan_stop()
         hat.a_in_scan_cleanup()
 
-        # Stack all blocks into one array
-        if data_blocks:
-            data = np.vstack(data_blocks)
-        else:
-            data = np.empty((0, num_channels))
-
-        return data
+        return buffer.view()
 
     except (HatError, ValueError) as err:
         print("\n", err)
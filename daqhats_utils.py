@@ -58,6 +58,42 @@ def select_hat_device(filter_by_id):
     return selected_hat_address
 
 
+def select_hat_devices(filter_by_id, addresses=None):
+    # type: (HatIDs, list[int]) -> list[int]
+    """
+    This function returns the addresses of several DAQ HAT devices without
+    prompting. If no addresses are requested, all devices matching the
+    filter are returned.
+
+    Args:
+        filter_by_id (int): If this is :py:const:`HatIDs.ANY` return all DAQ
+            HATs found.  Otherwise, return only DAQ HATs with ID matching this
+            value.
+        addresses (list[int]): Addresses to use, all found devices if None.
+
+    Returns:
+        list[int]: The addresses of the selected devices, in requested order.
+
+    Raises:
+        HatError: No HAT devices are found.
+        ValueError: A requested address has no matching device.
+
+    """
+    hats = hat_list(filter_by_id=filter_by_id)
+    if not hats:
+        raise HatError(0, 'Error: No HAT devices found')
+
+    found = [hat.address for hat in hats]
+    if addresses is None:
+        return sorted(found)
+
+    missing = [address for address in addresses if address not in found]
+    if missing:
+        raise ValueError('Error: No HAT device at address {}, found {}'.format(
+            ', '.join(str(a) for a in missing), found))
+    return list(addresses)
+
+
 def enum_mask_to_string(enum_type, bit_mask):
     # type: (Enum, int) -> str
     """
@@ -0,0 +1,43 @@
+"""
+Raspberry-pi environmental logs written by monitorpi.py.
+"""
+import pandas as pd
+import matplotlib.pyplot as plt
+
+#################################################
+# Reading environmental logs
+#################################################
+
+def load_monitorpi_csv(filepath):
+    df = pd.read_csv(filepath)
+    # Convert 'localtime' from string to datetime
+    df["timestamp"] = pd.to_datetime(df["localtime"], format="%Y_%m_%d_%H_%M")
+    return df
+
+def plot_monitorpi_data(df):
+    time = df["timestamp"]
+    columns_to_plot = [
+        ("extvolt(V)", "External Voltage (V)"),
+        ("cputemp(C)", "CPU Temperature (°C)"),
+        ("envtemperature(C)", "Environment Temperature (°C)"),
+        ("envhumidity(%)", "Environment Humidity (%)"),
+        ("envpressure(hPa)", "Environment Pressure (hPa)")
+    ]
+
+    num_plots = len(columns_to_plot)
+    fig, axs = plt.subplots(num_plots, 1, figsize=(12, 2.5 * num_plots), sharex=True)
+    
+    for ax, (col, label) in zip(axs, columns_to_plot):
+        ax.plot(time, df[col], marker="o", linestyle="-")
+        ax.set_ylabel(label)
+        ax.grid(True)
+
+    axs[-1].set_xlabel("Time")
+    fig.suptitle("Raspberry Pi Sensor Readings Over Time", fontsize=14)
+    fig.tight_layout(rect=[0, 0, 1, 0.97])
+    plt.xticks(rotation=45)
+    plt.show()
+
+def plot_monitorpi_fromcsv(filepath):
+    df = load_monitorpi_csv(filepath)
+    plot_monitorpi_data(df)
@@ -0,0 +1,83 @@
+"""
+Scan reads from the MCC 128 straight into preallocated numpy arrays.
+
+`a_in_scan_read` returns the samples as a Python list of floats, one object
+per sample, which the scripts then turned back into an array. The daqhats
+`a_in_scan_read_numpy` call fills a float64 array from the C buffer
+instead; `ScanBuffer.append` casts that array in one pass into the next free
+rows of a preallocated (capacity, nch) array (uint16 codes for the raw
+scripts, float64 volts for the scaled ones), so the acquisition loop
+allocates nothing per sample. Older daqhats without the numpy call fall
+back to one list conversion per read.
+
+benchmarks/bench_hat_read.py measures the per-sample cost of the read paths
+on simhat.py or a real board.
+"""
+import numpy as np
+
+READ_ALL_AVAILABLE = -1
+
+
+def read_numpy(hat, samples_per_channel, timeout):
+    '''
+    scan read whose data is a 1d float64 array (list converted if the daqhats version has no numpy read)
+    '''
+    reader = getattr(hat, 'a_in_scan_read_numpy', None)
+    if reader is not None:
+        return reader(samples_per_channel, timeout)
+    result = hat.a_in_scan_read(samples_per_channel, timeout)
+    return result._replace(data=np.asarray(result.data, dtype=np.float64))
+
+
+class ScanBuffer:
+    """
+    Preallocated rows that successive scan reads append to.
+
+    append() casts the numpy data of a read into the next free rows and
+    returns them as a view; view() is everything filled since clear(), which
+    keeps the memory. If a read does not fit the capacity doubles, so size
+    it to the flush threshold plus one scan buffer. Views are overwritten
+    after clear(), copy what must outlive it.
+
+    Args:
+        num_channels (int): channels per row.
+        capacity (int): rows allocated up front.
+        dtype: np.uint16 for raw codes (NOSCALEDATA), np.float64 for volts.
+    """
+
+    def __init__(self, num_channels, capacity, dtype=np.uint16):
+        self.nch = num_channels
+        self.data = np.empty((max(int(capacity), 1), num_channels), dtype=dtype)
+        self.rows = 0
+
+    def __len__(self):
+        return self.rows
+
+    def reserve(self, n):
+        need = self.rows + n
+        if need > len(self.data):
+            grown = np.empty((max(need, 2 * len(self.data)), self.nch), dtype=self.data.dtype)
+            grown[:self.rows] = self.data[:self.rows]
+            self.data = grown
+
+    def append(self, raw):
+        """
+        Cast scan data (read_numpy(...).data, or rows of codes) into the next free rows.
+
+        Returns:
+            numpy.ndarray: (n, nch) view of the rows just added
+        """
+        raw = np.ravel(raw)
+        n = raw.size // self.nch
+        self.reserve(n)
+        block = self.data[self.rows:self.rows + n]
+        # one cast from the float64 scan data, raw codes are exact integers
+        np.copyto(block, raw[:n * self.nch].reshape(n, self.nch), casting='unsafe')
+        self.rows += n
+        return block
+
+    def view(self):
+        return self.data[:self.rows]
+
+    def clear(self):
+        self.rows = 0
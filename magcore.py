@@ -0,0 +1,671 @@
+"""
+Compute core of the magnetometer analysis: calibration, FFT helpers, PS and
+PSD. Depends on numpy only; scipy is imported inside the few functions that
+need it. Readers live in magio.py, plotting in magplot.py, environmental
+logs in envlog.py.
+"""
+import os
+import numpy as np
+from profiling import stage, profiled
+
+#################################################
+# Calibration
+#################################################
+
+SLOPE=1.0083421207668117
+OFFSET=-295.30861087311496
+VOLT_TO_UT = 1000./143.
+# calibrate_data: volts = (code - _CODE_ZERO) * _CODE_TO_VOLT
+_CODE_ZERO = (32768. - OFFSET)/SLOPE
+_CODE_TO_VOLT = SLOPE*20./65536.
+
+# channel order 0, 1, 4 -> x, z, y
+AXIS_COLUMNS = {'x': 0, 'y': 2, 'z': 1}
+
+# numpy < 2 promotes float32 ffts to complex128
+_FFT_PROMOTES = np.lib.NumpyVersion(np.__version__) < '2.0.0'
+
+@profiled()
+def calibrate_data(dataraw,dtype=np.float64):
+    '''
+    adc codes -> volts; dtype=np.float32 halves memory, the 16 bit codes fit exactly
+    '''
+    if dataraw.dtype == np.uint16:
+        # calibrate only int16 data, in place on one working copy;
+        # (code*SLOPE+OFFSET)/65536*20-10 regrouped so that the mid-scale
+        # offset is taken from the exact codes first: in float32 code - _CODE_ZERO
+        # is exact and the rounding of _CODE_ZERO only shifts the DC, instead
+        # of -10 V cancelling against a ~10 V intermediate in every sample
+        data = dataraw.astype(dtype)
+        data -= _CODE_ZERO
+        data *= _CODE_TO_VOLT
+    else:
+        data = np.asarray(dataraw,dtype=dtype)
+        print("No calibration, assuming data is calibrated.")
+    return data
+
+def adc_quantization_psd(fs,depth=16,scope=20.*VOLT_TO_UT):
+    '''
+    one-sided psd floor [μT^2/Hz] of a uniform quantizer with step scope/2**depth
+    '''
+    q = scope/2**depth
+    return q**2/12./(fs/2.)
+
+def _work_dtype(chs,dtype=None):
+    if dtype is not None:
+        return np.dtype(dtype)
+    return np.dtype(np.float32) if np.asarray(chs).dtype == np.float32 else np.dtype(np.float64)
+
+def _rfft(x,n=None):
+    '''
+    rfft that keeps single precision input in complex64
+    '''
+    if x.dtype == np.float32 and _FFT_PROMOTES:
+        import scipy.fft
+        return scipy.fft.rfft(x,n=n)
+    return np.fft.rfft(x,n=n)
+
+def gap_rows(gaps):
+    '''
+    sorted stored-row indices of the discontinuities, accepts a gap table or plain indices
+    '''
+    if gaps is None:
+        return np.zeros(0, dtype=np.int64)
+    gaps = np.asarray(gaps)
+    rows = gaps['row'] if gaps.dtype.names else gaps
+    return np.sort(rows.astype(np.int64))
+
+#################################################
+# FFT Power Spectrum prelim (not used!)
+#################################################
+
+def fft_timeseries(chs,samplerate):
+    n = len(chs)
+    freq = np.fft.fftfreq(n, d=1/samplerate)
+    fft_values = np.fft.fft(chs)
+    return freq, fft_values.real, fft_values.imag
+
+def fft_power_spectrum(chs,samplerate):
+    freq, real, imag = fft_timeseries(chs, samplerate)
+    power_spectrum = real**2 + imag**2
+    
+    dt = 1. / samplerate
+    power_spectrum = power_spectrum * dt**2 / 2. /np.pi
+    return freq, power_spectrum
+
+def fft_asd(chs,samplerate):
+    freq, real, imag = fft_timeseries(chs, samplerate)
+    power_spectrum = real**2 + imag**2
+    
+    dt = 1. / samplerate
+    N = len(chs)
+    psd = power_spectrum * dt / N / 2. / np.pi  # Convert to power spectral density
+    asd = np.sqrt(psd)
+    return freq, asd
+
+def fft_amplitude(chs, samplerate):
+    freq, real, imag = fft_timeseries(chs, samplerate)
+    amplitude = np.sqrt(real**2 + imag**2)
+    N = len(chs)
+    amplitude = amplitude / N * 2  # Normalize amplitude
+    return freq, amplitude
+
+def slide_window_average(data,window_array,mode='wrap'):
+    '''
+    convolve data with window_array (centred as scipy.ndimage.convolve), see smooth;
+    pass mode='nearest' or 'reflect' for non-periodic records
+    '''
+    return smooth(data,window=window_array,mode=mode)
+
+@profiled()
+def gaussian_stft(chs, samplerate, g_std = 1000, g_length = 10000, mfft = 1000, hop=1000, dtype=None):
+    from scipy.signal import ShortTimeFFT
+    from scipy.signal.windows import gaussian
+    fs = samplerate
+    dtype = _work_dtype(chs,dtype)
+    chs = np.asarray(chs,dtype=dtype)
+    N = len(chs)
+    t_x = np.arange(N) * 1.0/ fs
+    # float32 window and data keep scipy.fft in complex64
+    w = gaussian(g_length,std=g_std,sym=True).astype(dtype)
+    SFT = ShortTimeFFT(w, hop=hop, fs=fs, mfft=mfft, scale_to='magnitude')
+    Sx = SFT.stft(chs)
+
+    extent = SFT.extent(N)
+    window_width = SFT.m_num*SFT.T
+    sigma_t = g_std*SFT.T
+    delta_t = SFT.delta_t
+    delta_f = SFT.delta_f
+
+    res = {}
+    res['sx'] = Sx
+    res['extent'] = extent
+    res['window_width'] = window_width
+    res['sigma_t'] = sigma_t
+    res['delta_t'] = delta_t
+    res['delta_f'] = delta_f
+
+    return res
+
+#################################################
+# FFT Power Spectrum and Power Spectral Density
+#################################################
+
+def compute_psd(chs,fs,nodc=True,dtype=None):
+    '''
+    one-sided psd with hamming window; float32 input (or dtype=np.float32)
+    runs the fft in single precision, mean and window sums stay float64
+    '''
+    dtype = _work_dtype(chs,dtype)
+    # remove DC
+    chs = np.asarray(chs,dtype=dtype) - dtype.type(np.mean(chs,dtype=np.float64))
+    N = len(chs)
+    
+    # add window
+    ws = np.hamming(N)
+    ws1 = np.sum(ws)
+    ws2 = np.sum(ws**2)
+
+    # rfft
+    f = np.fft.rfftfreq(N,1./fs)
+    chs *= ws.astype(dtype)
+    ak = _rfft(chs)
+
+    # normalize into psd
+    psd = (ak.real**2 + ak.imag**2)/dtype.type(fs*ws2)
+    psd[1:-1] *= 2
+    if nodc:
+        f = f[1:]
+        psd = psd[1:]
+    return f,psd
+
+@profiled()
+def compute_ps(chs,fs,nodc=True,dtype=None,size=None,workers=None):
+    '''
+    full-record power spectrum; size or workers switch to compute_full_ps
+    '''
+    if size is not None or workers is not None:
+        return compute_full_ps(chs,fs,nodc=nodc,size=size,workers=workers,dtype=dtype)
+    dtype = _work_dtype(chs,dtype)
+    # remove DC
+    chs = np.asarray(chs,dtype=dtype) - dtype.type(np.mean(chs,dtype=np.float64))
+    N = len(chs)
+    
+    # add window
+    ws = np.hamming(N)
+    ws1 = np.sum(ws)
+    ws2 = np.sum(ws**2)
+
+    # rfft
+    f = np.fft.rfftfreq(N,1./fs)
+    chs *= ws.astype(dtype)
+    ak = _rfft(chs)
+
+    # normalize into psd
+    ps = (ak.real**2 + ak.imag**2)/dtype.type(ws1**2)
+    ps[1:-1] *= 2
+    if nodc:
+        f = f[1:]
+        ps = ps[1:]
+    return f,ps
+
+@profiled()
+def compute_averaged_psd(chs,fs,Lbin:int,overlapratio:float=0.5,nodc=True,gaps=None,dtype=None):
+    '''
+    Welch-averaged psd; segments containing a gap (see load_gaps) are skipped.
+    Segment psds follow dtype (see compute_psd), the average accumulates in float64.
+    '''
+    dtype = _work_dtype(chs,dtype)
+    Nhop = int(Lbin*overlapratio)
+    N = len(chs)
+    nbins = (N-Lbin)//Nhop
+    
+    f = np.fft.rfftfreq(Lbin,1./fs)
+    nf = len(f)
+
+    # a gap at row g splits segment [start, start+Lbin) if start < g < start+Lbin
+    starts = np.arange(nbins)*Nhop
+    rows = gap_rows(gaps)
+    split = np.searchsorted(rows, starts+Lbin) - np.searchsorted(rows, starts, side='right')
+    starts = starts[split == 0]
+    if len(starts) < nbins:
+        print(f'skipped {nbins-len(starts)} of {nbins} segments across gaps')
+
+    acc = np.zeros(nf)
+
+    for binmin in starts:
+        binmax = binmin+Lbin
+        with stage('segment_fft'):
+            _,psd = compute_psd(chs[binmin:binmax],fs,nodc=False,dtype=dtype)
+            acc += psd
+
+    avg_psd = (acc/len(starts)).astype(dtype)
+    if nodc:
+        f = f[1:]
+        avg_psd = avg_psd[1:]
+    return f,avg_psd
+
+#################################################
+# Full-record spectra
+#################################################
+
+# threads of the full-record fft (scipy.fft workers), -1 uses all cores
+FFT_WORKERS = int(os.environ.get('MAGNETOFFT_FFT_WORKERS', -1))
+
+# samples per chunk when building a window without a float64 temporary of the full length
+_WINDOW_CHUNK = 1 << 20
+
+def set_fft_workers(workers):
+    '''
+    default thread count of compute_full_ps, -1 for all cores
+    '''
+    global FFT_WORKERS
+    FFT_WORKERS = int(workers)
+
+def fast_length(N,size='trim'):
+    '''
+    fft length for N samples: 'trim' largest fast length <= N, 'pad' smallest >= N,
+    None keeps N, an int is used as is
+    '''
+    import scipy.fft
+    if size is None:
+        return N
+    if size == 'pad':
+        return scipy.fft.next_fast_len(N,real=True)
+    if size == 'trim':
+        if hasattr(scipy.fft,'prev_fast_len'):
+            return scipy.fft.prev_fast_len(N,real=True)
+        n = N
+        while scipy.fft.next_fast_len(n,real=True) != n:
+            n -= 1
+        return n
+    return int(size)
+
+def full_hamming(N,dtype=np.float64):
+    '''
+    np.hamming(N) built chunkwise into one dtype array, with its sum and sum of squares;
+    not cached, a full-record window is as large as one axis and is freed with the caller's reference
+    '''
+    dtype = np.dtype(dtype)
+    w = np.empty(N,dtype=dtype)
+    ws1 = ws2 = 0.
+    for start in range(0,N,_WINDOW_CHUNK):
+        stop = min(start+_WINDOW_CHUNK,N)
+        c = np.arange(start,stop,dtype=np.float64)
+        c *= 2.*np.pi/max(N-1,1)
+        np.cos(c,out=c)
+        c *= -0.46
+        c += 0.54
+        ws1 += np.sum(c)
+        ws2 += np.dot(c,c)
+        w[start:stop] = c
+    if N == 1:
+        w[:] = 1.
+        ws1 = ws2 = 1.
+    return w,ws1,ws2
+
+@profiled()
+def compute_full_ps(data,fs,nodc=True,density=False,size=None,workers=None,dtype=None):
+    """
+    Single-transform PS (or PSD) of whole records with a multithreaded fft.
+
+    One working buffer, one hamming window and one scipy.fft plan are shared
+    by all axes. With size='trim' the last few samples are dropped so the
+    length only has small prime factors: bins get df = fs/Ntrim, marginally
+    coarser, and the dropped tail is not analysed. With size='pad' the
+    windowed record is zero-padded to the next fast length: bins are spaced
+    fs/Npad but the true resolution is still set by the N recorded samples
+    (neighbouring bins are correlated). Normalisation uses the window over
+    the N real samples, so line amplitudes (PS) and noise levels (PSD) match
+    the untrimmed, unpadded result.
+
+    Args:
+        data (numpy.ndarray or list): one axis (N,), axes in columns (N, naxes)
+            or a list of equal-length axes.
+        fs (float): sample rate in Hz.
+        nodc (bool): drop the DC bin.
+        density (bool): return the PSD [unit^2/Hz] instead of the PS [unit^2].
+        size (str or int): None, 'trim', 'pad' or an explicit fft length.
+        workers (int): fft threads, default FFT_WORKERS.
+        dtype: working precision, default float32 for float32 input else float64.
+
+    Returns:
+        tuple: (f, ps), ps has shape (nf,) for one axis and (naxes, nf) otherwise.
+    """
+    import scipy.fft
+    if isinstance(data,(list,tuple)):
+        axes = list(data)
+        single = False
+    else:
+        data = np.asarray(data)
+        single = data.ndim == 1
+        axes = [data] if single else [data[:,i] for i in range(data.shape[1])]
+    dtype = _work_dtype(axes[0],dtype)
+    workers = FFT_WORKERS if workers is None else workers
+
+    N = len(axes[0])
+    nfft = fast_length(N,size)
+    n = min(N,nfft)
+    w,ws1,ws2 = full_hamming(n,dtype)
+    norm = fs*ws2 if density else ws1**2
+
+    f = np.fft.rfftfreq(nfft,1./fs)
+    out = np.empty((len(axes),len(f)),dtype=dtype)
+    buf = np.zeros(nfft,dtype=dtype)
+    for i,chs in enumerate(axes):
+        with stage('axis',index=i):
+            seg = buf[:n]
+            seg[:] = chs[:n]
+            seg -= dtype.type(np.mean(chs[:n],dtype=np.float64))
+            seg *= w
+            buf[n:] = 0
+            ak = scipy.fft.rfft(buf,workers=workers)
+            np.multiply(ak.real,ak.real,out=out[i])
+            out[i] += ak.imag**2
+            del ak
+            out[i] /= dtype.type(norm)
+            out[i,1:] *= 2
+            if nfft % 2 == 0:
+                out[i,-1] /= 2
+    if nodc:
+        f = f[1:]
+        out = out[:,1:]
+    return f,(out[0] if single else out)
+
+#################################################
+# Log-frequency binning and reference curves
+#################################################
+
+# amplitude spectral density line drawn in the notebooks [μT/√Hz]
+REFERENCE_ASD = 0.1
+
+def enbw_bins(window):
+    '''
+    equivalent noise bandwidth of a window in fft bins, 1.363 for hamming
+    '''
+    window = np.asarray(window,dtype=np.float64)
+    return len(window)*np.sum(window**2)/np.sum(window)**2
+
+def log_bin_edges(fmin,fmax,per_decade=10):
+    '''
+    bin edges at integer multiples of 1/per_decade decade covering [fmin, fmax];
+    spectra binned with the same per_decade share edges
+    '''
+    k0 = int(np.floor(np.log10(fmin)*per_decade+1e-9))
+    k1 = int(np.ceil(np.log10(fmax)*per_decade-1e-9))
+    return 10.**(np.arange(k0,k1+1)/per_decade)
+
+def log_bin_spectrum(f,spec,per_decade=10,fmin=None,fmax=None,edges=None,enbw=None):
+    """
+    Average a linear-frequency spectrum into logarithmic frequency bins.
+
+    A PSD is a density, so the mean of the fft bins inside a log bin is the
+    band power divided by the band width. A PS (unit^2 per fft bin, e.g.
+    compute_ps) holds the window ENBW in every bin; pass enbw (in bins, see
+    enbw_bins) to turn it into a density first. Bins are [lo, hi), the last
+    one includes its upper edge, so fmax on a decade edge (e.g. Nyquist at
+    1 kHz) is kept. Log bins that contain no fft bin are dropped.
+
+    Args:
+        f (numpy.ndarray): ascending bin frequencies in Hz, DC excluded.
+        spec (numpy.ndarray): spectrum (nf,) or (..., nf).
+        per_decade (int): log bins per decade.
+        fmin, fmax (float): frequency range, default the range of f.
+        edges (numpy.ndarray): explicit bin edges, overrides the above.
+        enbw (float): ENBW in bins if spec is a PS.
+
+    Returns:
+        tuple: (fc, binned, counts), fc the geometric bin centres, binned
+        (..., nb) the averaged density, counts the fft bins per log bin.
+    """
+    f = np.asarray(f)
+    spec = np.asarray(spec,dtype=np.float64)
+    if enbw is not None:
+        spec = spec/(enbw*(f[1]-f[0]))
+    if edges is None:
+        fmin = f[f > 0][0] if fmin is None else fmin
+        fmax = f[-1] if fmax is None else fmax
+        edges = log_bin_edges(fmin,fmax,per_decade)
+    idx = np.searchsorted(f,edges)
+    idx[-1] = np.searchsorted(f,edges[-1],side='right')
+    counts = np.diff(idx)
+    keep = counts > 0
+    # reduceat sums f[idx[i]:idx[i+1]], evaluate it on the non-empty bins only
+    starts = idx[:-1][keep]
+    sums = np.add.reduceat(spec,np.minimum(starts,len(f)-1),axis=-1)
+    # the last start's sum runs to the end of f, cut it at its own edge
+    last = idx[1:][keep][-1]
+    if last < len(f):
+        sums[...,-1] -= np.sum(spec[...,last:],axis=-1)
+    counts = counts[keep]
+    fc = np.sqrt(edges[:-1]*edges[1:])[keep]
+    return fc,sums/counts,counts
+
+def reference_asd(f,reference=REFERENCE_ASD):
+    '''
+    reference asd on f: a constant, or a (fref, asdref) curve interpolated in
+    log-log; nan outside the curve
+    '''
+    f = np.asarray(f,dtype=np.float64)
+    if np.isscalar(reference):
+        return np.full(f.shape,float(reference))
+    fref,aref = (np.asarray(a,dtype=np.float64) for a in reference)
+    out = 10.**np.interp(np.log10(f),np.log10(fref),np.log10(aref),left=np.nan,right=np.nan)
+    return out
+
+def compare_to_reference(f,asd,reference=REFERENCE_ASD,bands=None):
+    """
+    Margins of many spectra against a reference curve or threshold per band.
+
+    Args:
+        f (numpy.ndarray): common frequency grid (nf,), e.g. log-binned.
+        asd (numpy.ndarray): amplitude spectral densities (..., nf), e.g.
+            (nruns, naxes, nf), in the units of the reference.
+        reference (float or tuple): threshold or (fref, asdref) curve.
+        bands (list[tuple]): (f_low, f_high) pairs, f_high exclusive; default
+            one per decade, the last one including f[-1] on a decade edge.
+
+    Returns:
+        dict: 'bands' (nbands, 2); 'margin' (..., nbands) worst-case
+        20*log10(reference/asd) in dB inside each band, nan where the band
+        holds no comparable bin; 'worst_f' frequency of that bin; 'pass'
+        margin >= 0.
+    """
+    f = np.asarray(f,dtype=np.float64)
+    asd = np.asarray(asd,dtype=np.float64)
+    default = bands is None
+    if default:
+        edges = log_bin_edges(f[0],f[-1],1)
+        bands = np.stack([edges[:-1],edges[1:]],axis=1)
+    bands = np.asarray(bands,dtype=np.float64).reshape(-1,2)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        margin = 20.*np.log10(reference_asd(f,reference)/asd)
+    inside = (f[None,:] >= bands[:,0:1]) & (f[None,:] < bands[:,1:2])
+    if default:
+        inside[-1] |= f == bands[-1,1]
+    masked = np.where(inside & ~np.isnan(margin[...,None,:]),margin[...,None,:],np.inf)
+    worst = np.argmin(masked,axis=-1)
+    band_margin = np.take_along_axis(masked,worst[...,None],axis=-1)[...,0]
+    band_margin[np.isinf(band_margin)] = np.nan
+    res = {}
+    res['bands'] = bands
+    res['margin'] = band_margin
+    res['worst_f'] = np.where(np.isnan(band_margin),np.nan,f[worst])
+    res['pass'] = band_margin >= 0
+    return res
+
+#################################################
+# Smoothing
+#################################################
+
+# edge modes as in scipy.ndimage -> np.pad modes; 'valid' returns only full windows
+_PAD_MODES = {'wrap':'wrap','reflect':'symmetric','mirror':'reflect','nearest':'edge','constant':'constant'}
+
+# kernel length up to which direct convolution beats overlap-add fft
+DIRECT_MAX = 64
+
+def _kernel_pads(W):
+    # centre of a length-W kernel as in scipy.ndimage (origin 0)
+    return W-1-W//2, W//2
+
+def _pad_axis0(data,left,right,mode):
+    if mode == 'valid':
+        return data
+    if mode not in _PAD_MODES:
+        raise ValueError(f"unknown edge mode {mode!r}")
+    pad = [(left,right)] + [(0,0)]*(data.ndim-1)
+    return np.pad(data,pad,mode=_PAD_MODES[mode])
+
+def _boxcar_sums(padded,W):
+    '''
+    sums of all length-W windows along axis 0 from one cumulative sum
+    '''
+    # cumulate deviations from the first sample to keep the float64 sums small
+    ref = padded[:1].astype(np.float64)
+    c = np.zeros((len(padded)+1,)+padded.shape[1:])
+    np.cumsum(padded-ref,axis=0,out=c[1:])
+    return c[W:]-c[:-W]+W*ref
+
+def _fir_valid(padded,w,method):
+    if method == 'boxcar':
+        return _boxcar_sums(padded,len(w))*w[0]
+    if method == 'direct' and padded.ndim == 1:
+        return np.convolve(padded,w,mode='valid')
+    from scipy.signal import oaconvolve
+    return oaconvolve(padded,w.reshape((-1,)+(1,)*(padded.ndim-1)),mode='valid',axes=0)
+
+def _exp_coeffs(width):
+    # single pole with the centre of mass of a width-sample boxcar
+    alpha = 2./(width+1.)
+    return np.array([alpha]),np.array([1.,alpha-1.])
+
+def _smoothing_kernel(width,window,method):
+    if window is None:
+        w = np.full(int(width),1./int(width))
+    else:
+        w = np.asarray(window,dtype=np.float64)
+    if method == 'auto':
+        if np.all(w == w[0]):
+            method = 'boxcar'
+        else:
+            method = 'direct' if len(w) <= DIRECT_MAX else 'fft'
+    if method == 'boxcar' and not np.all(w == w[0]):
+        raise ValueError('boxcar needs a uniform window')
+    return w,method
+
+def smooth(data,width=None,window=None,method='auto',mode='nearest',axis=0):
+    """
+    Moving-window smoothing with the cheapest algorithm for the window.
+
+    'boxcar' (uniform windows, one cumulative sum, O(N) for any width),
+    'direct' (np.convolve, short kernels), 'fft' (overlap-add convolution,
+    O(N log W) for long arbitrary kernels) or 'exponential' (single-pole
+    recursive filter of about the same width run forward and backward, zero
+    phase). 'auto' picks boxcar for uniform windows, otherwise direct or fft
+    by kernel length. The kernel is centred as in scipy.ndimage.convolve.
+
+    Args:
+        data (numpy.ndarray): samples, smoothed along axis.
+        width (int): boxcar/exponential width in samples.
+        window (numpy.ndarray): explicit kernel, overrides width.
+        method (str): 'auto', 'boxcar', 'direct', 'fft' or 'exponential'.
+        mode (str): edge handling 'nearest', 'reflect', 'mirror', 'constant'
+            (zeros) or 'wrap' (periodic record) as in scipy.ndimage, or
+            'valid' to return only full windows.
+        axis (int): time axis.
+
+    Returns:
+        numpy.ndarray: smoothed data, same shape unless mode='valid'.
+    """
+    data = np.moveaxis(np.asarray(data),axis,0)
+    if method == 'exponential':
+        from scipy.signal import filtfilt
+        padtype = {'nearest':'constant','reflect':'even','mirror':'even'}.get(mode)
+        if padtype is None:
+            raise ValueError("exponential smoothing supports mode 'nearest', 'reflect' or 'mirror'")
+        b,a = _exp_coeffs(width)
+        out = filtfilt(b,a,data,axis=0,padtype=padtype,padlen=min(3*int(width),len(data)-1))
+        return np.moveaxis(out,0,axis)
+    w,method = _smoothing_kernel(width,window,method)
+    left,right = _kernel_pads(len(w))
+    out = _fir_valid(_pad_axis0(data,left,right,mode),w,method)
+    return np.moveaxis(out,0,axis)
+
+def smooth_widths(data,widths,mode='nearest'):
+    '''
+    boxcar averages of several widths from one cumulative sum, shape (len(widths),)+data.shape;
+    mode='valid' keeps the N-max(widths)+1 samples where the widest window is full,
+    all widths centred on the same samples
+    '''
+    data = np.asarray(data)
+    pads = [_kernel_pads(int(W)) for W in widths]
+    lmax = max(l for l,_ in pads)
+    rmax = max(r for _,r in pads)
+    padded = _pad_axis0(data,lmax,rmax,mode)
+    ref = padded[:1].astype(np.float64)
+    c = np.zeros((len(padded)+1,)+padded.shape[1:])
+    np.cumsum(padded-ref,axis=0,out=c[1:])
+    N = len(data) if mode != 'valid' else max(len(data)-lmax-rmax,0)
+    out = np.empty((len(widths),N)+data.shape[1:])
+    for k,(W,(l,_)) in enumerate(zip(widths,pads)):
+        s = lmax-l
+        out[k] = (c[s+W:s+W+N]-c[s:s+N])/W+ref
+    return out
+
+class StreamingSmoother:
+    """
+    Block-by-block smoothing along axis 0 with carried state.
+
+    FIR methods (boxcar, direct, fft) return each output once the samples
+    right of it have arrived, i.e. delayed by about half the window; flush()
+    returns the rest using the edge mode at the end. The concatenated
+    outputs equal smooth() of the whole record for the same mode ('wrap'
+    needs the whole record and is not available). 'exponential' is causal
+    here: one forward pass, no delay, started at the first sample.
+    """
+
+    def __init__(self,width=None,window=None,method='auto',mode='nearest'):
+        if mode in ('wrap','valid'):
+            raise ValueError(f"mode {mode!r} is not available when streaming")
+        self.mode = mode
+        self.method = method
+        self._zi = None
+        if method == 'exponential':
+            self.b,self.a = _exp_coeffs(width)
+        else:
+            self.w,self.method = _smoothing_kernel(width,window,method)
+            self.left,self.right = _kernel_pads(len(self.w))
+        self._buf = None
+        self._started = False
+
+    def update(self,block):
+        block = np.asarray(block)
+        if self.method == 'exponential':
+            from scipy.signal import lfilter, lfilter_zi
+            if self._zi is None:
+                zi = lfilter_zi(self.b,self.a)
+                self._zi = zi.reshape((-1,)+(1,)*(block.ndim-1))*block[:1].astype(np.float64)
+            out,self._zi = lfilter(self.b,self.a,block,axis=0,zi=self._zi)
+            return out
+        data = block if self._buf is None else np.concatenate([self._buf,block])
+        if not self._started:
+            # reflecting edges need more samples than the left pad
+            if len(data) <= self.left or len(data) < len(self.w):
+                self._buf = data
+                return data[:0].astype(np.float64)
+            data = _pad_axis0(data,self.left,0,self.mode)
+            self._started = True
+        out = _fir_valid(data,self.w,self.method)
+        self._buf = data[len(out):]
+        return out
+
+    def flush(self):
+        if self.method == 'exponential' or self._buf is None:
+            return np.zeros(0)
+        if not self._started:
+            out = smooth(self._buf,window=self.w,method=self.method,mode=self.mode)
+        else:
+            out = _fir_valid(_pad_axis0(self._buf,0,self.right,self.mode),self.w,self.method)
+        self._buf = None
+        self._started = False
+        return out
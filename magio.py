@@ -0,0 +1,148 @@
+"""
+Readers for magnetometer data files. h5py is needed for hdf5 files, polars
+is imported only by load_csv_pl.
+"""
+import os
+import time
+import numpy as np
+import h5py
+from magcore import calibrate_data, VOLT_TO_UT
+from profiling import stage, profiled, add_bytes
+from blockreader import BlockReader, stored_rows, PREFETCH
+
+TIME_FORMAT = "%Y_%m_%d_%H_%M"      # start_time / localtime strings of the writers
+
+# 'gaps' table of a part, one row per scan restart after an overrun (see the
+# resilient scan). The gap sits between stored rows row-1 and row;
+# start_sample/end_sample give the lost stretch on the uninterrupted sample
+# clock of the part (end_sample - start_sample lost). vds.GAP_DTYPE is the
+# run-level table of the master file.
+PART_GAP_DTYPE = np.dtype([
+    ('row', 'i8'),
+    ('start_sample', 'i8'),
+    ('end_sample', 'i8'),
+    ('t_start', 'f8'),       # unix time of the first lost sample
+    ('t_end', 'f8'),         # unix time the scan restarted
+    ('cause', 'S16'),
+])
+
+#################################################
+# Loading data
+#################################################
+
+@profiled()
+def load_hdf5(pathh5,dtype=np.float64):
+    '''
+    load hdf5 and extract metadata, convert into magnetic field value in μT,
+    dtype=np.float32 for the single precision analysis path
+    '''
+    f = h5py.File(pathh5,'r')
+    data = f['voltage']
+    dset = {}
+    
+    dset['sample_rate'] = data.attrs['sample_rate']
+    dset['measure_time'] = data.attrs['measure_time']
+    dset['end_time'] = data.attrs['end_time']
+    dset['gaps'] = f['gaps'][:] if 'gaps' in f else None
+    
+    with stage('read'):
+        data = data[:stored_rows(data)]
+        add_bytes(data.nbytes)
+    data = calibrate_data(data,dtype)
+    data *= VOLT_TO_UT
+    
+
+    if data.ndim == 1 or data.shape[1] == 1:
+        # Single-channel case
+        dset['x'] = data.flatten()
+    else:
+        # Multi-channel case, assuming channel order 0, 1, 4 -> x, z, y
+        dset['x'] = data[:, 0]
+        dset['y'] = data[:, 2]
+        dset['z'] = data[:, 1]   
+
+    return dset
+
+def iter_hdf5_blocks(pathh5, blocksize=65536, columns=None, align=False, prefetch=PREFETCH):
+    '''
+    iterate over the raw uint16 codes of a hdf5 part in blocks of rows,
+    yields (start_row, block) without loading the whole file; the next block
+    is read in the background (blockreader.BlockReader), align=True rounds
+    blocks to whole chunks for consumers that take any block size
+    '''
+    for start, block in BlockReader(pathh5, blocksize, columns, prefetch, align):
+        add_bytes(block.nbytes)
+        yield start, block
+
+def load_gaps(pathh5):
+    '''
+    gap table of a part or run master written by the resilient scan, empty if none
+    '''
+    with h5py.File(pathh5, 'r', swmr=True) as f:
+        if 'gaps' not in f:
+            return np.zeros(0, dtype=[('row', 'i8')])
+        return f['gaps'][:]
+
+def part_start_unix(attrs):
+    '''
+    (unix time of the first sample, source): exact with the supervisor run
+    clock (time_base + part_start), else the minute of start_time
+    '''
+    if 'time_base' in attrs and 'part_start' in attrs:
+        return float(attrs['time_base']) + float(attrs['part_start']), 'time_base'
+    start = attrs['start_time']
+    if isinstance(start, bytes):
+        start = start.decode()
+    return time.mktime(time.strptime(start, TIME_FORMAT)), 'start_time'
+
+@profiled()
+def load_csv_pl(pathcsv,dtype=np.float64):
+    import polars as pl
+    add_bytes(os.path.getsize(pathcsv))
+    df = pl.read_csv(pathcsv)
+    data = df.to_numpy()
+    data = calibrate_data(data,dtype)
+    data *= VOLT_TO_UT
+
+    dset = {}
+
+    if data.ndim == 1 or data.shape[1] == 1:
+        # Single-channel case
+        dset['x'] = data.flatten()
+    else:
+        # Multi-channel case, assuming channel order 0, 1, 4 -> x, z, y
+        dset['x'] = data[:, 0]
+        dset['y'] = data[:, 2]
+        dset['z'] = data[:, 1]
+
+    return dset
+
+@profiled()
+def load_csv(pathcsv,dtype=np.float64):
+    '''
+    load csv magnetometer result and convert into magnetic field value in μT
+    '''
+    add_bytes(os.path.getsize(pathcsv))
+    data = np.genfromtxt(pathcsv,delimiter=',')
+    data = calibrate_data(data,dtype)
+    data *= VOLT_TO_UT
+    dset = {}
+    if data.ndim == 1 or data.shape[1] == 1:
+        # Single-channel case
+        dset['x'] = data.flatten()
+    else:
+        # Multi-channel case, assuming channel order 0, 1, 4 -> x, z, y
+        dset['x'] = data[:, 0]
+        dset['y'] = data[:, 2]
+        dset['z'] = data[:, 1]
+    
+    return dset
+
+def load_reference_curve(pathcsv='pixelized_PSD_bamp.csv'):
+    '''
+    reference curve csv of (frequency [Hz], asd [μT/√Hz]) rows, returns (f, asd)
+    for compare_to_reference
+    '''
+    ref = np.loadtxt(pathcsv,delimiter=',',ndmin=2)
+    order = np.argsort(ref[:,0])
+    return ref[order,0],ref[order,1]
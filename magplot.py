@@ -0,0 +1,169 @@
+"""
+Plotting routines for PS and PSD. Importing this module sets the
+matplotlib font size used by all figures.
+
+Spectra and timeseries are decimated to a few points per output pixel
+(min/max envelope per pixel column, on log frequency or linear time) before
+they reach matplotlib; pass decimate=None to plot every point.
+"""
+import numpy as np
+import matplotlib.pyplot as plt
+from magcore import compute_full_ps, compute_averaged_psd, log_bin_spectrum, reference_asd, REFERENCE_ASD
+from magio import load_hdf5, load_csv_pl
+from profiling import stage, profiled
+
+plt.rcParams.update({'font.size': 14})
+
+# pixel columns the decimated curves are reduced to, 8 in at dpi=200 is 1600 px
+PLOT_COLUMNS = 2000
+
+#################################################
+# Decimation
+#################################################
+
+@profiled()
+def decimate_minmax(x,y,ncols=PLOT_COLUMNS,log=False,dense=4):
+    '''
+    keep the min and max of y in each of ncols equal columns of x (log10 x if log);
+    columns with at most dense points keep all of them, x must be ascending;
+    NaN are skipped by min/max, the first NaN of a column is kept so lines still break there
+    '''
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if log:
+        pos = x > 0
+        x,y = x[pos],y[pos]
+    n = len(x)
+    if ncols is None or n <= 2*ncols:
+        return x,y
+    u = np.log10(x) if log else x
+    edges = np.linspace(u[0],u[-1],ncols+1)
+    starts = np.searchsorted(u,edges[:-1])
+    counts = np.diff(np.append(starts,n))
+    nonempty = counts > 0
+    starts,counts = starts[nonempty],counts[nonempty]
+    col = np.repeat(np.arange(len(starts)),counts)
+
+    keep = np.zeros(n,dtype=bool)
+    sparse = counts <= dense
+    keep[sparse[col]] = True
+    # first position of the column min and max, and of its first NaN
+    for hit in (y == np.fmin.reduceat(y,starts)[col],y == np.fmax.reduceat(y,starts)[col],np.isnan(y)):
+        hit = np.flatnonzero(hit)
+        _,first = np.unique(col[hit],return_index=True)
+        keep[hit[first]] = True
+    return x[keep],y[keep]
+
+#################################################
+# PLotting
+#################################################
+
+@profiled()
+def plot_sample_ps(path,fs=1000.,ax=None,label=None,orientation=['x','y','z'],alpha=0.6,dtype=np.float64,
+                   size=None,workers=None,decimate=PLOT_COLUMNS):
+    '''
+    full-record PS of each axis, size/workers as in compute_full_ps
+    '''
+    
+    if path.endswith('.hdf5'):
+        print('->loading hdf5...',end='\r')
+        dset = load_hdf5(path,dtype)
+    if path.endswith('.csv'):
+        print('->loading csv ...',end='\r')
+        dset = load_csv_pl(path,dtype)
+    print('->load complete   ',end='\r')
+
+    if ax is None:
+        fig,ax = plt.subplots(figsize = (8,6))
+        ax.set_xlabel('f[Hz]')
+        ax.set_ylabel('FFT Amplitude[$\mu T$]')
+    else:
+        fig=None
+        
+    print('->computing spectra   ',end='\r')
+    f,ps = compute_full_ps([dset[vec] for vec in orientation],fs,size=size,workers=workers)
+    for vec,ps_vec in zip(orientation,ps):
+        print('->plotting direction '+vec,end='\r')
+        with stage('axis',axis=vec):
+            ax.loglog(*decimate_minmax(f,np.sqrt(ps_vec),decimate,log=True),label=label+vec,alpha=alpha)
+        
+    print('plot complete '+path[-20:-4]+'.')
+    return fig,ax
+
+@profiled()
+def plot_sample_psd(path,fs=1000.,ax=None,label=None,orientation=['x','y','z'],Lbin=None,overlap=0.5,alpha=0.6,dtype=np.float64,
+                    per_decade=None,decimate=PLOT_COLUMNS):
+    '''
+    averaged LSD of each axis, per_decade rebins it on log frequency before plotting
+    '''
+    print('plot sample '+path+':')
+    
+    if path.endswith('.hdf5'):
+        print('->loading hdf5...',end='\r')
+        dset = load_hdf5(path,dtype)
+    if path.endswith('.csv'):
+        print('->loading csv ...',end='\r')
+        dset = load_csv_pl(path,dtype)
+    print('->load complete   ',end='\r')
+
+    if Lbin is None:
+        print('! Warning, no Lbin, taken default')
+        N = len(dset['x'])
+        Lbin = N//20
+    
+    if ax is None:
+        fig,ax = plt.subplots(figsize = (8,6))
+        ax.set_xlabel('f[Hz]')
+        ax.set_ylabel('LSD[$\mu T/ \sqrt{Hz}$]')
+    else:
+        fig=None
+    
+    for vec in orientation:
+        print('->plotting direction '+vec,end='\r')
+        with stage('axis',axis=vec):
+            data = dset[vec]
+            f,ps = compute_averaged_psd(data,fs,Lbin,overlap,gaps=dset.get('gaps'))
+            if per_decade:
+                f,ps,_ = log_bin_spectrum(f,ps,per_decade)
+            ax.loglog(*decimate_minmax(f,np.sqrt(ps),decimate,log=True),label=vec,alpha=alpha)
+        
+    print('plot complete '+path+'.')
+    return fig,ax
+
+@profiled()
+def plot_sample_timeseries(path,ax=None,orientation=['x','y','z'],alpha=0.6,dtype=np.float64,
+                           decimate=PLOT_COLUMNS):
+    '''
+    calibrated field of each axis against time, min/max decimated per pixel column
+    '''
+    if path.endswith('.hdf5'):
+        dset = load_hdf5(path,dtype)
+    if path.endswith('.csv'):
+        dset = load_csv_pl(path,dtype)
+    fs = float(dset.get('sample_rate',1000.))
+    t = np.arange(len(dset['x']))/fs
+
+    if ax is None:
+        fig,ax = plt.subplots(figsize = (8,6))
+        ax.set_xlabel('t[s]')
+        ax.set_ylabel(r'B[$\mu T$]')
+    else:
+        fig=None
+
+    for vec in orientation:
+        ax.plot(*decimate_minmax(t,dset[vec],decimate),label=vec,alpha=alpha)
+    return fig,ax
+
+def plot_reference(ax,reference=REFERENCE_ASD,fmin=1e-2,fmax=5e2,label=None,**kwargs):
+    '''
+    draw a threshold (default 100 nT/√Hz) or a (f, asd) reference curve on an LSD plot
+    '''
+    if np.isscalar(reference):
+        f = np.array([fmin,fmax])
+        label = label or f'{reference*1e3:g}' + r'$nT/\sqrt{Hz}$'
+    else:
+        f = np.asarray(reference[0])
+    kwargs.setdefault('linestyle','--')
+    kwargs.setdefault('c','r')
+    ax.loglog(f,reference_asd(f,reference),label=label,**kwargs)
+    return ax
@@ -0,0 +1,212 @@
+"""
+Live acquisition metrics.
+
+`AcquisitionMetrics` is updated from the acquisition loop with a handful of
+integer/float operations per read, so it can stay on in the hot path. The
+values are published, off the hot path, either by a small Prometheus-style
+HTTP endpoint (`serve_metrics`) or by a thread appending snapshots to a
+rolling JSON-lines file (`MetricsFileWriter`).
+
+The backlog histogram (samples per channel available at each read) compared
+with `scan_buffer_samples` shows how close the scan is to a buffer overrun.
+"""
+import os
+import json
+import time
+import shutil
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = 'magnetometer'
+
+# histogram bucket upper bounds
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+PERIOD_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0)
+BACKLOG_BUCKETS = (10, 100, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000)
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram in the Prometheus sense.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        cumulative, total = [], 0
+        for c in self.counts:
+            total += c
+            cumulative.append(total)
+        return {'buckets': list(self.buckets), 'cumulative': cumulative,
+                'sum': self.sum, 'count': self.count}
+
+
+class AcquisitionMetrics:
+    """
+    Counters, gauges and histograms of one acquisition run.
+
+    Args:
+        savedir (str): output directory, its file system is reported as free disk.
+    """
+
+    def __init__(self, savedir='.'):
+        self.savedir = savedir
+        self.start = time.time()
+        self.samples_acquired = 0
+        self.reads = 0
+        self.bytes_written = 0
+        self.hardware_overruns = 0
+        self.buffer_overruns = 0
+        self.current_part = 0
+        self.scan_buffer_samples = 0
+        self.last_backlog = 0
+        self.read_backlog = Histogram(BACKLOG_BUCKETS)
+        self.read_period = Histogram(PERIOD_BUCKETS)
+        self.flush_seconds = Histogram(LATENCY_BUCKETS)
+        self.fsync_seconds = Histogram(LATENCY_BUCKETS)
+        self._last_read = None
+
+    def observe_read(self, samples_per_channel, backlog=None):
+        '''
+        call once per a_in_scan_read with the number of samples per channel
+        returned, backlog defaults to it (READ_ALL_AVAILABLE reads)
+        '''
+        if backlog is None:
+            backlog = samples_per_channel
+        now = time.perf_counter()
+        if self._last_read is not None:
+            self.read_period.observe(now - self._last_read)
+        self._last_read = now
+        self.reads += 1
+        self.samples_acquired += samples_per_channel
+        self.last_backlog = backlog
+        self.read_backlog.observe(backlog)
+
+    def observe_write(self, nbytes, flush_seconds, fsync_seconds=None):
+        self.bytes_written += nbytes
+        self.flush_seconds.observe(flush_seconds)
+        if fsync_seconds is not None:
+            self.fsync_seconds.observe(fsync_seconds)
+
+    def observe_overrun(self, hardware=False, buffer=False):
+        self.hardware_overruns += int(hardware)
+        self.buffer_overruns += int(buffer)
+
+    def disk_free(self):
+        try:
+            return shutil.disk_usage(self.savedir).free
+        except OSError:
+            return -1
+
+    def snapshot(self):
+        '''
+        all values as a plain dict, evaluated when called (not in the acquisition loop)
+        '''
+        return {
+            'time': time.time(),
+            'uptime_seconds': time.time() - self.start,
+            'samples_acquired_total': self.samples_acquired,
+            'reads_total': self.reads,
+            'bytes_written_total': self.bytes_written,
+            'hardware_overruns_total': self.hardware_overruns,
+            'buffer_overruns_total': self.buffer_overruns,
+            'current_part': self.current_part,
+            'scan_buffer_samples': self.scan_buffer_samples,
+            'read_backlog_last_samples': self.last_backlog,
+            'disk_free_bytes': self.disk_free(),
+            'read_backlog_samples': self.read_backlog.snapshot(),
+            'read_period_seconds': self.read_period.snapshot(),
+            'flush_seconds': self.flush_seconds.snapshot(),
+            'fsync_seconds': self.fsync_seconds.snapshot(),
+        }
+
+    def render(self):
+        '''
+        Prometheus text exposition format
+        '''
+        lines = []
+        for key, value in self.snapshot().items():
+            name = f"{PREFIX}_{key}"
+            if isinstance(value, dict):
+                lines.append(f"# TYPE {name} histogram")
+                for le, c in zip(value['buckets'], value['cumulative']):
+                    lines.append(f'{name}_bucket{{le="{le}"}} {c}')
+                lines.append(f'{name}_bucket{{le="+Inf"}} {value["cumulative"][-1]}')
+                lines.append(f"{name}_sum {value['sum']}")
+                lines.append(f"{name}_count {value['count']}")
+            else:
+                kind = 'counter' if key.endswith('_total') else 'gauge'
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(metrics, port, host='127.0.0.1'):
+    """
+    Serve metrics.render() at http://host:port/metrics from a daemon thread.
+
+    Returns:
+        ThreadingHTTPServer: call shutdown() to stop.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') not in ('', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+    print(f"Metrics at http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+class MetricsFileWriter(threading.Thread):
+    """
+    Appends a JSON snapshot to `path` every `interval` seconds. The file is
+    rotated to `path + '.1'` when it exceeds `max_bytes`.
+    """
+
+    def __init__(self, metrics, path, interval=10.0, max_bytes=10 * 1024 * 1024):
+        super().__init__(name='metrics-file', daemon=True)
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.write()
+
+    def write(self):
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, self.path + '.1')
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(self.metrics.snapshot()) + '\n')
+        except OSError as e:
+            print(f"Warning: metrics file write failed: {e}")
+
+    def stop(self):
+        self._stop_event.set()
+        self.write()
@@ -1,11 +1,11 @@
-import adafruit_bme680
 import time
-import board
 import argparse
 import os
 import csv
 import subprocess
 
+HEADER = ['localtime', 'extvolt(V)', 'cputemp(C)', 'envtemperature(C)', 'envhumidity(%)', 'envpressure(hPa)']
+
 def read_voltage(channel="EXT5V_V"):
     try:
         output = subprocess.check_output(['vcgencmd', 'pmic_read_adc', channel], encoding='utf-8')
@@ -24,6 +24,47 @@ def read_cpu_temperature():
         return None
 
 
+def open_env_sensor(sea_level_pressure=1013.25):
+    '''
+    BME680 on the board's default I2C bus
+    '''
+    import adafruit_bme680
+    import board
+    # Create sensor object, communicating over the board's default I2C bus
+    i2c = board.I2C()   # uses board.SCL and board.SDA
+    bme680 = adafruit_bme680.Adafruit_BME680_I2C(i2c)
+
+    # change this to match the location's pressure (hPa) at sea level
+    bme680.sea_level_pressure = sea_level_pressure
+    return bme680
+
+
+def read_health(bme680=None):
+    '''
+    one log row in HEADER order, environment values are None without a sensor
+    '''
+    timestamp_str = time.strftime("%Y_%m_%d_%H_%M", time.localtime())
+    extvolt = read_voltage()
+    cputemp = read_cpu_temperature()
+    if bme680 is None:
+        temperature = humidity = pressure = None
+    else:
+        temperature = bme680.temperature
+        humidity = bme680.relative_humidity
+        pressure = bme680.pressure
+    return [timestamp_str, extvolt, cputemp, temperature, humidity, pressure]
+
+
+def health_log_path(savedir):
+    file_path = savedir + 'logs/'
+    
+    if not os.path.exists(file_path):
+        os.makedirs(file_path)
+    
+    timestamp_str = time.strftime("%Y_%m_%d_%H_%M", time.localtime())
+    return file_path+f"monitorpi_{timestamp_str}.csv"
+
+
 def main():
     parser = argparse.ArgumentParser(
                         prog='Raspberry-pi self health recorder',
@@ -35,13 +76,7 @@ def main():
     parser.add_argument('-s', '--scanrate', help='scan rate (S/min), default 1S/min',type=float,default=1)
     
     args = parser.parse_args()
-    file_path = args.savedir + 'logs/'
-    
-    if not os.path.exists(file_path):
-        os.makedirs(file_path)
-    
-    timestamp_str = time.strftime("%Y_%m_%d_%H_%M", time.localtime())
-    filename = file_path+f"monitorpi_{timestamp_str}.csv"
+    filename = health_log_path(args.savedir)
     
     interval = 60.0/args.scanrate
     t_measure = args.time
@@ -52,31 +87,19 @@ def main():
     else:
         print('Scan time = {}s, start scanning...'.format(t_measure))
     
-    # Create sensor object, communicating over the board's default I2C bus
-    i2c = board.I2C()   # uses board.SCL and board.SDA
-    bme680 = adafruit_bme680.Adafruit_BME680_I2C(i2c)
-    
-    # change this to match the location's pressure (hPa) at sea level
-    bme680.sea_level_pressure = 1013.25
+    bme680 = open_env_sensor()
     
     time_start = time.time()
     
     try:
         with open(filename, mode='w', newline='') as csvfile:
             writer = csv.writer(csvfile)
-            writer.writerow(['localtime', 'extvolt(V)', 'cputemp(C)', 'envtemperature(C)', 'envhumidity(%)', 'envpressure(hPa)'])
+            writer.writerow(HEADER)
             while True:
                 if t_measure is not None and (time.time() - time_start) >= t_measure:
                     break
     
-                timestamp_str = time.strftime("%Y_%m_%d_%H_%M", time.localtime())
-                extvolt = read_voltage()
-                cputemp = read_cpu_temperature()
-                temperature = bme680.temperature
-                humidity = bme680.relative_humidity
-                pressure = bme680.pressure
-    
-                writer.writerow([timestamp_str, extvolt, cputemp, temperature, humidity, pressure])
+                writer.writerow(read_health(bme680))
                 csvfile.flush()
                 time.sleep(interval)
     
@@ -86,4 +109,4 @@ def main():
     print('data saved to'+ filename)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Concurrent acquisition from several stacked MCC 128 HATs into one run.
+
+Every listed address is opened without prompting and scanned at the same
+time, each board drained by its own thread. The main thread writes all
+devices into the same hourly part files, one group per device:
+
+    /hat<addr>/voltage   raw uint16 codes, same attributes as the single-HAT parts
+    /hat<addr>/timeref   (sample_count, t) pairs, t in seconds of the shared
+                         monotonic clock since run start, one row per read
+
+The run start (`t0_wall`) and each device's scan start (`scan_start`) are
+stored as attributes so the devices can be aligned in time afterwards.
+"""
+import os
+import time
+import queue
+import argparse
+import threading
+import h5py
+import numpy as np
+
+try:
+    from daqhats import mcc128, OptionFlags, HatIDs, HatError, AnalogInputMode, AnalogInputRange, \
+        TriggerModes
+    from daqhats_utils import select_hat_devices, chan_list_to_mask
+except ImportError:
+    # no daqhats library, only simulated devices are available
+    mcc128 = None
+    from simhat import OptionFlags, HatIDs, HatError, AnalogInputMode, AnalogInputRange, \
+        TriggerModes, chan_list_to_mask
+from simhat import SimulatedHat
+from hatread import ScanBuffer, read_numpy, READ_ALL_AVAILABLE
+from recover_parts import writer_lock
+from partwriter import CHUNK_DURATION, DEFAULT_CHUNKSIZE, safe_fsync, register_signal_handlers, \
+    create_voltage, stamp_end_time
+
+# Constants
+REPORT_INTERVAL = 60.0   # seconds between stats printouts
+IDLE_SLEEP = 0.01        # seconds to wait when a read returned nothing
+
+_STOP = threading.Event()
+
+
+def on_exit(signum, frame):
+    """
+    Signal handler: ask the drain threads and the writer to stop, the
+    writer then flushes everything and closes the current part.
+    """
+    print(f"Received signal {signum}, stopping acquisition...")
+    _STOP.set()
+
+
+class HatDrain(threading.Thread):
+    """
+    Reads one HAT scan buffer on its own thread and queues the blocks.
+
+    Queue items are (address, sample_count, t, block) with sample_count the
+    number of samples per channel read so far including this block, t the
+    shared-clock time of the read and block a (rows, nch) uint16 array.
+    """
+
+    def __init__(self, address, hat, num_channels, out, t0, timeout=5.0):
+        super().__init__(name=f"hat{address}", daemon=True)
+        self.address = address
+        self.hat = hat
+        self.num_channels = num_channels
+        self.out = out
+        self.t0 = t0
+        self.timeout = timeout
+
+        self.samples = 0
+        self.reads = 0
+        self.max_backlog = 0
+        self.last_read = None
+        self.hardware_overrun = False
+        self.buffer_overrun = False
+        self.error = None
+
+    def run(self):
+        try:
+            while not _STOP.is_set():
+                result = read_numpy(self.hat, READ_ALL_AVAILABLE, self.timeout)
+                now = time.monotonic() - self.t0
+                if result.hardware_overrun:
+                    print(f"\nHAT {self.address}: Hardware overrun!")
+                    self.hardware_overrun = True
+                    break
+                if result.buffer_overrun:
+                    print(f"\nHAT {self.address}: Buffer overrun!")
+                    self.buffer_overrun = True
+                    break
+
+                rows = len(result.data) // self.num_channels
+                if rows == 0:
+                    time.sleep(IDLE_SLEEP)
+                    continue
+                # one cast per read, the block is handed over to the writer thread
+                block = result.data[:rows * self.num_channels].astype(np.uint16)
+                block = block.reshape((rows, self.num_channels))
+
+                self.samples += rows
+                self.reads += 1
+                self.max_backlog = max(self.max_backlog, rows)
+                self.last_read = now
+                self.out.put((self.address, self.samples, now, block))
+        except (HatError, ValueError) as err:
+            print(f"\nHAT {self.address}: error during acquisition: {err}")
+            self.error = str(err)
+        finally:
+            # one failing board ends the run for all of them
+            _STOP.set()
+
+    def throughput(self):
+        '''
+        samples per channel per second since run start
+        '''
+        if not self.last_read:
+            return 0.0
+        return self.samples / self.last_read
+
+    def stats(self):
+        return {
+            'samples': self.samples,
+            'reads': self.reads,
+            'throughput': self.throughput(),
+            'max_backlog': self.max_backlog,
+            'hardware_overrun': self.hardware_overrun,
+            'buffer_overrun': self.buffer_overrun,
+            'error': self.error or '',
+        }
+
+
+def open_hats(addresses, simulate=False):
+    """
+    Open the listed HAT addresses without prompting.
+
+    Args:
+        addresses (list[int]): board addresses, all found boards if None.
+        simulate (bool): use simhat.SimulatedHat instead of hardware.
+
+    Returns:
+        dict: address -> device object.
+    """
+    if simulate:
+        return {a: SimulatedHat(a) for a in (addresses or [0])}
+    if mcc128 is None:
+        raise HatError(0, 'Error: daqhats library not installed, use --simulate')
+    addresses = select_hat_devices(HatIDs.MCC_128, addresses)
+    return {a: mcc128(a) for a in addresses}
+
+
+def multi_hat_scan(addresses, channels, scan_rate, total_time, savedir, prefix,
+                   chunksize=DEFAULT_CHUNKSIZE, simulate=False, exttrigger=False, hats=None):
+    """
+    Scan several HATs concurrently with hourly part rotation.
+
+    Args:
+        addresses (list[int]): HAT addresses, all found boards if None.
+        channels (list[int]): channel indices, same on every board.
+        scan_rate (float): samples per second per channel.
+        total_time (float): total run time in seconds.
+        savedir (str): output directory.
+        prefix (str): filename prefix (e.g. 'mag_2025_07_16_12_00').
+        chunksize (int): rows per hdf5 chunk and per write.
+        simulate (bool): use simulated devices.
+        exttrigger (bool): start all scans on the rising edge of the shared
+            TRIG input instead of one after another.
+        hats (dict): address -> already opened device, used instead of
+            opening addresses (e.g. simhat.SimulatedHat with injected overruns,
+            see benchmarks/check_multihat.py).
+
+    Returns:
+        dict: address -> stats dict of the device.
+    """
+    os.makedirs(savedir, exist_ok=True)
+    # keeps recover_parts.py away from the parts while they are written
+    lock = writer_lock(savedir)
+    channel_mask = chan_list_to_mask(channels)
+    num_channels = len(channels)
+    options = OptionFlags.CONTINUOUS | OptionFlags.NOCALIBRATEDATA | OptionFlags.NOSCALEDATA
+    if exttrigger:
+        options |= OptionFlags.EXTTRIGGER
+
+    register_signal_handlers(on_exit)
+    _STOP.clear()
+
+    if hats is None:
+        hats = open_hats(addresses, simulate)
+    addresses = list(hats)
+    for address, hat in hats.items():
+        hat.a_in_mode_write(AnalogInputMode.SE)
+        hat.a_in_range_write(AnalogInputRange.BIP_10V)
+        if exttrigger:
+            hat.trigger_mode(TriggerModes.RISING_EDGE)
+        actual_rate = hat.a_in_scan_actual_rate(num_channels, scan_rate)
+        print(f"HAT {address}: using actual scan rate {actual_rate} Hz")
+
+    t0_wall = time.time()
+    t0 = time.monotonic()
+    blocks = queue.Queue()
+    drains = {a: HatDrain(a, hats[a], num_channels, blocks, t0) for a in addresses}
+    scan_start = {}
+
+    file_count = 0
+    next_rotate = t0_wall + CHUNK_DURATION
+    written = {a: 0 for a in addresses}
+
+    def open_new_file(idx):
+        filename = os.path.join(savedir, f"{prefix}_part{idx}.hdf5")
+        f = h5py.File(filename, "w", libver="latest")
+        f.attrs['t0_wall'] = t0_wall
+        f.attrs['addresses'] = addresses
+        f.attrs['part'] = idx
+        dsets, refs = {}, {}
+        for a in addresses:
+            grp = f.create_group(f"hat{a}")
+            dset = create_voltage(grp, num_channels, chunksize, scan_rate, total_time)
+            dset.attrs['channels'] = channels
+            dset.attrs['address'] = a
+            dset.attrs['first_sample'] = written[a]
+            dset.attrs['scan_start'] = scan_start.get(a, 0.0)
+            dsets[a] = dset
+            refs[a] = grp.create_dataset(
+                "timeref", shape=(0, 2), maxshape=(None, 2), chunks=(1024, 2), dtype="float64"
+            )
+        # SWMR only after all objects exist
+        f.swmr_mode = True
+        return f, dsets, refs
+
+    buffers = {a: ScanBuffer(num_channels, 2 * chunksize) for a in addresses}
+    timerefs = {a: [] for a in addresses}
+
+    def write_device(a):
+        if buffers[a]:
+            combined = buffers[a].view()
+            dset = dsets[a]
+            old = dset.shape[0]
+            dset.resize((old + combined.shape[0], num_channels))
+            dset[old:, :] = combined
+            written[a] += combined.shape[0]
+            buffers[a].clear()
+        if timerefs[a]:
+            ref = refs[a]
+            old = ref.shape[0]
+            ref.resize((old + len(timerefs[a]), 2))
+            ref[old:, :] = timerefs[a]
+            timerefs[a].clear()
+
+    def close_file():
+        for a in addresses:
+            write_device(a)
+            stamp_end_time(dsets[a])
+            for key, value in drains[a].stats().items():
+                dsets[a].attrs[key] = value
+        f.flush()
+        safe_fsync(f)
+        f.close()
+
+    # Start all scans back to back and remember when each one started
+    for a in addresses:
+        hats[a].a_in_scan_start(channel_mask, 0, scan_rate, options)
+        scan_start[a] = time.monotonic() - t0
+    f, dsets, refs = open_new_file(file_count)
+    for a in addresses:
+        drains[a].start()
+    print(f"Scan started on HATs {addresses}. Acquiring...")
+
+    next_report = t0_wall + REPORT_INTERVAL
+    try:
+        while True:
+            try:
+                a, count, t, block = blocks.get(timeout=0.5)
+                buffers[a].append(block)
+                timerefs[a].append((count, t))
+            except queue.Empty:
+                pass
+
+            for dev in addresses:
+                if len(buffers[dev]) >= chunksize:
+                    write_device(dev)
+                    f.flush()
+                    safe_fsync(f)
+
+            now = time.time()
+            if now >= next_rotate:
+                close_file()
+                file_count += 1
+                next_rotate += CHUNK_DURATION
+                f, dsets, refs = open_new_file(file_count)
+
+            if now >= next_report:
+                next_report += REPORT_INTERVAL
+                for dev in addresses:
+                    st = drains[dev].stats()
+                    print(f"HAT {dev}: {st['samples']} S, {st['throughput']:.1f} S/s, "
+                          f"max backlog {st['max_backlog']}")
+
+            if now - t0_wall >= total_time and not _STOP.is_set():
+                print("Measurement complete.")
+                _STOP.set()
+            if _STOP.is_set() and blocks.empty():
+                break
+
+    finally:
+        _STOP.set()
+        for a in addresses:
+            try:
+                hats[a].a_in_scan_stop()
+            except Exception:
+                pass
+        for a in addresses:
+            drains[a].join(timeout=10.0)
+            try:
+                hats[a].a_in_scan_cleanup()
+            except Exception:
+                pass
+        while not blocks.empty():
+            a, count, t, block = blocks.get_nowait()
+            buffers[a].append(block)
+            timerefs[a].append((count, t))
+        close_file()
+        os.close(lock)
+        print(f"Data saved to parts 0–{file_count} in {savedir}")
+
+    stats = {a: drains[a].stats() for a in addresses}
+    for a, st in stats.items():
+        print(f"HAT {a}: {st['samples']} S in {st['reads']} reads, {st['throughput']:.1f} S/s, "
+              f"max backlog {st['max_backlog']}, hardware overrun {st['hardware_overrun']}, "
+              f"buffer overrun {st['buffer_overrun']}")
+    return stats
+
+
+def load_multi_hat(path, address):
+    '''
+    raw codes, timeref and attributes of one device in a multi-HAT part
+    '''
+    with h5py.File(path, 'r') as f:
+        grp = f[f"hat{address}"]
+        dset = {}
+        dset['voltage'] = grp['voltage'][:]
+        dset['timeref'] = grp['timeref'][:]
+        dset.update({k: v for k, v in grp['voltage'].attrs.items()})
+        dset['t0_wall'] = f.attrs['t0_wall']
+    return dset
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Big Mag multi-HAT',
+        description='Concurrent scan of several MCC 128 HATs with hourly file rotation.'
+    )
+    parser.add_argument('savedir', type=str, help='Directory for output HDF5 files')
+    parser.add_argument('-a', '--addresses', type=int, nargs='+', default=None,
+                        help='HAT addresses to scan (default: all found)')
+    parser.add_argument('-c', '--channels', type=int, nargs='+', default=[0, 1, 4],
+                        help='Channels to scan on every HAT')
+    parser.add_argument('-t', '--time', type=float, default=10.0,
+                        help='Total record time in seconds')
+    parser.add_argument('-s', '--scanrate', type=float, default=1000.0,
+                        help='Requested scan rate (S/s)')
+    parser.add_argument('--exttrigger', action='store_true',
+                        help='Start all scans on the shared external trigger')
+    parser.add_argument('--simulate', action='store_true',
+                        help='Use simulated HATs (simhat.py) instead of hardware')
+    args = parser.parse_args()
+
+    ts = time.strftime("%Y_%m_%d_%H_%M", time.localtime())
+    multi_hat_scan(args.addresses, args.channels, args.scanrate, args.time,
+                   args.savedir, f"mag_{ts}", simulate=args.simulate, exttrigger=args.exttrigger)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Parquet export of runs and health logs for polars lazy queries.
+
+Every hdf5 part becomes `<lake>/mag/<prefix>_part<N>.parquet` with one row
+group per `row_group_seconds` of samples (one minute by default). Columns
+are `time` (UTC timestamp in ns, on the sample clock of the part, shifted
+over recorded gaps), `sample` (index on the uninterrupted clock) and the raw
+uint16 codes `x`, `y`, `z`. Parquet keeps min/max statistics of every row
+group, so `scan_mag(lake, t_start, t_stop)` reads only the row groups of the
+requested minutes. Sample rate, calibration constants, channel order and
+the part attributes are stored in the file metadata under `magnetofft`.
+
+monitorpi health logs go to `<lake>/env/<name>.parquet` with the same
+`time` column, `with_environment` attaches the latest health row to every
+sample (as-of join).
+
+    python parquet_lake.py lake run/mag_2025_*_part*.hdf5 --env run/logs/monitorpi_*.csv
+
+pyarrow (export) and polars (queries) are imported when used.
+"""
+import os
+import csv
+import json
+import time
+import argparse
+from datetime import datetime, timezone
+import numpy as np
+from magcore import SLOPE, OFFSET, VOLT_TO_UT, AXIS_COLUMNS, _CODE_ZERO, _CODE_TO_VOLT
+from magio import iter_hdf5_blocks, load_gaps, part_start_unix, TIME_FORMAT
+
+ROW_GROUP_SECONDS = 60.
+META_KEY = b'magnetofft'
+
+
+def sample_index(rows, gaps):
+    '''
+    index on the uninterrupted sample clock of stored rows, adding the samples
+    lost at every gap before them
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+    if len(gaps) == 0 or 'start_sample' not in gaps.dtype.names:
+        return rows
+    order = np.argsort(gaps['row'])
+    lost = np.cumsum((gaps['end_sample'] - gaps['start_sample'])[order])
+    k = np.searchsorted(gaps['row'][order], rows, side='right')
+    return rows + np.concatenate([[0], lost])[k]
+
+
+def _attr(value):
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def export_part(pathh5, lake, row_group_seconds=ROW_GROUP_SECONDS, compression='zstd', overwrite=False):
+    """
+    Write one hdf5 part as a Parquet file of the lake.
+
+    Args:
+        pathh5 (str): part file.
+        lake (str): lake directory.
+        row_group_seconds (float): samples per row group, in seconds.
+        compression (str): parquet codec.
+        overwrite (bool): replace an existing export.
+
+    Returns:
+        str: path of the parquet file
+    """
+    import h5py
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    out = os.path.join(lake, 'mag', os.path.splitext(os.path.basename(pathh5))[0] + '.parquet')
+    if os.path.exists(out) and not overwrite:
+        print(f"{out} exists")
+        return out
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+
+    with h5py.File(pathh5, 'r', swmr=True) as f:
+        attrs = {k: _attr(v) for k, v in f['voltage'].attrs.items()}
+        nch = f['voltage'].shape[1] if f['voltage'].ndim > 1 else 1
+    fs = float(attrs['sample_rate'])
+    t0, time_source = part_start_unix(attrs)
+    gaps = load_gaps(pathh5)
+    axes = {'x': 0} if nch == 1 else AXIS_COLUMNS
+
+    meta = {
+        'source': os.path.basename(pathh5),
+        'sample_rate': fs,
+        'calibration': {'slope': SLOPE, 'offset': OFFSET, 'volt_to_ut': VOLT_TO_UT,
+                        'code_zero': _CODE_ZERO, 'code_to_volt': _CODE_TO_VOLT,
+                        'formula': 'ut = (code-code_zero)*code_to_volt*volt_to_ut'},
+        'axis_columns': {ax: axes[ax] for ax in sorted(axes)},
+        'time_source': time_source,
+        'start_unix': t0,
+        'row_group_seconds': row_group_seconds,
+        'gaps': int(len(gaps)),
+        'attrs': attrs,
+    }
+    fields = [pa.field('time', pa.timestamp('ns', tz='UTC')), pa.field('sample', pa.int64())]
+    fields += [pa.field(ax, pa.uint16()) for ax in sorted(axes)]
+    schema = pa.schema(fields, metadata={META_KEY: json.dumps(meta).encode()})
+
+    rows_per_group = max(int(round(row_group_seconds * fs)), 1)
+    t0_ns = int(round(t0 * 1e9))
+    tmp = out + '.tmp'
+    nrows = 0
+    with pq.ParquetWriter(tmp, schema, compression=compression) as writer:
+        # one hdf5 block per row group
+        for start, raw in iter_hdf5_blocks(pathh5, rows_per_group):
+            raw = raw.reshape(len(raw), nch)
+            sample = sample_index(np.arange(start, start + len(raw)), gaps)
+            t_ns = t0_ns + np.round(sample * (1e9 / fs)).astype(np.int64)
+            columns = [pa.array(t_ns, type=pa.timestamp('ns', tz='UTC')), pa.array(sample)]
+            columns += [pa.array(np.ascontiguousarray(raw[:, axes[ax]])) for ax in sorted(axes)]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema), row_group_size=len(raw))
+            nrows += len(raw)
+    os.replace(tmp, out)
+    print(f"{out}: {nrows} rows in {-(-nrows // rows_per_group)} row groups")
+    return out
+
+
+def export_run(parts, lake, row_group_seconds=ROW_GROUP_SECONDS, compression='zstd', overwrite=False):
+    return [export_part(p, lake, row_group_seconds, compression, overwrite) for p in parts]
+
+
+def export_env(pathcsv, lake, time_base=None, overwrite=False):
+    """
+    Write a monitorpi health log to `<lake>/env/`.
+
+    Args:
+        pathcsv (str): log written by monitorpi.py or the supervisor.
+        lake (str): lake directory.
+        time_base (float): unix time of the supervisor run clock; with the
+            `runtime(s)` column of supervisor logs the row times are exact,
+            otherwise they are the minute of `localtime`.
+
+    Returns:
+        str: path of the parquet file
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    out = os.path.join(lake, 'env', os.path.splitext(os.path.basename(pathcsv))[0] + '.parquet')
+    if os.path.exists(out) and not overwrite:
+        print(f"{out} exists")
+        return out
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+
+    with open(pathcsv, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = [r for r in reader if len(r) == len(header)]
+    cols = {name: [r[i] for r in rows] for i, name in enumerate(header)}
+    if time_base is not None and 'runtime(s)' in cols:
+        t = np.array([time_base + float(v) for v in cols['runtime(s)']])
+    else:
+        t = np.array([time.mktime(time.strptime(v, TIME_FORMAT)) for v in cols['localtime']])
+    arrays = {'time': pa.array(np.round(t * 1e9).astype(np.int64), type=pa.timestamp('ns', tz='UTC'))}
+    for name in header:
+        if name == 'localtime':
+            arrays[name] = pa.array(cols[name])
+        else:
+            # empty cells are readings the board could not take
+            arrays[name] = pa.array([float(v) if v not in ('', 'None') else None for v in cols[name]],
+                                    type=pa.float64())
+    table = pa.table(arrays)
+    table = table.replace_schema_metadata({META_KEY: json.dumps({'source': os.path.basename(pathcsv)}).encode()})
+    pq.write_table(table, out + '.tmp')
+    os.replace(out + '.tmp', out)
+    print(f"{out}: {len(rows)} rows")
+    return out
+
+
+def lake_metadata(path):
+    '''
+    magnetofft metadata dict of a lake parquet file
+    '''
+    import pyarrow.parquet as pq
+    meta = pq.read_schema(path).metadata or {}
+    return json.loads(meta[META_KEY]) if META_KEY in meta else {}
+
+
+def _to_datetime(t):
+    '''
+    datetime (naive = UTC), unix seconds or a TIME_FORMAT local time string -> aware UTC datetime
+    '''
+    if isinstance(t, str):
+        t = time.mktime(time.strptime(t, TIME_FORMAT))
+    if isinstance(t, datetime):
+        return t if t.tzinfo is not None else t.replace(tzinfo=timezone.utc)
+    return datetime.fromtimestamp(float(t), tz=timezone.utc)
+
+
+def scan_mag(lake, t_start=None, t_stop=None, calibrate=True, dtype='float64'):
+    """
+    Lazy polars query over all exported parts. The time range is pushed
+    down to the row group statistics, only matching minutes are read.
+
+    Args:
+        lake (str): lake directory.
+        t_start, t_stop: range [t_start, t_stop) as datetime, unix seconds or
+            a "%Y_%m_%d_%H_%M" local time string; None for open.
+        calibrate (bool): replace the codes by μT (as load_hdf5).
+        dtype (str): 'float64' or 'float32' for the calibrated columns.
+
+    Returns:
+        polars.LazyFrame
+    """
+    import polars as pl
+    lf = pl.scan_parquet(os.path.join(lake, 'mag', '*.parquet'))
+    if t_start is not None:
+        lf = lf.filter(pl.col('time') >= _to_datetime(t_start))
+    if t_stop is not None:
+        lf = lf.filter(pl.col('time') < _to_datetime(t_stop))
+    if calibrate:
+        out = pl.Float32 if dtype == 'float32' else pl.Float64
+        axes = [ax for ax in ('x', 'y', 'z') if ax in lf.collect_schema().names()]
+        # same constants as magcore.calibrate_data, so the lake matches load_hdf5
+        lf = lf.with_columns([
+            ((pl.col(ax).cast(pl.Float64) - _CODE_ZERO) * (_CODE_TO_VOLT * VOLT_TO_UT)).cast(out).alias(ax)
+            for ax in axes
+        ])
+    return lf
+
+
+def scan_env(lake):
+    import polars as pl
+    return pl.scan_parquet(os.path.join(lake, 'env', '*.parquet')).sort('time')
+
+
+def with_environment(mag, env, tolerance='5m'):
+    '''
+    as-of join: every sample gets the latest health row at most `tolerance` older
+    '''
+    return mag.sort('time').join_asof(env.drop('localtime'), on='time', strategy='backward',
+                                      tolerance=tolerance)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Parquet lake',
+        description='Export hdf5 parts and monitorpi logs as Parquet with per-minute row groups.'
+    )
+    parser.add_argument('lake', type=str, help='Lake directory')
+    parser.add_argument('parts', type=str, nargs='*', help='hdf5 part files')
+    parser.add_argument('--env', type=str, nargs='*', default=[], help='monitorpi health logs (csv)')
+    parser.add_argument('--time-base', type=float, default=None,
+                        help='Run clock of supervisor health logs (time_base attribute of the parts)')
+    parser.add_argument('-r', '--row-group', type=float, default=ROW_GROUP_SECONDS,
+                        help='Seconds of samples per row group')
+    parser.add_argument('-c', '--compression', type=str, default='zstd', help='Parquet codec')
+    parser.add_argument('-f', '--force', action='store_true', help='Overwrite existing exports')
+    args = parser.parse_args()
+
+    export_run(args.parts, args.lake, args.row_group, args.compression, args.force)
+    for path in args.env:
+        export_env(path, args.lake, args.time_base, args.force)
@@ -0,0 +1,68 @@
+"""
+Pieces shared by the hdf5 part writers (scan_save_rawh5_fault_tolerant.py
+and multihat.py): rotation constants, the `voltage` dataset of a part and
+its attributes, end-of-part stamping, fsync and signal registration.
+"""
+import os
+import time
+import signal
+from magio import TIME_FORMAT
+
+CHUNK_DURATION = 3600.0  # seconds per file
+DEFAULT_CHUNKSIZE = 8192
+
+
+def safe_fsync(h5file):
+    """
+    Attempt to fsync the underlying file descriptor of an HDF5 File.
+    """
+    try:
+        fd = h5file.id.get_vfd_handle()
+        os.fsync(fd)
+    except Exception as e:
+        print(f"Warning: fsync failed: {e}")
+
+
+def register_signal_handlers(handler):
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGPWR):
+        try:
+            signal.signal(sig, handler)
+        except (AttributeError, RuntimeError, ValueError):
+            # Some signals may not exist, or we are not in the main thread
+            pass
+
+
+def create_voltage(group, num_channels, chunksize, scan_rate, total_time):
+    """
+    Create the extendable uint16 `voltage` dataset of a part with its
+    metadata, before the file switches to SWMR.
+
+    Args:
+        group (h5py.Group): file or group of the part.
+        num_channels (int): columns.
+        chunksize (int): rows per chunk.
+        scan_rate (float): samples per second per channel.
+        total_time (float): total run time in seconds.
+
+    Returns:
+        h5py.Dataset
+    """
+    dset = group.create_dataset(
+        "voltage", shape=(0, num_channels), maxshape=(None, num_channels),
+        chunks=(chunksize, num_channels), dtype="uint16"
+    )
+    dset.attrs['dtype'] = 'uint16'
+    dset.attrs['sample_rate'] = scan_rate
+    start_ts = time.strftime(TIME_FORMAT, time.localtime())
+    dset.attrs['start_time'] = start_ts
+    dset.attrs['measure_time'] = min(CHUNK_DURATION, total_time)
+    # Pre-create end_time attribute for safe SWMR updates
+    dset.attrs['end_time'] = start_ts  # placeholder
+    return dset
+
+
+def stamp_end_time(dset):
+    '''
+    replace the end_time placeholder when the part is closed
+    '''
+    dset.attrs['end_time'] = time.strftime(TIME_FORMAT, time.localtime())
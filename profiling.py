@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Opt-in stage timing for the analysis pipeline.
+
+Loaders, calibration, PSD loops and plots open named stages with
+`stage(name, **tags)`. While profiling is off a stage is a single flag check
+returning a shared no-op context. When on, every stage path (nested names,
+e.g. `plot_sample_psd;axis[x];compute_averaged_psd;segment_fft`) collects
+call count, wall time, process CPU time (includes fft worker threads),
+bytes read (reported by the readers with `add_bytes`) and peak traced
+allocation.
+
+Switch it on with the environment variable
+
+    MAGNETOFFT_PROFILE=1                 report to ./magnetofft_profile_<pid>.json at exit
+    MAGNETOFFT_PROFILE=<dir or .json>    report there
+    MAGNETOFFT_PROFILE_MEMORY=0          skip tracemalloc (lower overhead)
+
+or for a block of code:
+
+    with profile('psd.json') as prof:
+        plot_sample_psd(path, fs)
+    prof.print_table()
+
+Reports are JSON plus a `.folded` file of self times in microseconds
+(flamegraph.pl / speedscope input). `python profiling.py a.json b.json -o
+all.json` aggregates the reports of batch jobs.
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import argparse
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _NullStage()
+
+
+class Report:
+    """
+    Aggregated stage records of one run, keyed by stage path.
+    """
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.start = time.time()
+        self.records = {}
+        self._lock = threading.Lock()
+
+    def add(self, path, wall, cpu, nbytes, peak):
+        with self._lock:
+            rec = self.records.setdefault(path, {'count': 0, 'wall_s': 0., 'cpu_s': 0.,
+                                                 'bytes_read': 0, 'peak_bytes': 0})
+            rec['count'] += 1
+            rec['wall_s'] += wall
+            rec['cpu_s'] += cpu
+            rec['bytes_read'] += nbytes
+            rec['peak_bytes'] = max(rec['peak_bytes'], peak)
+
+    def self_times(self):
+        '''
+        wall time of each path minus its direct children
+        '''
+        own = {p: r['wall_s'] for p, r in self.records.items()}
+        for p, r in self.records.items():
+            parent = p.rpartition(';')[0]
+            if parent in own:
+                own[parent] -= r['wall_s']
+        return {p: max(t, 0.) for p, t in own.items()}
+
+    def to_dict(self):
+        return {
+            'run': {'argv': sys.argv, 'pid': os.getpid(), 'start': self.start,
+                    'duration_s': time.time() - self.start, 'memory': self.memory},
+            'stages': [dict(path=p, **r) for p, r in sorted(self.records.items())],
+        }
+
+    def folded(self):
+        return '\n'.join(f"{p} {int(round(t * 1e6))}" for p, t in sorted(self.self_times().items())) + '\n'
+
+    def write(self, path):
+        '''
+        JSON report to path and folded self times to path with .folded
+        '''
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+        with open(os.path.splitext(path)[0] + '.folded', 'w') as f:
+            f.write(self.folded())
+        return path
+
+    def print_table(self, top=20):
+        print_stages(self.to_dict()['stages'], top)
+
+
+class _State(threading.local):
+    def __init__(self):
+        self.stack = []
+
+
+_state = _State()
+_report = None
+
+
+def enabled():
+    return _report is not None
+
+
+def enable(memory=True):
+    '''
+    start collecting into a fresh report and return it
+    '''
+    global _report
+    _report = Report(memory)
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return _report
+
+
+def disable():
+    '''
+    stop collecting, returns the finished report
+    '''
+    global _report
+    report, _report = _report, None
+    if report is not None and report.memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return report
+
+
+class _Stage:
+    __slots__ = ('name', 'path', 'wall', 'cpu', 'nbytes', 'base', 'peak')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        stack = _state.stack
+        self.path = stack[-1].path + ';' + self.name if stack else self.name
+        self.nbytes = 0
+        if _report.memory:
+            cur, peak = tracemalloc.get_traced_memory()
+            # parents keep their peak across the reset below
+            for frame in stack:
+                frame.peak = max(frame.peak, peak)
+            tracemalloc.reset_peak()
+            self.base = self.peak = cur
+        stack.append(self)
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        stack = _state.stack
+        stack.pop()
+        peak = 0
+        if _report is not None:
+            if _report.memory and tracemalloc.is_tracing():
+                self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+                peak = self.peak - self.base
+                if stack:
+                    stack[-1].peak = max(stack[-1].peak, self.peak)
+            _report.add(self.path, wall, cpu, self.nbytes, peak)
+        if stack:
+            stack[-1].nbytes += self.nbytes
+        return False
+
+
+def stage(name, **tags):
+    '''
+    context manager timing a named stage, tags are appended as name[key=value]
+    '''
+    if _report is None:
+        return _NULL
+    if tags:
+        name += '[' + ','.join(f"{k}={v}" for k, v in tags.items()) + ']'
+    return _Stage(name)
+
+
+def profiled(name=None):
+    '''
+    decorator running the function inside stage(name or function name)
+    '''
+    def wrap(func):
+        label = name or func.__name__
+
+        def inner(*args, **kwargs):
+            if _report is None:
+                return func(*args, **kwargs)
+            with _Stage(label):
+                return func(*args, **kwargs)
+        inner.__name__ = func.__name__
+        inner.__doc__ = func.__doc__
+        inner.__wrapped__ = func
+        return inner
+    return wrap
+
+
+def add_bytes(nbytes):
+    '''
+    attribute bytes read to the current stage (and its parents)
+    '''
+    if _report is not None and _state.stack:
+        _state.stack[-1].nbytes += int(nbytes)
+
+
+@contextmanager
+def profile(path=None, memory=True):
+    '''
+    profile a block of code, writes the report to path if given
+    '''
+    global _report
+    previous = _report
+    report = enable(memory)
+    try:
+        yield report
+    finally:
+        disable()
+        # an environment-enabled report continues after the block
+        _report = previous
+        if previous is not None and previous.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if path:
+            report.write(path)
+
+
+def print_stages(stages, top=20):
+    stages = sorted(stages, key=lambda s: -s['wall_s'])[:top]
+    print(f"{'stage':60s} {'n':>6s} {'wall s':>9s} {'cpu s':>9s} {'MB read':>9s} {'peak MB':>9s}")
+    for s in stages:
+        print(f"{s['path'][-60:]:60s} {s['count']:6d} {s['wall_s']:9.3f} {s['cpu_s']:9.3f} "
+              f"{s['bytes_read'] / 1e6:9.1f} {s['peak_bytes'] / 1e6:9.1f}")
+
+
+def merge_reports(paths):
+    '''
+    sum the stages of several JSON reports (peak is the maximum)
+    '''
+    merged = Report(memory=False)
+    for path in paths:
+        with open(path) as f:
+            for s in json.load(f)['stages']:
+                rec = merged.records.setdefault(s['path'], {'count': 0, 'wall_s': 0., 'cpu_s': 0.,
+                                                             'bytes_read': 0, 'peak_bytes': 0})
+                for key in ('count', 'wall_s', 'cpu_s', 'bytes_read'):
+                    rec[key] += s[key]
+                rec['peak_bytes'] = max(rec['peak_bytes'], s['peak_bytes'])
+    return merged
+
+
+def _env_report_path(value):
+    if value == '1':
+        return os.path.join(os.getcwd(), f"magnetofft_profile_{os.getpid()}.json")
+    if value.endswith('.json'):
+        return value
+    os.makedirs(value, exist_ok=True)
+    ts = time.strftime("%Y_%m_%d_%H_%M_%S", time.localtime())
+    return os.path.join(value, f"profile_{ts}_{os.getpid()}.json")
+
+
+def _write_env_report(path):
+    report = disable()
+    if report is not None and report.records:
+        report.write(path)
+        print(f"profile report saved to {path}")
+
+
+_ENV = os.environ.get('MAGNETOFFT_PROFILE', '')
+if _ENV not in ('', '0'):
+    enable(memory=os.environ.get('MAGNETOFFT_PROFILE_MEMORY', '1') != '0')
+    atexit.register(_write_env_report, _env_report_path(_ENV))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Profile reports',
+        description='Aggregate and print stage timing reports written with MAGNETOFFT_PROFILE.'
+    )
+    parser.add_argument('reports', type=str, nargs='+', help='JSON reports')
+    parser.add_argument('-o', '--out', type=str, default=None, help='Write the merged report here')
+    parser.add_argument('-n', '--top', type=int, default=20, help='Stages shown')
+    args = parser.parse_args()
+
+    merged = merge_reports(args.reports)
+    merged.print_table(args.top)
+    if args.out:
+        merged.write(args.out)
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Streaming spectral statistics of magnetometer runs.
+
+Segment PSDs (same window and normalisation as compute_psd) are folded into
+a fixed-size histogram per frequency bin instead of an ensemble matrix, so
+memory does not grow with the number of segments. Bins are uniform in
+log10(PSD) around a per-frequency reference level taken from the median of
+the first few segments; mean, min and max are kept exactly, median and
+percentiles are interpolated inside one histogram bin (0.025 decade, about
+6 %, by default). Glitchy segments move the mean but not the median.
+
+Memory is nf * nbins * 4 bytes per axis, nf = Lbin * fs / 2 + 1, and grows
+with the sample rate: Lbin 100 s with 256 bins takes 51 MB per axis at
+1 kHz, but 1 GB per axis (3 GB for x, y, z) at 20 kS/s. psd_stats_run
+refuses sketches above MAX_SKETCH_BYTES (--max-memory); use fewer bins
+(-n), a shorter Lbin or one axis at a time (-a) for high rates.
+"""
+import os
+import argparse
+import h5py
+import numpy as np
+from magcore import calibrate_data, compute_psd, gap_rows, VOLT_TO_UT, AXIS_COLUMNS
+from magio import iter_hdf5_blocks, load_gaps
+
+DEFAULT_PERCENTILES = (10., 50., 90.)
+DEFAULT_NBINS = 256
+DEFAULT_SPAN = 6.0          # decades covered by the histogram
+WARMUP = 8                  # segments buffered to set the reference level
+QUANTILE_ROWS = 4096        # frequency bins per cumulative-count pass
+MAX_SKETCH_BYTES = 1024**3  # histogram counters of all axes allowed by psd_stats_run
+
+
+class SpectralStats:
+    """
+    Mean, median and percentiles of segment PSDs with constant memory.
+
+    Feed calibrated samples of one axis with update() (segments continue
+    across calls; call reset() at a discontinuity) or ready segment PSDs
+    with add_psd().
+
+    Args:
+        fs (float): sample rate in Hz.
+        Lbin (int): segment length in samples.
+        overlapratio (float): segment overlap as in compute_averaged_psd.
+        nbins (int): histogram bins per frequency.
+        span (float): decades of PSD covered, centred on the reference.
+        ref (numpy.ndarray or float): log10 reference level per frequency
+            (or one for all); default from the first WARMUP segments. Pass
+            the same ref to sketches that will be merged.
+        dtype: working precision of the segment PSDs.
+    """
+
+    def __init__(self, fs, Lbin, overlapratio=0.5, nbins=DEFAULT_NBINS, span=DEFAULT_SPAN,
+                 ref=None, dtype=np.float64):
+        self.fs = float(fs)
+        self.Lbin = int(Lbin)
+        self.hop = max(int(self.Lbin * overlapratio), 1)
+        self.nbins = int(nbins)
+        self.span = float(span)
+        self.step = self.span / self.nbins
+        self.dtype = np.dtype(dtype)
+        self.f = np.fft.rfftfreq(self.Lbin, 1. / self.fs)
+        nf = len(self.f)
+
+        self.count = 0
+        self.sum = np.zeros(nf)
+        self.min = np.full(nf, np.inf)
+        self.max = np.full(nf, -np.inf)
+        self.counts = None
+        self.ref = None
+        self._warm = []
+        if ref is not None:
+            self._set_ref(np.broadcast_to(np.asarray(ref, dtype=float), (nf,)))
+        self._tail = np.zeros(0, dtype=self.dtype)
+
+    @property
+    def memory_bytes(self):
+        return len(self.f) * self.nbins * 4
+
+    def _set_ref(self, ref):
+        self.ref = np.array(ref, dtype=float)
+        # lower histogram edge per frequency
+        self._lo = self.ref - self.span / 2.
+        self.counts = np.zeros((len(self.f), self.nbins), dtype=np.uint32)
+        self._rowoff = np.arange(len(self.f)) * self.nbins
+
+    def _histogram(self, psd):
+        with np.errstate(divide='ignore'):
+            idx = (np.log10(psd) - self._lo) / self.step
+        idx = np.clip(np.nan_to_num(idx, neginf=0.), 0, self.nbins - 1).astype(np.intp)
+        # one entry per row, so the flat indices are unique
+        self.counts.ravel()[self._rowoff + idx] += 1
+
+    def add_psd(self, psd):
+        '''
+        fold one segment psd (full rfft length, DC included) into the statistics
+        '''
+        psd = np.asarray(psd, dtype=float)
+        self.count += 1
+        self.sum += psd
+        np.minimum(self.min, psd, out=self.min)
+        np.maximum(self.max, psd, out=self.max)
+        if self.counts is not None:
+            self._histogram(psd)
+            return
+        self._warm.append(psd)
+        if len(self._warm) >= WARMUP:
+            self._flush_warmup()
+
+    def _flush_warmup(self):
+        with np.errstate(divide='ignore'):
+            ref = np.log10(np.median(self._warm, axis=0))
+        self._set_ref(np.where(np.isfinite(ref), ref, 0.))
+        for psd in self._warm:
+            self._histogram(psd)
+        self._warm = []
+
+    def update(self, chs):
+        '''
+        consume calibrated samples of one axis, returns the number of new segments
+        '''
+        chs = np.asarray(chs, dtype=self.dtype)
+        data = np.concatenate([self._tail, chs]) if len(self._tail) else chs
+        nseg = (len(data) - self.Lbin) // self.hop + 1 if len(data) >= self.Lbin else 0
+        for k in range(nseg):
+            _, psd = compute_psd(data[k * self.hop:k * self.hop + self.Lbin], self.fs,
+                                 nodc=False, dtype=self.dtype)
+            self.add_psd(psd)
+        self._tail = data[nseg * self.hop:].copy()
+        return nseg
+
+    def reset(self):
+        '''
+        drop the pending samples, the next segment starts after a discontinuity
+        '''
+        self._tail = np.zeros(0, dtype=self.dtype)
+
+    def merge(self, other):
+        '''
+        add the statistics of another sketch with the same f, bins and ref
+        '''
+        for s in (self, other):
+            if s.counts is None and s._warm:
+                s._flush_warmup()
+        if other.counts is not None:
+            if self.counts is None:
+                self._set_ref(other.ref)
+            elif (other.nbins != self.nbins or other.span != self.span
+                    or not np.array_equal(other.ref, self.ref)):
+                raise ValueError('merged sketches need the same nbins, span and ref')
+            self.counts += other.counts
+        self.count += other.count
+        self.sum += other.sum
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+
+    def percentile(self, q):
+        '''
+        q-th percentile (0-100) per frequency bin
+        '''
+        if self.count == 0:
+            return np.full(len(self.f), np.nan)
+        if self.counts is None:
+            return np.percentile(self._warm, q, axis=0)
+        out = np.empty(len(self.f))
+        target = q / 100. * self.count
+        for r0 in range(0, len(self.f), QUANTILE_ROWS):
+            rows = slice(r0, r0 + QUANTILE_ROWS)
+            counts = self.counts[rows]
+            cum = np.cumsum(counts, axis=1)
+            k = np.minimum(np.sum(cum < target, axis=1), self.nbins - 1)
+            r = np.arange(len(k))
+            below = cum[r, k] - counts[r, k]
+            frac = np.clip((target - below) / np.maximum(counts[r, k], 1), 0., 1.)
+            out[rows] = self._lo[rows] + (k + frac) * self.step
+        # edge bins also hold the out-of-range values, min/max are exact
+        return np.clip(10**out, self.min, self.max)
+
+    def result(self, percentiles=DEFAULT_PERCENTILES, nodc=True):
+        """
+        Statistics of all segments so far.
+
+        Returns:
+            dict: 'f', 'count', 'mean', 'median', 'min', 'max' and
+            'percentiles' {q: psd}; arrays have the DC bin dropped if nodc.
+        """
+        sl = slice(1, None) if nodc else slice(None)
+        res = {}
+        res['f'] = self.f[sl]
+        res['count'] = self.count
+        res['mean'] = (self.sum / max(self.count, 1))[sl]
+        res['median'] = self.percentile(50.)[sl]
+        res['min'] = self.min[sl]
+        res['max'] = self.max[sl]
+        res['percentiles'] = {q: self.percentile(q)[sl] for q in percentiles}
+        return res
+
+
+def compute_psd_stats(chs, fs, Lbin, overlapratio=0.5, nodc=True, gaps=None,
+                      percentiles=DEFAULT_PERCENTILES, **kwargs):
+    '''
+    mean/median/percentile psd of one in-memory axis, the streaming counterpart
+    of compute_averaged_psd; segments restart after every gap row. Every full
+    segment is used, (N-Lbin)//hop + 1 of them, one more than
+    compute_averaged_psd takes ((N-Lbin)//hop, the last full segment is left
+    out), so the mean differs from it by about 1/segments
+    '''
+    stats = SpectralStats(fs, Lbin, overlapratio, **kwargs)
+    rows = gap_rows(gaps)
+    edges = np.concatenate([[0], rows[(rows > 0) & (rows < len(chs))], [len(chs)]])
+    for a, b in zip(edges[:-1], edges[1:]):
+        stats.reset()
+        stats.update(chs[a:b])
+    return stats.result(percentiles, nodc)
+
+
+def psd_stats_run(paths, outpath, Lbin, overlapratio=0.5, axes=('x', 'y', 'z'),
+                  percentiles=DEFAULT_PERCENTILES, nbins=DEFAULT_NBINS, span=DEFAULT_SPAN,
+                  blocksize=None, dtype=np.float64, max_memory=MAX_SKETCH_BYTES):
+    """
+    Streaming PSD statistics over consecutive hdf5 parts, saved to outpath.
+
+    Args:
+        paths (list[str]): part files (or run masters) in acquisition order.
+        outpath (str): output hdf5 file.
+        Lbin (float): segment length in seconds.
+        overlapratio (float): segment overlap.
+        axes (tuple): axes to analyse.
+        percentiles (tuple): percentiles saved besides the median.
+        nbins (int), span (float): histogram size, see SpectralStats.
+        blocksize (int): rows per read, default 4 segments (rounded up to whole chunks).
+        dtype: working precision.
+        max_memory (int): bytes allowed for the histograms of all axes,
+            None for no limit.
+
+    Raises:
+        ValueError: if the histograms would need more than max_memory.
+    """
+    with h5py.File(paths[0], 'r') as f:
+        attrs = f['voltage'].attrs
+        fs = float(attrs['sample_rate'])
+        start_time = attrs.get('start_time', '')
+        ncols = f['voltage'].shape[1] if f['voltage'].ndim > 1 else 1
+    if ncols == 1:
+        axes, cols = ['x'], [0]
+    else:
+        cols = [AXIS_COLUMNS[a] for a in axes]
+    n = int(round(Lbin * fs))
+    blocksize = blocksize or 4 * n
+    need = len(axes) * (n // 2 + 1) * nbins * 4
+    if max_memory is not None and need > max_memory:
+        raise ValueError(f"histograms need {need / 1024.**2:.1f} MB for {len(axes)} axes "
+                         f"({n // 2 + 1} frequencies x {nbins} bins), above {max_memory / 1024.**2:.1f} MB: "
+                         f"use fewer bins, a shorter Lbin, fewer axes or raise the limit")
+
+    stats = [SpectralStats(fs, n, overlapratio, nbins, span, dtype=dtype) for _ in axes]
+    print(f"sketch memory {len(axes) * stats[0].memory_bytes / 1024.**2:.1f} MB")
+    for path in paths:
+        print('->psd stats ' + path, end='\r')
+        rows = list(gap_rows(load_gaps(path)))
+        for start, raw in iter_hdf5_blocks(path, blocksize, columns=cols, align=True):
+            data = calibrate_data(raw, dtype)
+            data *= VOLT_TO_UT
+            # split the block at gap rows, segments never straddle a gap
+            edges = [0] + [g - start for g in rows if start < g < start + len(raw)] + [len(raw)]
+            for a, b in zip(edges[:-1], edges[1:]):
+                if a > 0:
+                    for s in stats:
+                        s.reset()
+                for i, s in enumerate(stats):
+                    s.update(data[a:b, i])
+            if start + len(raw) in rows:
+                for s in stats:
+                    s.reset()
+
+    with h5py.File(outpath, 'w') as out:
+        out.attrs['sample_rate'] = fs
+        out.attrs['Lbin'] = Lbin
+        out.attrs['overlapratio'] = overlapratio
+        out.attrs['start_time'] = start_time
+        out.attrs['sources'] = [os.path.basename(p) for p in paths]
+        out.attrs['units'] = 'uT^2/Hz'
+        for ax, s in zip(axes, stats):
+            res = s.result(percentiles)
+            g = out.create_group(ax)
+            g.attrs['count'] = res['count']
+            for key in ('f', 'mean', 'median', 'min', 'max'):
+                g.create_dataset(key, data=res[key])
+            g.create_dataset('percentiles', data=np.array(list(percentiles), dtype=float))
+            g.create_dataset('percentile_psd', data=np.array([res['percentiles'][q] for q in percentiles]))
+            g.create_dataset('ref', data=s.ref if s.ref is not None else np.zeros(0))
+        print(f"psd stats of {stats[0].count} segments saved to {outpath}")
+
+
+def load_psd_stats(path):
+    '''
+    load a file written by psd_stats_run, one dict per axis as returned by SpectralStats.result
+    '''
+    dset = {}
+    with h5py.File(path, 'r') as f:
+        dset['sample_rate'] = f.attrs['sample_rate']
+        dset['Lbin'] = f.attrs['Lbin']
+        for ax in f:
+            g = f[ax]
+            res = {key: g[key][:] for key in ('f', 'mean', 'median', 'min', 'max')}
+            res['count'] = int(g.attrs['count'])
+            res['percentiles'] = dict(zip(g['percentiles'][:].tolist(), g['percentile_psd'][:]))
+            dset[ax] = res
+    return dset
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='PSD statistics',
+        description='Streaming mean, median and percentile PSD of hdf5 magnetometer parts.'
+    )
+    parser.add_argument('outfile', type=str, help='Output hdf5 file')
+    parser.add_argument('parts', type=str, nargs='+', help='Part files in acquisition order')
+    parser.add_argument('-L', '--lbin', type=float, default=100., help='Segment length in s')
+    parser.add_argument('-o', '--overlap', type=float, default=0.5, help='Segment overlap ratio')
+    parser.add_argument('-p', '--percentiles', type=float, nargs='+', default=list(DEFAULT_PERCENTILES),
+                        help='Percentiles to save')
+    parser.add_argument('-n', '--nbins', type=int, default=DEFAULT_NBINS,
+                        help='Histogram bins per frequency')
+    parser.add_argument('--float32', action='store_true', help='Single precision segment psds')
+    parser.add_argument('-a', '--axes', type=str, nargs='+', default=['x', 'y', 'z'], choices=['x', 'y', 'z'],
+                        help='Axes to analyse')
+    parser.add_argument('--max-memory', type=float, default=MAX_SKETCH_BYTES / 1024.**2,
+                        help='MB allowed for the histograms of all axes')
+    args = parser.parse_args()
+
+    psd_stats_run(args.parts, args.outfile, args.lbin, args.overlap, args.axes, percentiles=args.percentiles,
+                  nbins=args.nbins, dtype=np.float32 if args.float32 else np.float64,
+                  max_memory=args.max_memory * 1024**2)
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+Find and repair hdf5 parts left behind by a crashed acquisition.
+
+A part whose writer died (power loss, kill -9) is still flagged as open for
+SWMR writing in its superblock, so h5py refuses to open it for writing. Its
+`end_time` attribute is still the placeholder (the start minute), and rows
+the writer had allocated but not yet filled read back as zeros. Each part is
+validated from its metadata and tail chunks only:
+
+    valid rows   the last row that reads back with any non-zero code, chunks
+                 that fail to read or hold only zeros are the corrupt tail
+    end_time,    rebuilt from the part start and the sample count (valid rows
+    measure_time plus the samples lost in recorded gaps)
+
+Repair copies a flagged part into a clean file (HDF5 object copy, the data
+chunks are not decoded) and replaces it, then trims the corrupt tail (or
+only marks it in the `valid_rows` attribute, which the readers in magio.py
+honor), drops gap and summary rows beyond the valid rows, adds the summary
+of the unsummarized last rows and writes the rebuilt attributes. Parts are
+checked in parallel.
+
+    python recover_parts.py run/                 # check and repair, parts older than MIN_AGE
+    python recover_parts.py run/ -n -o report.json   # report only
+
+The fault-tolerant writer runs a quick pass (only parts whose superblock is
+still flagged open) on its directory before it starts a scan. A SWMR writer
+keeps its part flagged open and holds no HDF5 file lock, so the flag alone
+cannot tell a crashed part from one being written: running writers hold the
+directory's writer lock shared (`writer_lock`, an fcntl lock the kernel
+drops when the process dies) and recovery skips a directory whose lock it
+cannot take exclusively. Parts written within MIN_AGE are never touched.
+"""
+import os
+import json
+import glob
+import time
+import fcntl
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import h5py
+import numpy as np
+from blockstats import BlockSummarizer
+from magio import part_start_unix, TIME_FORMAT
+
+MIN_AGE = 600.          # seconds since the last write before a part is touched
+LOCK_NAME = '.writer.lock'
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+# superblock v2/v3 status flags: file open for writing, for SWMR writing
+WRITE_ACCESS = 0x01
+SWMR_WRITE_ACCESS = 0x04
+
+
+def superblock_open(path):
+    '''
+    True if the superblock says a writer still has the file open (or the
+    superblock has no status flags to tell), from the first 12 bytes
+    '''
+    with open(path, 'rb') as fh:
+        head = fh.read(12)
+    if len(head) < 12 or head[:8] != HDF5_SIGNATURE:
+        return True
+    if head[8] < 2:
+        return True
+    return bool(head[11] & (WRITE_ACCESS | SWMR_WRITE_ACCESS))
+
+
+def writer_lock(savedir, exclusive=False, block=True):
+    '''
+    open fd holding the writer lock of savedir: shared for a running writer,
+    exclusive for recovery; None if not block and another process holds it
+    in a conflicting mode (close the fd to release it)
+    '''
+    fd = os.open(os.path.join(savedir, LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o644)
+    mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    try:
+        fcntl.flock(fd, mode if block else mode | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def find_parts(savedir):
+    return sorted(glob.glob(os.path.join(savedir, '*_part*.hdf5')))
+
+
+def last_valid_row(dset):
+    '''
+    (rows up to the last non-zero row, rows in chunks that failed to read),
+    reading chunks backwards from the end
+    '''
+    step = dset.chunks[0] if dset.chunks else 8192
+    end = dset.shape[0]
+    corrupt = 0
+    while end > 0:
+        start = ((end - 1) // step) * step
+        try:
+            block = dset[start:end]
+        except OSError:
+            corrupt += end - start
+            end = start
+            continue
+        nonzero = np.flatnonzero(block.reshape(len(block), -1).any(axis=1))
+        if len(nonzero):
+            return start + int(nonzero[-1]) + 1, corrupt
+        end = start
+    return 0, corrupt
+
+
+def _str(value):
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def check_part(path):
+    """
+    Validate one part from its metadata and tail chunks.
+
+    Returns:
+        dict: 'part', 'path', 'status' ('ok', 'damaged', 'marked' (tail
+        already marked), 'unreadable', 'skipped'), 'open', 'rows', 'valid_rows', 'corrupt_rows', 'lost',
+        'sample_rate', 'start_time', 'end_time', 'measure_time' and the
+        rebuilt 'end_time_rebuilt', 'measure_time_rebuilt'.
+    """
+    info = {'part': os.path.basename(path), 'path': path, 'status': 'ok', 'open': superblock_open(path)}
+    try:
+        with h5py.File(path, 'r', swmr=True) as f:
+            if 'voltage' not in f:
+                info.update(status='skipped', error='no voltage dataset')
+                return info
+            dset = f['voltage']
+            attrs = dict(dset.attrs)
+            info['rows'] = int(dset.shape[0])
+            info['valid_rows'], info['corrupt_rows'] = last_valid_row(dset)
+            gaps = f['gaps'][:] if 'gaps' in f else None
+    except (OSError, KeyError) as e:
+        info.update(status='unreadable', error=str(e))
+        return info
+
+    valid = info['valid_rows']
+    fs = float(attrs['sample_rate'])
+    lost = 0
+    if gaps is not None and len(gaps) and 'start_sample' in gaps.dtype.names:
+        kept = gaps[gaps['row'] <= valid]
+        lost = int(np.sum(kept['end_sample'] - kept['start_sample']))
+    info['lost'] = lost
+    info['sample_rate'] = fs
+    info['start_time'] = _str(attrs.get('start_time', ''))
+    info['end_time'] = _str(attrs.get('end_time', ''))
+    info['measure_time'] = float(attrs.get('measure_time', np.nan))
+    span = (valid + lost) / fs
+    info['measure_time_rebuilt'] = span
+    try:
+        t0, _ = part_start_unix(attrs)
+        info['end_time_rebuilt'] = time.strftime(TIME_FORMAT, time.localtime(t0 + span))
+    except (KeyError, ValueError):
+        info['end_time_rebuilt'] = info['end_time']
+
+    placeholder = info['end_time'] == info['start_time'] and info['end_time_rebuilt'] != info['start_time']
+    marked = int(attrs.get('valid_rows', -1)) == valid
+    if info['open'] or (valid < info['rows'] and not marked) or placeholder:
+        info['status'] = 'damaged'
+    elif marked and valid < info['rows']:
+        info['status'] = 'marked'
+    return info
+
+
+def _rewrite(path):
+    '''
+    copy a part still flagged open into a new, cleanly closed file and replace it
+    '''
+    tmp = path + '.recover'
+    with h5py.File(path, 'r', swmr=True) as src, h5py.File(tmp, 'w', libver='latest') as dst:
+        for name in src:
+            src.copy(src[name], dst, name=name)
+        for key, value in src.attrs.items():
+            dst.attrs[key] = value
+        dst.flush()
+        os.fsync(dst.id.get_vfd_handle())
+    os.replace(tmp, path)
+
+
+def _fix_summary(f, valid):
+    '''
+    drop summary rows beyond the valid rows and summarize the rows after the
+    last summary block; (rows dropped, rows added)
+    '''
+    dset = f['summary']
+    rows = dset[:]
+    keep = rows[rows['row'] + rows['count'] <= valid]
+    dropped = len(rows) - len(keep)
+    covered = int(keep['row'][-1] + keep['count'][-1]) if len(keep) else 0
+    added = 0
+    if covered < valid:
+        summarizer = BlockSummarizer(f['voltage'].shape[1], int(dset.attrs['blocksize']), covered)
+        new = np.concatenate([summarizer.update(f['voltage'][covered:valid]), summarizer.flush()])
+        keep = np.concatenate([keep, new])
+        added = len(new)
+    dset.resize((len(keep),))
+    if len(keep):
+        dset[...] = keep
+    return dropped, added
+
+
+def repair_part(path, info, trim=True):
+    """
+    Repair a part found damaged by check_part.
+
+    Args:
+        path (str): part file.
+        info (dict): its check_part result, updated and returned.
+        trim (bool): cut the corrupt tail from the dataset; False keeps the
+            rows and records the valid count in the `valid_rows` attribute.
+
+    Returns:
+        dict: info with 'status' 'repaired' or 'marked' ('failed' and
+        'error' if the file could not be written), 'rewritten',
+        'gaps_dropped', 'summary_dropped', 'summary_added'.
+    """
+    valid = info['valid_rows']
+    try:
+        info['rewritten'] = info['open']
+        if info['open']:
+            _rewrite(path)
+        with h5py.File(path, 'r+') as f:
+            dset = f['voltage']
+            if trim and valid < dset.shape[0]:
+                dset.resize((valid,) + dset.shape[1:])
+            elif not trim:
+                dset.attrs['valid_rows'] = valid
+            info['gaps_dropped'] = 0
+            if 'gaps' in f and len(f['gaps']):
+                gaps = f['gaps'][:]
+                keep = gaps[gaps['row'] <= valid]
+                info['gaps_dropped'] = len(gaps) - len(keep)
+                f['gaps'].resize((len(keep),))
+                if len(keep):
+                    f['gaps'][...] = keep
+            info['summary_dropped'], info['summary_added'] = _fix_summary(f, valid) if 'summary' in f else (0, 0)
+            dset.attrs['end_time'] = info['end_time_rebuilt']
+            dset.attrs['measure_time'] = info['measure_time_rebuilt']
+            dset.attrs['recovered'] = time.strftime(TIME_FORMAT, time.localtime())
+            dset.attrs['recovered_rows'] = info['rows'] - valid
+    except (OSError, KeyError) as e:
+        info.update(status='failed', error=str(e))
+        return info
+    info['status'] = 'marked' if not trim and valid < info['rows'] else 'repaired'
+    return info
+
+
+def recover_part(path, repair=True, trim=True, min_age=MIN_AGE):
+    '''
+    check_part, then repair_part if damaged; parts written within min_age
+    seconds are left alone (status 'recent'), they may belong to a running scan
+    '''
+    if time.time() - os.path.getmtime(path) < min_age:
+        return {'part': os.path.basename(path), 'path': path, 'status': 'recent'}
+    info = check_part(path)
+    if repair and info['status'] == 'damaged':
+        info = repair_part(path, info, trim)
+    return info
+
+
+def recover_parts(paths, repair=True, trim=True, min_age=MIN_AGE, workers=None):
+    """
+    Check (and repair) parts, one worker process per part.
+
+    Returns:
+        list[dict]: recover_part results in the order of paths
+    """
+    if workers == 1 or len(paths) <= 1:
+        return [recover_part(p, repair, trim, min_age) for p in paths]
+    n = len(paths)
+    # spawn: the acquisition calls this from a thread of the supervisor
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return list(pool.map(recover_part, paths, [repair] * n, [trim] * n, [min_age] * n))
+
+
+def recover_dir(savedir, quick=False, repair=True, trim=True, min_age=MIN_AGE, workers=None):
+    '''
+    recover_parts on the parts of a directory under its exclusive writer
+    lock, nothing is touched while a writer holds it; quick only checks parts
+    whose superblock is still flagged open (a few bytes read per clean part)
+    '''
+    lock = writer_lock(savedir, exclusive=True, block=False)
+    if lock is None:
+        print(f"{savedir}: a writer is running, parts not checked")
+        return []
+    try:
+        paths = find_parts(savedir)
+        if quick:
+            paths = [p for p in paths if superblock_open(p)]
+        results = recover_parts(paths, repair, trim, min_age, workers)
+    finally:
+        os.close(lock)
+    for info in results:
+        if info['status'] != 'ok':
+            print(format_result(info))
+    return results
+
+
+def format_result(info):
+    line = f"{info['part']}: {info['status']}"
+    if 'valid_rows' in info and 'end_time_rebuilt' in info:
+        line += (f", {info['valid_rows']} of {info['rows']} rows valid ({info['corrupt_rows']} unreadable)"
+                 f", end_time {info['end_time']} -> {info['end_time_rebuilt']}"
+                 f", measure_time {info['measure_time_rebuilt']:.1f} s")
+    if 'error' in info:
+        line += f" ({info['error']})"
+    return line
+
+
+def status_counts(results):
+    return {s: sum(r['status'] == s for r in results) for s in sorted({r['status'] for r in results})}
+
+
+def save_report(path, results):
+    report = {'date': time.strftime(TIME_FORMAT, time.localtime()), 'parts': results,
+              'counts': status_counts(results)}
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Recover parts',
+        description='Validate hdf5 parts after a crash, trim corrupt tails and rebuild end_time/measure_time.'
+    )
+    parser.add_argument('paths', type=str, nargs='+', help='Directories of parts or part files')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='Only report damaged parts')
+    parser.add_argument('-m', '--mark', action='store_true',
+                        help='Keep corrupt tail rows, record valid_rows instead of trimming')
+    parser.add_argument('-q', '--quick', action='store_true', help='Only parts still flagged open')
+    parser.add_argument('-a', '--min-age', type=float, default=MIN_AGE,
+                        help='Skip parts written less than this many seconds ago')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='Worker processes')
+    parser.add_argument('-o', '--out', type=str, default=None, help='Write the JSON report here')
+    args = parser.parse_args()
+
+    paths = []
+    for p in args.paths:
+        paths += find_parts(p) if os.path.isdir(p) else [p]
+    if args.quick:
+        paths = [p for p in paths if superblock_open(p)]
+    # hold the writer lock of every directory, skip those with a running writer
+    locks, busy = {}, set()
+    for d in sorted({os.path.dirname(os.path.abspath(p)) for p in paths}):
+        locks[d] = writer_lock(d, exclusive=True, block=False)
+        if locks[d] is None:
+            print(f"{d}: a writer is running, parts skipped")
+            busy.add(d)
+    paths = [p for p in paths if os.path.dirname(os.path.abspath(p)) not in busy]
+    t = time.perf_counter()
+    results = recover_parts(paths, not args.dry_run, not args.mark, args.min_age, args.workers)
+    for fd in locks.values():
+        if fd is not None:
+            os.close(fd)
+    for info in results:
+        print(format_result(info))
+    if args.out:
+        save_report(args.out, results)
+    print(f"{len(results)} parts in {time.perf_counter() - t:.2f} s: "
+          + ', '.join(f"{n} {s}" for s, n in status_counts(results).items()))
@@ -3,6 +3,7 @@ import os
 import time
 from daqhats import mcc128, OptionFlags, HatIDs, HatError, AnalogInputMode, AnalogInputRange
 from daqhats_utils import select_hat_device, chan_list_to_mask
+from hatread import ScanBuffer, read_numpy
 import argparse
 import h5py
 import numpy as np
@@ -51,7 +52,8 @@ def continuous_scan_and_dump(channels, scan_rate, t_measure, filename, chunksize
         dset.attrs['sample_rate'] = scan_rate
         dset.attrs['start_time'] = time.strftime("%Y_%m_%d_%H_%M", time.localtime())
         dset.attrs['measure_time'] = t_measure
-        buffer = []
+        # reads are cast into preallocated rows, written every chunksize rows
+        buffer = ScanBuffer(num_channels, 2 * chunksize)
         try:
             address = select_hat_device(HatIDs.MCC_128)
             hat = mcc128(address)
@@ -68,7 +70,7 @@ def continuous_scan_and_dump(channels, scan_rate, t_measure, filename, chunksize
             start_time = time.time()
 
             while True:
-                read_result = hat.a_in_scan_read(read_request_size, timeout)
+                read_result = read_numpy(hat, read_request_size, timeout)
 
                 if read_result.hardware_overrun:
                     print("\nHardware overrun!")
@@ -77,22 +79,16 @@ def continuous_scan_and_dump(channels, scan_rate, t_measure, filename, chunksize
                     print("\nBuffer overrun!")
                     break
 
-                block = np.array(read_result.data,dtype=np.uint16)
-                samples_read_per_channel = int(len(block) / num_channels)
-
-                block = block.reshape((samples_read_per_channel, num_channels))
-
-                buffer.append(block)
+                buffer.append(read_result.data)
 
                 # flush when buffer large enough
-                total = sum(b.shape[0] for b in buffer)
-                if total >= chunksize:
-                    combined = np.vstack(buffer)
+                if len(buffer) >= chunksize:
+                    combined = buffer.view()
                     old = dset.shape[0]
                     dset.resize((old + combined.shape[0], num_channels))
                     dset[old:,:] = combined
                     f.flush()
-                    buffer = []
+                    buffer.clear()
 
                 if time.time() - start_time >= t_measure:
                     print("Measurement complete.")
@@ -103,7 +99,7 @@ def continuous_scan_and_dump(channels, scan_rate, t_measure, filename, chunksize
 
             # final flush
             if buffer:
-                combined = np.vstack(buffer)
+                combined = buffer.view()
                 old = dset.shape[0]
                 new = old + combined.shape[0]
                 dset.resize((new, len(channels)))
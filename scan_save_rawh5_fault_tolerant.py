@@ -2,34 +2,23 @@
 import os
 import sys
 import time
-import signal
 import argparse
 import h5py
 import numpy as np
 from daqhats import mcc128, OptionFlags, HatIDs, HatError, AnalogInputMode, AnalogInputRange
 from daqhats_utils import select_hat_device, chan_list_to_mask
+from scan_tuning import measure_writer_latency, plan_scan, ReadCadence
+from blockstats import BlockSummarizer, create_summary, append_summary
+from hatread import ScanBuffer, read_numpy, READ_ALL_AVAILABLE
+from magio import PART_GAP_DTYPE
+from partwriter import CHUNK_DURATION, DEFAULT_CHUNKSIZE, safe_fsync, register_signal_handlers, \
+    create_voltage, stamp_end_time
 
 # Global handles for cleanup
 _HAT = None
 _FILE = None
 _DSET = None
 
-# Constants
-READ_ALL_AVAILABLE = -1
-CHUNK_DURATION = 3600.0  # seconds per file
-DEFAULT_CHUNKSIZE = 8192
-
-
-def safe_fsync(h5file):
-    """
-    Attempt to fsync the underlying file descriptor of an HDF5 File.
-    """
-    try:
-        fd = h5file.id.get_vfd_handle()
-        os.fsync(fd)
-    except Exception as e:
-        print(f"Warning: fsync failed: {e}")
-
 
 def on_exit(signum, frame):
     """
@@ -55,16 +44,10 @@ def on_exit(signum, frame):
     sys.exit(0)
 
 
-def register_signal_handlers():
-    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGPWR):
-        try:
-            signal.signal(sig, on_exit)
-        except (AttributeError, RuntimeError):
-            # Some signals may not exist
-            pass
-
-
-def continuous_scan_with_rotation(channels, scan_rate, total_time, savedir, prefix, chunksize=DEFAULT_CHUNKSIZE):
+def continuous_scan_with_rotation(channels, scan_rate, total_time, savedir, prefix, chunksize=DEFAULT_CHUNKSIZE,
+                                  trigger=False, metrics=None, tuned=False, resilient=False,
+                                  stop_event=None, on_block=None, time_base=None, handle_signals=True,
+                                  recover=True):
     """
     Continuous acquisition with hourly HDF5 rotation, SWMR mode,
     and immediate flush+fsync for crash resilience.
@@ -75,10 +58,36 @@ def continuous_scan_with_rotation(channels, scan_rate, total_time, savedir, pref
         total_time (float): total run time in seconds
         savedir (str): output directory
         prefix (str): filename prefix (e.g. 'mag_2025_07_16_12_00')
+        trigger (bool): run the glitch trigger on written blocks (on its own
+            thread) and store events in '<prefix>_events.hdf5'
+        metrics (metrics.AcquisitionMetrics): updated with read, write and
+            flush/fsync statistics if given
+        tuned (bool): size the scan buffer and read chunk-aligned blocks
+            from the measured writer latency (see scan_tuning.py)
+        resilient (bool): restart the scan after an overrun and record the
+            gap in the 'gaps' table of the current part instead of stopping
+        stop_event (threading.Event): end the run cleanly once set
+        on_block (callable): called with a copy of every block of codes
+            written, must not block (see supervisor.py)
+        time_base (supervisor.TimeBase): shared run clock stored in the part attrs
+        handle_signals (bool): install the SIGTERM/SIGINT/SIGPWR handlers;
+            False when a supervisor runs the scan in a thread
+        recover (bool): first repair parts in savedir that an earlier crashed
+            run left open, unless another writer is running there (see
+            recover_parts.py)
     """
     global _HAT, _FILE, _DSET
 
     os.makedirs(savedir, exist_ok=True)
+    from recover_parts import recover_dir, save_report, writer_lock
+    if recover:
+        # only parts still flagged open are opened, a clean directory costs a few bytes per part;
+        # skipped while another writer holds the directory lock, recent parts are never touched
+        recovered = recover_dir(savedir, quick=True)
+        if recovered:
+            save_report(os.path.join(savedir, 'logs', f"{prefix}_recovery.json"), recovered)
+    # held until the last part is closed, recovery leaves the directory alone meanwhile
+    lock = writer_lock(savedir)
     channel_mask = chan_list_to_mask(channels)
     num_channels = len(channels)
     options = OptionFlags.CONTINUOUS | OptionFlags.NOCALIBRATEDATA | OptionFlags.NOSCALEDATA
@@ -86,7 +95,8 @@ def continuous_scan_with_rotation(channels, scan_rate, total_time, savedir, pref
     input_range = AnalogInputRange.BIP_10V
 
     # Register cleanup handlers
-    register_signal_handlers()
+    if handle_signals:
+        register_signal_handlers(on_exit)
 
     # Connect to device
     address = select_hat_device(HatIDs.MCC_128)
@@ -105,61 +115,140 @@ def continuous_scan_with_rotation(channels, scan_rate, total_time, savedir, pref
     def open_new_file(idx):
         filename = os.path.join(savedir, f"{prefix}_part{idx}.hdf5")
         f = h5py.File(filename, "w", libver="latest", swmr=True)
+        dset = create_voltage(f, num_channels, chunksize, scan_rate, total_time)
+        if time_base is not None:
+            dset.attrs['time_base'] = time_base.unix0
+            dset.attrs['part_start'] = time_base.now()
+        # all objects exist before SWMR starts so readers see them
+        f.create_dataset("gaps", shape=(0,), maxshape=(None,), chunks=(64,), dtype=PART_GAP_DTYPE)
+        create_summary(f, num_channels, summary_block, scan_rate)
         f.swmr_mode = True
-        dset = f.create_dataset(
-            "voltage", shape=(0, num_channels), maxshape=(None, num_channels),
-            chunks=(chunksize, num_channels), dtype="uint16"
-        )
-        # Metadata
-        dset.attrs['dtype'] = 'uint16'
-        dset.attrs['sample_rate'] = scan_rate
-        start_ts = time.strftime("%Y_%m_%d_%H_%M", time.localtime())
-        dset.attrs['start_time'] = start_ts
-        dset.attrs['measure_time'] = min(CHUNK_DURATION, total_time)
-        # Pre-create end_time attribute for safe SWMR updates
-        dset.attrs['end_time'] = start_ts  # placeholder
         return f, dset
 
+    # one summary row (count, mean, M2, min, max per channel) per second of rows
+    summary_block = max(int(round(scan_rate)), 1)
+
     # Open initial file
     f, dset = open_new_file(file_count)
+    summarizer = BlockSummarizer(num_channels, summary_block)
     _FILE, _DSET = f, dset
-    buffer = []
+    # reads land in preallocated rows, flushed once chunksize rows are in
+    buffer = ScanBuffer(num_channels, 2 * chunksize)
+
+    events = None
+    if trigger:
+        # imported here, the analysis stack is not needed for plain acquisition;
+        # the trigger runs on its own thread, its medians would delay the next read
+        from trigger import GlitchTrigger, EventStore, TriggerThread
+        events = TriggerThread(EventStore(os.path.join(savedir, f"{prefix}_events.hdf5"),
+                                          GlitchTrigger(scan_rate, num_channels)))
+        events.add_part(os.path.basename(f.filename))
+        events.start()
+
+    def write_block(combined):
+        old = dset.shape[0]
+        dset.resize((old + combined.shape[0], num_channels))
+        dset[old:, :] = combined
+        append_summary(f['summary'], summarizer.update(combined))
+        if on_block is not None or events is not None:
+            # the read buffer is reused after the flush
+            block = combined.copy()
+            if on_block is not None:
+                on_block(block)
+            if events is not None:
+                events.feed(block)
+
+    def flush_buffer():
+        combined = buffer.view()
+        write_block(combined)
+        t_flush = time.perf_counter()
+        f.flush()
+        t_fsync = time.perf_counter()
+        safe_fsync(f)
+        if metrics is not None:
+            metrics.observe_write(combined.nbytes, t_fsync - t_flush, time.perf_counter() - t_fsync)
+        buffer.clear()
+
+    # Scan buffer and read size
+    samples_per_channel = 0
+    read_size, timeout = READ_ALL_AVAILABLE, 5.0
+    cadence = None
+    if tuned:
+        latency = measure_writer_latency(savedir, num_channels, chunksize)
+        plan = plan_scan(actual_rate, num_channels, chunksize, latency)
+        cadence = ReadCadence(plan)
+        samples_per_channel = plan['buffer']
+        print(f"Tuned scan: writer latency {latency * 1000:.1f} ms, buffer {plan['buffer']}, "
+              f"read block {plan['block']} every {plan['period']:.2f} s")
+
+    def record_gap(cause):
+        nonlocal scan_t0, scan_samples, part_lost
+        # everything read before the overrun goes to disk first
+        if buffer:
+            flush_buffer()
+        hat.a_in_scan_stop()
+        hat.a_in_scan_cleanup()
+        hat.a_in_scan_start(channel_mask, samples_per_channel, scan_rate, options)
+        t_restart = time.time()
+        lost = max(int(round((t_restart - scan_t0) * actual_rate)) - scan_samples, 0)
+        row = dset.shape[0]
+        gap = np.zeros(1, dtype=PART_GAP_DTYPE)
+        gap['row'] = row
+        gap['start_sample'] = row + part_lost
+        gap['end_sample'] = row + part_lost + lost
+        gap['t_start'] = scan_t0 + scan_samples / actual_rate
+        gap['t_end'] = t_restart
+        gap['cause'] = cause
+        gaps = f['gaps']
+        gaps.resize((gaps.shape[0] + 1,))
+        gaps[-1:] = gap
+        f.flush()
+        safe_fsync(f)
+        part_lost += lost
+        scan_t0, scan_samples = t_restart, 0
+        print(f"Scan restarted after {cause} overrun, ~{lost} samples lost at row {row}.")
 
     # Start scan
-    hat.a_in_scan_start(channel_mask, 0, scan_rate, options)
+    hat.a_in_scan_start(channel_mask, samples_per_channel, scan_rate, options)
+    scan_t0, scan_samples, part_lost = time.time(), 0, 0
     print("Scan started. Acquiring...")
+    if metrics is not None:
+        metrics.scan_buffer_samples = hat.a_in_scan_buffer_size()
 
     try:
         while True:
             # Read raw data
-            result = hat.a_in_scan_read(READ_ALL_AVAILABLE, timeout=5.0)
-            if result.hardware_overrun:
-                print("\nHardware overrun!")
-                break
-            if result.buffer_overrun:
-                print("\nBuffer overrun!")
-                break
-
-            block = np.array(result.data, dtype=np.uint16)
-            rows = block.size // num_channels
-            block = block.reshape((rows, num_channels))
-            buffer.append(block)
+            if cadence is not None:
+                read_size, timeout = cadence.block, cadence.timeout
+            result = read_numpy(hat, read_size, timeout)
+            if metrics is not None:
+                metrics.observe_overrun(result.hardware_overrun, result.buffer_overrun)
+            if result.hardware_overrun or result.buffer_overrun:
+                cause = 'hardware' if result.hardware_overrun else 'buffer'
+                print(f"\n{cause.capitalize()} overrun!")
+                if not resilient:
+                    break
+                # then on to the rotation, duration and stop checks, overruns may keep coming
+                record_gap(cause)
+            else:
+                rows = len(buffer.append(result.data))
+                scan_samples += rows
+                backlog = rows
+                if cadence is not None:
+                    backlog = hat.a_in_scan_status().samples_available
+                    cadence.update(backlog)
+                if metrics is not None:
+                    metrics.observe_read(rows, backlog)
 
             # Rotate file if needed
             now = time.time()
             if now >= next_rotate:
                 # Flush current buffer
                 if buffer:
-                    combined = np.vstack(buffer)
-                    old = dset.shape[0]
-                    dset.resize((old + combined.shape[0], num_channels))
-                    dset[old:, :] = combined
-                    f.flush()
-                    safe_fsync(f)
-                    buffer.clear()
+                    flush_buffer()
                 # Close old file cleanly
-                end_ts = time.strftime("%Y_%m_%d_%H_%M", time.localtime())
-                dset.attrs['end_time'] = end_ts
+                append_summary(f['summary'], summarizer.flush())
+                stamp_end_time(dset)
                 f.flush()
                 safe_fsync(f)
                 f.close()
@@ -169,22 +258,24 @@ def continuous_scan_with_rotation(channels, scan_rate, total_time, savedir, pref
                 next_rotate += CHUNK_DURATION
                 f, dset = open_new_file(file_count)
                 _FILE, _DSET = f, dset
+                summarizer = BlockSummarizer(num_channels, summary_block)
+                part_lost = 0
+                if metrics is not None:
+                    metrics.current_part = file_count
+                if events is not None:
+                    events.add_part(os.path.basename(f.filename))
 
             # Write if buffer large
-            total_buf = sum(b.shape[0] for b in buffer)
-            if total_buf >= chunksize:
-                combined = np.vstack(buffer)
-                old = dset.shape[0]
-                dset.resize((old + combined.shape[0], num_channels))
-                dset[old:, :] = combined
-                f.flush()
-                safe_fsync(f)
-                buffer.clear()
+            if len(buffer) >= chunksize:
+                flush_buffer()
 
             # Check total duration
             if now - start_time >= total_time:
                 print("Measurement complete.")
                 break
+            if stop_event is not None and stop_event.is_set():
+                print("Stop requested.")
+                break
 
     except (HatError, ValueError) as err:
         print("\nError during acquisition:", err)
@@ -195,16 +286,16 @@ def continuous_scan_with_rotation(channels, scan_rate, total_time, savedir, pref
         hat.a_in_scan_cleanup()
         # Final flush
         if buffer:
-            combined = np.vstack(buffer)
-            old = dset.shape[0]
-            dset.resize((old + combined.shape[0], num_channels))
-            dset[old:, :] = combined
+            flush_buffer()
+        if events is not None:
+            events.close()
+        append_summary(f['summary'], summarizer.flush())
         # Update end_time on final file
-        end_ts = time.strftime("%Y_%m_%d_%H_%M", time.localtime())
-        dset.attrs['end_time'] = end_ts
+        stamp_end_time(dset)
         f.flush()
         safe_fsync(f)
         f.close()
+        os.close(lock)
         print(f"Data saved to parts 0–{file_count} in {savedir}")
 
 
@@ -218,8 +309,31 @@ if __name__ == '__main__':
                         help='Total record time in seconds')
     parser.add_argument('-s', '--scanrate', type=float, default=1000.0,
                         help='Requested scan rate (S/s)')
+    parser.add_argument('--trigger', action='store_true',
+                        help='Run the glitch trigger during acquisition')
+    parser.add_argument('--resilient', action='store_true',
+                        help='Restart the scan after overruns and record gaps instead of stopping')
+    parser.add_argument('--tuned', action='store_true',
+                        help='Size scan buffer and read blocks from the measured writer latency')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve live metrics at http://127.0.0.1:<port>/metrics')
+    parser.add_argument('--metrics-file', type=str, default=None,
+                        help='Append metrics snapshots (JSON lines) to this file every 10 s')
+    parser.add_argument('--no-recover', action='store_true',
+                        help='Do not repair crashed parts in savedir before starting')
     args = parser.parse_args()
 
+    metrics = None
+    if args.metrics_port is not None or args.metrics_file is not None:
+        from metrics import AcquisitionMetrics, serve_metrics, MetricsFileWriter
+        metrics = AcquisitionMetrics(args.savedir)
+        if args.metrics_port is not None:
+            serve_metrics(metrics, args.metrics_port)
+        if args.metrics_file is not None:
+            MetricsFileWriter(metrics, args.metrics_file).start()
+
     ts = time.strftime("%Y_%m_%d_%H_%M", time.localtime())
     continuous_scan_with_rotation([0,1,4], args.scanrate, args.time,
-                                  args.savedir, f"mag_{ts}")
+                                  args.savedir, f"mag_{ts}", trigger=args.trigger,
+                                  metrics=metrics, tuned=args.tuned, resilient=args.resilient,
+                                  recover=not args.no_recover)
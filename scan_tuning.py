@@ -0,0 +1,145 @@
+"""
+Scan buffer and read cadence tuning for continuous HAT acquisition.
+
+Instead of `samples_per_channel=0` (library-chosen host buffer) and
+`READ_ALL_AVAILABLE` in a tight loop, a tuned scan reads fixed blocks that
+tile the hdf5 chunks, so every read blocks in the library until a whole
+block is ready and every write fills whole chunks. The host buffer is sized
+to cover two read periods plus the worst measured writer latency with a
+safety factor. `ReadCadence` grows the read block when the backlog left
+after a read eats into the buffer headroom, and shrinks it back once the
+headroom recovers.
+"""
+import os
+import time
+import tempfile
+import h5py
+import numpy as np
+
+TARGET_PERIOD = 0.5       # seconds between reads aimed for
+SAFETY = 4.0              # multiples of the writer latency kept in the buffer
+MIN_BUFFER = 1000         # samples per channel, daqhats lower bound
+MIN_BLOCKS = 8            # read blocks the scan buffer holds at least
+LOW_HEADROOM = 0.5        # grow the read block below this buffer headroom
+HIGH_HEADROOM = 0.9       # shrink back above this headroom
+RECOVER_READS = 20        # reads with high headroom before shrinking
+
+
+def measure_writer_latency(savedir, num_channels, chunksize, trials=5):
+    """
+    Time chunk-sized SWMR appends with flush+fsync in a scratch file.
+
+    Args:
+        savedir (str): directory on the target file system.
+        num_channels (int): columns per row.
+        chunksize (int): rows per write.
+        trials (int): number of writes timed.
+
+    Returns:
+        float: the slowest write in seconds.
+    """
+    fd, path = tempfile.mkstemp(suffix='.hdf5', dir=savedir)
+    os.close(fd)
+    block = np.zeros((chunksize, num_channels), dtype=np.uint16)
+    worst = 0.0
+    try:
+        with h5py.File(path, 'w', libver='latest') as f:
+            dset = f.create_dataset('voltage', shape=(0, num_channels), maxshape=(None, num_channels),
+                                    chunks=(chunksize, num_channels), dtype='uint16')
+            f.swmr_mode = True
+            for _ in range(trials):
+                t = time.perf_counter()
+                old = dset.shape[0]
+                dset.resize((old + chunksize, num_channels))
+                dset[old:, :] = block
+                f.flush()
+                os.fsync(f.id.get_vfd_handle())
+                worst = max(worst, time.perf_counter() - t)
+    finally:
+        os.remove(path)
+    return worst
+
+
+def chunk_aligned_block(rows, chunksize):
+    '''
+    nearest block size to rows that is a multiple of chunksize or a power-of-two divisor of it
+    '''
+    if rows >= chunksize:
+        return chunksize * max(int(round(rows / chunksize)), 1)
+    block = chunksize
+    while block > 1 and block // 2 >= rows and chunksize % (block // 2) == 0:
+        block //= 2
+    return block
+
+
+def plan_scan(scan_rate, num_channels, chunksize=8192, writer_latency=0.05,
+              target_period=TARGET_PERIOD, safety=SAFETY):
+    """
+    Work out the scan buffer and read block from rate, channels and writer latency.
+
+    Args:
+        scan_rate (float): samples per second per channel.
+        num_channels (int): number of scanned channels.
+        chunksize (int): rows per hdf5 chunk.
+        writer_latency (float): worst flush+fsync time of one write in seconds.
+        target_period (float): aimed time between reads in seconds.
+        safety (float): writer latencies the buffer must absorb on top of a read period.
+
+    Returns:
+        dict: 'buffer' (samples_per_channel for a_in_scan_start), 'block'
+        (samples per channel per read), 'period' (s between reads),
+        'timeout' (s for a_in_scan_read), 'max_block'.
+    """
+    block = chunk_aligned_block(max(int(scan_rate * target_period), 1), chunksize)
+    period = block / scan_rate
+    # two blocks in flight plus the writer stall margin, and room for
+    # ReadCadence to double the block
+    buffer = int(np.ceil(scan_rate * (2 * period + safety * writer_latency)))
+    buffer = max(buffer, MIN_BUFFER, MIN_BLOCKS * block)
+    buffer = int(np.ceil(buffer / block)) * block
+    plan = {}
+    plan['buffer'] = buffer
+    plan['block'] = block
+    plan['period'] = period
+    plan['timeout'] = 2 * period + 5.0
+    plan['max_block'] = max(block, (buffer // 4) // block * block)
+    plan['num_channels'] = num_channels
+    plan['writer_latency'] = writer_latency
+    return plan
+
+
+class ReadCadence:
+    """
+    Adapts the read block to the measured backlog.
+
+    Call update() after every read with the samples per channel still
+    available in the scan buffer (a_in_scan_status().samples_available).
+    """
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.base = plan['block']
+        self.block = plan['block']
+        self.buffer = plan['buffer']
+        self.min_headroom = 1.0
+        self._good = 0
+
+    @property
+    def timeout(self):
+        return self.plan['timeout'] * self.block / self.base
+
+    def update(self, backlog):
+        headroom = 1.0 - backlog / self.buffer
+        self.min_headroom = min(self.min_headroom, headroom)
+        if headroom < LOW_HEADROOM and self.block < self.plan['max_block']:
+            self.block = min(self.block * 2, self.plan['max_block'])
+            self._good = 0
+            print(f"Scan headroom {headroom:.0%}, read block -> {self.block}")
+        elif headroom > HIGH_HEADROOM and self.block > self.base:
+            self._good += 1
+            if self._good >= RECOVER_READS:
+                self.block = max(self.block // 2, self.base)
+                self._good = 0
+        else:
+            self._good = 0
+        return headroom
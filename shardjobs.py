@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+"""
+Sharded spectral jobs coordinated through a shared directory.
+
+A job directory holds the catalog (`job.json`, one work unit per part) and
+everything the workers need to cooperate without any service:
+
+    job.json               task, parameters, units (part paths relative to the job)
+    locks/<unit>.lock      claim, created with O_CREAT|O_EXCL; its mtime is the
+                           heartbeat of the owning worker
+    results/<unit>.hdf5    result, written to a temporary name and renamed,
+                           so it is either complete or absent
+    failed/<unit>.*.json   one record per failed attempt
+
+Any number of workers on any hosts that mount the directory run
+`python shardjobs.py work <jobdir>`. A worker skips units with a result,
+claims a free unit, refreshes the lock while it computes and removes it
+after the result is in place. Locks not refreshed for `stale` seconds (as
+seen on the filesystem clock, so host clocks need not agree) belong to
+crashed workers: they are taken over by an atomic rename, exactly one
+worker wins. Results are idempotent, a unit finished twice by a worker that
+was wrongly declared dead is just written twice.
+
+    python shardjobs.py create job/ campaign/run*/mag_*_part*.hdf5 -L 100
+    python shardjobs.py work job/ -n 4          # on every host
+    python shardjobs.py status job/
+    python shardjobs.py merge job/ stack.hdf5   # sums the partial PSDs
+
+Tasks: 'psd' (segment PSD sums and quality table per part, stacking.py) and
+'bandpower' (band RMS series per part, bandpower.py).
+"""
+import os
+import sys
+import json
+import time
+import socket
+import zlib
+import argparse
+import threading
+import traceback
+import multiprocessing
+import numpy as np
+
+HEARTBEAT = 10.         # seconds between lock refreshes
+STALE = 120.            # lock age after which its worker is presumed dead
+MAX_ATTEMPTS = 3        # failed attempts before a unit is given up
+
+
+#################################################
+# Tasks
+#################################################
+
+def _task_psd(path, out, params):
+    import h5py
+    from stacking import stack_part, DEFAULT_BANDS
+    res = stack_part(path, params['Lbin'], params.get('overlapratio', 0.5),
+                     tuple(params.get('axes', ('x', 'y', 'z'))), params.get('bands', DEFAULT_BANDS),
+                     params.get('max_gaps', 0), params.get('weighting', 'inverse'), params.get('ref_band', -1))
+    with h5py.File(out, 'w') as f:
+        for key in ('f', 'sum', 'wsum', 'weight'):
+            f.create_dataset(key, data=res[key])
+        f.create_dataset('table', data=res['table'])
+        f.attrs['count'] = res['count']
+        f.attrs['sample_rate'] = res['fs']
+
+
+def _task_bandpower(path, out, params):
+    from bandpower import band_power_run, DEFAULT_BANDS
+    band_power_run([path], out, params.get('bands', DEFAULT_BANDS), params.get('interval', 1.0),
+                   params.get('segment'))
+
+
+TASKS = {'psd': _task_psd, 'bandpower': _task_bandpower}
+
+
+#################################################
+# Job catalog
+#################################################
+
+def unit_id(index, path):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return f"{index:05d}_{stem}"
+
+
+def create_job(jobdir, parts, task='psd', **params):
+    """
+    Write the catalog of a job, one unit per part.
+
+    Args:
+        jobdir (str): shared job directory.
+        parts (list[str]): part files, stored relative to jobdir.
+        task (str): key of TASKS.
+        params: task parameters (JSON serializable).
+
+    Returns:
+        dict: the catalog
+    """
+    if task not in TASKS:
+        raise ValueError(f"unknown task {task}, one of {sorted(TASKS)}")
+    for sub in ('locks', 'results', 'failed', 'clock'):
+        os.makedirs(os.path.join(jobdir, sub), exist_ok=True)
+    units = [{'id': unit_id(i, p), 'path': os.path.relpath(os.path.abspath(p), os.path.abspath(jobdir))}
+             for i, p in enumerate(parts)]
+    job = {'task': task, 'params': params, 'units': units, 'created': time.time()}
+    path = os.path.join(jobdir, 'job.json')
+    if os.path.exists(path):
+        old = load_job(jobdir)
+        if old['task'] != task or old['units'] != units or old['params'] != json.loads(json.dumps(params)):
+            raise ValueError(f"{path} exists with a different catalog")
+        return old
+    tmp = path + f".tmp{os.getpid()}"
+    with open(tmp, 'w') as f:
+        json.dump(job, f, indent=1)
+    os.replace(tmp, path)
+    return job
+
+
+def load_job(jobdir):
+    with open(os.path.join(jobdir, 'job.json')) as f:
+        return json.load(f)
+
+
+def _paths(jobdir, uid):
+    return (os.path.join(jobdir, 'locks', uid + '.lock'),
+            os.path.join(jobdir, 'results', uid + '.hdf5'))
+
+
+def fs_now(jobdir, worker):
+    '''
+    current time of the shared filesystem: mtime of a file this worker just touched
+    '''
+    probe = os.path.join(jobdir, 'clock', worker)
+    with open(probe, 'w'):
+        pass
+    return os.stat(probe).st_mtime
+
+
+def _attempts(jobdir, uid):
+    prefix = uid + '.'
+    return sum(name.startswith(prefix) for name in os.listdir(os.path.join(jobdir, 'failed')))
+
+
+#################################################
+# Claiming
+#################################################
+
+def claim(lock, owner):
+    '''
+    create the lock exclusively, False if another worker holds it
+    '''
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        json.dump(owner, f)
+    return True
+
+
+def break_stale(lock, now, stale, worker):
+    '''
+    take over a lock not refreshed for `stale` seconds; the rename is atomic,
+    only one of several workers breaking the same lock succeeds
+    '''
+    try:
+        if now - os.stat(lock).st_mtime < stale:
+            return False
+        grave = f"{lock}.stale.{worker}"
+        os.rename(lock, grave)
+    except FileNotFoundError:
+        return False
+    os.remove(grave)
+    print(f"{worker}: recovered stale lock {os.path.basename(lock)}")
+    return True
+
+
+class Heartbeat(threading.Thread):
+    """
+    Refreshes the mtime of a held lock. The lock is identified by its inode:
+    if it was taken over (and maybe claimed again by another worker) `lost`
+    is set and the lock is left alone; the result is still written, results
+    are idempotent.
+    """
+
+    def __init__(self, lock, interval=HEARTBEAT):
+        super().__init__(daemon=True)
+        self.lock = lock
+        self.interval = interval
+        self.inode = os.stat(lock).st_ino
+        self.lost = False
+        self._done = threading.Event()
+
+    def owned(self):
+        try:
+            return os.stat(self.lock).st_ino == self.inode
+        except FileNotFoundError:
+            return False
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            if not self.owned():
+                self.lost = True
+                return
+            os.utime(self.lock)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.lost = self.lost or not self.owned()
+
+
+#################################################
+# Workers
+#################################################
+
+def run_unit(jobdir, job, unit, worker, heartbeat=HEARTBEAT):
+    '''
+    compute one claimed unit into its result file
+    '''
+    lock, result = _paths(jobdir, unit['id'])
+    beat = Heartbeat(lock, heartbeat)
+    beat.start()
+    t = time.perf_counter()
+    try:
+        tmp = f"{result}.tmp.{worker}"
+        TASKS[job['task']](os.path.join(jobdir, unit['path']), tmp, job['params'])
+        os.replace(tmp, result)
+    except Exception as e:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        record = {'unit': unit['id'], 'worker': worker, 'error': repr(e), 'traceback': traceback.format_exc(),
+                  'time': time.time()}
+        with open(os.path.join(jobdir, 'failed', f"{unit['id']}.{worker}.{int(time.time())}.json"), 'w') as f:
+            json.dump(record, f, indent=1)
+        print(f"{worker}: {unit['id']} failed: {e!r}")
+        return False
+    finally:
+        beat.stop()
+        if not beat.lost:
+            try:
+                os.remove(lock)
+            except FileNotFoundError:
+                pass
+    lost = ' (lock was taken over)' if beat.lost else ''
+    print(f"{worker}: {unit['id']} done in {time.perf_counter() - t:.1f} s{lost}")
+    return True
+
+
+def run_worker(jobdir, worker=None, stale=STALE, max_units=None, max_attempts=MAX_ATTEMPTS):
+    """
+    Claim and process units until none is left.
+
+    Args:
+        jobdir (str): job directory.
+        worker (str): worker name, default host-pid.
+        stale (float): lock age in s after which it is taken over.
+        max_units (int): stop after this many units.
+        max_attempts (int): failed attempts after which a unit is skipped.
+
+    Returns:
+        int: units completed by this worker
+    """
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    job = load_job(jobdir)
+    units = list(job['units'])
+    # workers start at different units to keep lock contention low
+    start = zlib.crc32(worker.encode()) % max(len(units), 1)
+    units = units[start:] + units[:start]
+    owner = {'worker': worker, 'host': socket.gethostname(), 'pid': os.getpid()}
+    done = 0
+    while True:
+        progress = False
+        waiting = False
+        for unit in units:
+            lock, result = _paths(jobdir, unit['id'])
+            if os.path.exists(result) or _attempts(jobdir, unit['id']) >= max_attempts:
+                continue
+            if not claim(lock, dict(owner, claimed=time.time())):
+                if break_stale(lock, fs_now(jobdir, worker), stale, worker):
+                    progress = True
+                waiting = True
+                continue
+            if os.path.exists(result):
+                # finished between the check and the claim
+                os.remove(lock)
+                continue
+            done += run_unit(jobdir, job, unit, worker, min(HEARTBEAT, stale / 4.))
+            progress = True
+            if max_units is not None and done >= max_units:
+                return done
+        if not progress:
+            if not waiting:
+                return done
+            # units held by other workers, wait for them to finish or go stale
+            time.sleep(min(HEARTBEAT, stale / 4.))
+
+
+def _worker_main(args):
+    jobdir, worker, stale = args
+    return run_worker(jobdir, worker, stale)
+
+
+def run_local(jobdir, nworkers, stale=STALE):
+    '''
+    run nworkers worker processes on this host and wait for them
+    '''
+    host = socket.gethostname()
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(nworkers) as pool:
+        done = pool.map(_worker_main, [(jobdir, f"{host}-w{i}", stale) for i in range(nworkers)])
+    return sum(done)
+
+
+#################################################
+# Status and merging
+#################################################
+
+def job_status(jobdir, stale=STALE):
+    """
+    Returns:
+        dict: counts of 'units', 'done', 'running', 'stale', 'failed' (given up)
+        and 'pending', plus 'workers' holding fresh locks.
+    """
+    job = load_job(jobdir)
+    now = fs_now(jobdir, 'status')
+    res = {'units': len(job['units']), 'done': 0, 'running': 0, 'stale': 0, 'failed': 0, 'pending': 0,
+           'workers': set()}
+    for unit in job['units']:
+        lock, result = _paths(jobdir, unit['id'])
+        if os.path.exists(result):
+            res['done'] += 1
+            continue
+        try:
+            age = now - os.stat(lock).st_mtime
+            with open(lock) as f:
+                owner = json.load(f)
+        except (FileNotFoundError, ValueError):
+            age = None
+        if age is not None and age < stale:
+            res['running'] += 1
+            res['workers'].add(owner['worker'])
+        elif age is not None:
+            res['stale'] += 1
+        elif _attempts(jobdir, unit['id']) >= MAX_ATTEMPTS:
+            res['failed'] += 1
+        else:
+            res['pending'] += 1
+    res['workers'] = sorted(res['workers'])
+    return res
+
+
+def merge_psd(jobdir, rules=None):
+    """
+    Merge the partial PSD sums of a finished 'psd' job into a campaign stack.
+    Campaign-level rules (stacking.rule_corrections, DEFAULT_RULES with
+    `rules` as overrides) are applied to the merged quality table and the
+    rejected or clamped segments recomputed and subtracted, as in
+    stacking.stack_campaign.
+
+    Returns:
+        dict: as stacking.stack_campaign, plus 'missing' units without result.
+    """
+    import h5py
+    from stacking import rule_corrections, subtract_correction, recompute_part
+    job = load_job(jobdir)
+    if job['task'] != 'psd':
+        raise ValueError(f"job task is {job['task']}, only psd results are merged")
+    params = job['params']
+    axes = tuple(params.get('axes', ('x', 'y', 'z')))
+    total = None
+    tables, missing, paths = [], [], {}
+    for unit in job['units']:
+        _, result = _paths(jobdir, unit['id'])
+        if not os.path.exists(result):
+            missing.append(unit['id'])
+            continue
+        with h5py.File(result, 'r') as f:
+            part = {key: f[key][:] for key in ('f', 'sum', 'wsum', 'weight')}
+            part['count'] = int(f.attrs['count'])
+            tables.append(f['table'][:])
+        if total is None:
+            total = part
+        else:
+            for key in ('sum', 'wsum', 'weight', 'count'):
+                total[key] = total[key] + part[key]
+        paths[os.path.basename(unit['path']).encode()] = os.path.join(jobdir, unit['path'])
+    if total is None:
+        raise ValueError('no results to merge')
+    if missing:
+        print(f"Warning: {len(missing)} units without result: {missing[:5]}")
+
+    table = np.concatenate(tables)
+    for job in rule_corrections(table, rules, paths):
+        psum, wsum = recompute_part(job[0], job[1], params['Lbin'], axes, job[2])
+        subtract_correction(total, job, psum, wsum)
+
+    n = max(total['count'], 1)
+    res = {}
+    res['f'] = total['f'][1:]
+    res['axes'] = list(axes)
+    res['psd'] = (total['wsum'] / np.maximum(total['weight'], 1e-300)[:, None])[:, 1:]
+    res['psd_mean'] = (total['sum'] / n)[:, 1:]
+    res['count'] = total['count']
+    res['rejected'] = int(np.sum(~table['accepted']))
+    res['table'] = table
+    res['missing'] = missing
+    return res
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Shard jobs',
+        description='Per-part spectral jobs shared by many workers through a job directory.'
+    )
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('create', help='Write the job catalog')
+    p.add_argument('jobdir', type=str)
+    p.add_argument('parts', type=str, nargs='+', help='Part files')
+    p.add_argument('-t', '--task', choices=sorted(TASKS), default='psd')
+    p.add_argument('-L', '--lbin', type=float, default=100., help='psd: segment length in s')
+    p.add_argument('-o', '--overlap', type=float, default=0.5, help='psd: segment overlap ratio')
+    p.add_argument('-b', '--band', type=float, nargs=2, action='append', metavar=('FLOW', 'FHIGH'),
+                   help='Band in Hz, may be repeated')
+    p.add_argument('-i', '--interval', type=float, default=1.0, help='bandpower: output cadence in s')
+    p.add_argument('-u', '--uniform', action='store_true', help='psd: uniform instead of inverse-power weights')
+
+    p = sub.add_parser('work', help='Process units until none is left')
+    p.add_argument('jobdir', type=str)
+    p.add_argument('-n', '--workers', type=int, default=1, help='Worker processes on this host')
+    p.add_argument('--stale', type=float, default=STALE, help='Seconds after which a silent lock is recovered')
+
+    p = sub.add_parser('status', help='Print job progress')
+    p.add_argument('jobdir', type=str)
+
+    p = sub.add_parser('merge', help='Merge psd results into a stack file')
+    p.add_argument('jobdir', type=str)
+    p.add_argument('outfile', type=str)
+    # defaults: stacking.DEFAULT_RULES, not imported here to keep work/status light
+    p.add_argument('-k', '--kurtosis', type=float, default=None,
+                   help='Reject segments above this excess kurtosis (default as stacking.py)')
+    p.add_argument('-m', '--mad', type=float, default=None,
+                   help='Reject band power above median + MAD x this (log10, default as stacking.py)')
+    p.add_argument('-q', '--quiet', type=float, default=None,
+                   help='Reject band power below median - MAD x this (log10, default as stacking.py)')
+    p.add_argument('-w', '--weight-max', type=float, default=None,
+                   help='Clamp weights at this multiple of the median weight (default as stacking.py)')
+    args = parser.parse_args()
+
+    if args.command == 'create':
+        params = {}
+        if args.band:
+            params['bands'] = args.band
+        if args.task == 'psd':
+            params.update(Lbin=args.lbin, overlapratio=args.overlap,
+                          weighting='uniform' if args.uniform else 'inverse')
+        else:
+            params.update(interval=args.interval)
+        job = create_job(args.jobdir, args.parts, args.task, **params)
+        print(f"{args.jobdir}: {len(job['units'])} units, task {job['task']}")
+    elif args.command == 'work':
+        if args.workers > 1:
+            n = run_local(args.jobdir, args.workers, args.stale)
+        else:
+            n = run_worker(args.jobdir, stale=args.stale)
+        print(f"{n} units completed")
+    elif args.command == 'status':
+        st = job_status(args.jobdir)
+        print(f"{st['done']}/{st['units']} done, {st['running']} running, {st['stale']} stale, "
+              f"{st['pending']} pending, {st['failed']} failed")
+        if st['workers']:
+            print('workers: ' + ', '.join(st['workers']))
+    elif args.command == 'merge':
+        from stacking import save_stack
+        rules = {}
+        if args.kurtosis is not None:
+            rules['kurtosis_max'] = args.kurtosis
+        if args.mad is not None:
+            rules['band_mad'] = args.mad
+        if args.quiet is not None:
+            rules['quiet_mad'] = args.quiet
+        if args.weight_max is not None:
+            rules['weight_max'] = args.weight_max
+        res = merge_psd(args.jobdir, rules)
+        save_stack(res, args.outfile, **load_job(args.jobdir)['params'])
+        print(f"stacked {res['count']} segments from {len(res['table'])} scored, saved to {args.outfile}")
+        if res['missing']:
+            sys.exit(1)
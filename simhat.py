@@ -0,0 +1,263 @@
+"""
+Simulated MCC 128 DAQ HAT for running the acquisition code without hardware.
+
+`SimulatedHat` implements the subset of the daqhats `mcc128` scan interface
+used in this repository. Samples are produced at the requested rate in
+wall-clock time into a host buffer of finite size, so slow readers see the
+same `buffer_overrun` behaviour as on the Pi. With NOSCALEDATA the data are
+raw adc codes (as float, like daqhats). Overruns can also be injected at
+given scan times (`overruns`) or on demand (`inject_overrun`), so the
+overrun handling of the scripts can be exercised: the scan stops and the
+reads report the flag, as on the hardware.
+"""
+import time
+import threading
+from collections import namedtuple
+from enum import IntEnum, IntFlag
+import numpy as np
+
+
+class OptionFlags(IntFlag):
+    DEFAULT = 0x0000
+    NOSCALEDATA = 0x0001
+    NOCALIBRATEDATA = 0x0002
+    EXTCLOCK = 0x0004
+    EXTTRIGGER = 0x0008
+    CONTINUOUS = 0x0010
+    TEMPERATURE = 0x0020
+
+
+class TriggerModes(IntEnum):
+    RISING_EDGE = 0
+    FALLING_EDGE = 1
+    ACTIVE_HIGH = 2
+    ACTIVE_LOW = 3
+
+
+class HatIDs(IntEnum):
+    ANY = 0
+    MCC_118 = 0x0142
+    MCC_128 = 0x0146
+
+
+class AnalogInputMode(IntEnum):
+    SE = 0
+    DIFF = 1
+
+
+class AnalogInputRange(IntEnum):
+    BIP_10V = 0
+    BIP_5V = 1
+    BIP_2V = 2
+    BIP_1V = 3
+
+
+class HatError(Exception):
+    def __init__(self, address, value):
+        super().__init__()
+        self.address = address
+        self.value = value
+
+    def __str__(self):
+        return "Addr {}: ".format(self.address) + self.value
+
+
+HatInfo = namedtuple('HatInfo', ['address', 'id', 'version', 'product_name'])
+ScanRead = namedtuple('ScanRead', ['running', 'hardware_overrun', 'buffer_overrun',
+                                   'triggered', 'timeout', 'data'])
+ScanStatus = namedtuple('ScanStatus', ['running', 'hardware_overrun', 'buffer_overrun',
+                                       'triggered', 'samples_available'])
+
+MAX_SAMPLE_RATE = 100000.0
+CODE_MID = 32768.0
+
+
+def hat_list(filter_by_id=HatIDs.ANY, count=1):
+    """
+    Descriptors of `count` simulated MCC 128 boards at addresses 0..count-1.
+    """
+    return [HatInfo(a, HatIDs.MCC_128, 1, 'MCC 128 (simulated)') for a in range(count)]
+
+
+def chan_list_to_mask(chan_list):
+    chan_mask = 0
+    for chan in chan_list:
+        chan_mask |= 0x01 << chan
+    return chan_mask
+
+
+class SimulatedHat:
+    """
+    Stand-in for `daqhats.mcc128`.
+
+    Args:
+        address (int): board address, only used for reporting.
+        noise (float): rms noise in codes.
+        tone (tuple): (frequency Hz, amplitude codes) of a sine added to all channels.
+        seed (int): random seed.
+        overruns (list[tuple]): (seconds since the first scan start, 'hardware'
+            or 'buffer') overruns to inject, each once.
+    """
+
+    def __init__(self, address=0, noise=20.0, tone=(5.0, 500.0), seed=None, overruns=()):
+        self._address = address
+        self.noise = noise
+        self.tone = tone
+        self._rng = np.random.default_rng(seed if seed is not None else address)
+        self._lock = threading.Lock()
+        self._running = False
+        self._buffer = None
+        self._nch = 0
+        self._rate = 0.0
+        self._t0 = 0.0
+        self._produced = 0
+        self._consumed = 0
+        self._buffer_overrun = False
+        self._hardware_overrun = False
+        self._continuous = False
+        self._total = 0
+        self._faults = sorted(overruns)
+        self._first_t0 = None
+
+    def address(self):
+        return self._address
+
+    def a_in_mode_write(self, input_mode):
+        self.input_mode = input_mode
+
+    def a_in_range_write(self, input_range):
+        self.input_range = input_range
+
+    def trigger_mode(self, mode):
+        self.trigger = mode
+
+    def a_in_scan_actual_rate(self, channel_count, sample_rate_per_channel):
+        return min(sample_rate_per_channel, MAX_SAMPLE_RATE / max(channel_count, 1))
+
+    def a_in_scan_buffer_size(self):
+        return 0 if self._buffer is None else self._buffer.shape[0]
+
+    def a_in_scan_channel_count(self):
+        return self._nch
+
+    def a_in_scan_start(self, channel_mask, samples_per_channel, sample_rate_per_channel, options):
+        if self._running:
+            raise HatError(self._address, "A scan is already active.")
+        self._nch = bin(channel_mask).count('1')
+        self._rate = self.a_in_scan_actual_rate(self._nch, sample_rate_per_channel)
+        self._continuous = bool(options & OptionFlags.CONTINUOUS)
+        self._total = samples_per_channel
+        if self._continuous:
+            # daqhats default host buffer: one second of data, at least 1000 samples
+            size = max(samples_per_channel, int(self._rate), 1000)
+        else:
+            size = samples_per_channel
+        self._buffer = np.zeros((size, self._nch))
+        self._produced = 0
+        self._consumed = 0
+        self._buffer_overrun = False
+        self._hardware_overrun = False
+        self._t0 = time.monotonic()
+        if self._first_t0 is None:
+            self._first_t0 = self._t0
+        self._running = True
+
+    def a_in_scan_status(self):
+        with self._lock:
+            self._produce()
+            return ScanStatus(self._running, self._hardware_overrun, self._buffer_overrun, True,
+                              self._produced - self._consumed)
+
+    def a_in_scan_read(self, samples_per_channel, timeout):
+        running, hardware, overrun, ok, data = self._read(samples_per_channel, timeout)
+        return ScanRead(running, hardware, overrun, True, not ok, data.ravel().tolist())
+
+    def a_in_scan_read_numpy(self, samples_per_channel, timeout):
+        running, hardware, overrun, ok, data = self._read(samples_per_channel, timeout)
+        return ScanRead(running, hardware, overrun, True, not ok, data.ravel())
+
+    def inject_overrun(self, kind='hardware'):
+        '''
+        stop the running scan with a hardware or buffer overrun, reported by the next read
+        '''
+        with self._lock:
+            self._produce()
+            self._overrun(kind)
+
+    def _overrun(self, kind):
+        if not self._running:
+            return
+        if kind == 'hardware':
+            self._hardware_overrun = True
+        else:
+            self._buffer_overrun = True
+        self._running = False
+
+    def a_in_scan_stop(self):
+        with self._lock:
+            self._produce()
+            self._running = False
+
+    def a_in_scan_cleanup(self):
+        self._running = False
+        self._buffer = None
+
+    def _produce(self):
+        if not self._running:
+            return
+        now = time.monotonic()
+        fault = None
+        if self._faults and now - self._first_t0 >= self._faults[0][0]:
+            # samples up to the fault time are produced, then the scan stops
+            t_fault, fault = self._faults.pop(0)
+            now = max(self._first_t0 + t_fault, self._t0)
+        target = int((now - self._t0) * self._rate)
+        if not self._continuous:
+            target = min(target, self._total)
+        n = target - self._produced
+        if n > 0:
+            size = self._buffer.shape[0]
+            if self._produced + n - self._consumed > size:
+                # the reader fell behind, the oldest samples are lost
+                self._buffer_overrun = True
+                self._running = False
+                n = size - (self._produced - self._consumed)
+            t = (self._produced + np.arange(n)) / self._rate
+            f, amp = self.tone
+            samples = CODE_MID + amp * np.sin(2 * np.pi * f * t)[:, None] \
+                + self.noise * self._rng.standard_normal((n, self._nch))
+            samples = np.clip(np.rint(samples), 0, 65535)
+            idx = (self._produced + np.arange(n)) % size
+            self._buffer[idx] = samples
+            self._produced += n
+            if not self._continuous and self._produced >= self._total:
+                self._running = False
+        if fault is not None:
+            self._overrun(fault)
+
+    def _read(self, samples_per_channel, timeout):
+        deadline = time.monotonic() + (timeout if timeout >= 0 else 1e12)
+        while True:
+            with self._lock:
+                if self._buffer is None:
+                    raise HatError(self._address, "No scan is active.")
+                self._produce()
+                available = self._produced - self._consumed
+                if samples_per_channel < 0:
+                    want = available
+                elif not self._running:
+                    want = min(samples_per_channel, available)
+                else:
+                    want = samples_per_channel
+                if available >= want or time.monotonic() >= deadline:
+                    n = min(want, available)
+                    idx = (self._consumed + np.arange(n)) % self._buffer.shape[0]
+                    data = self._buffer[idx]
+                    self._consumed += n
+                    return self._running, self._hardware_overrun, self._buffer_overrun, n == want, data
+                missing = want - available
+            time.sleep(min(max(missing / self._rate, 0.001), 0.1))
+
+
+# daqhats name, so installing simhat as sys.modules["daqhats"] runs the scan scripts unchanged
+mcc128 = SimulatedHat
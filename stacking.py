@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+Quality-gated stacking of segment PSDs over a campaign.
+
+Parts are processed in parallel, one worker per part. A worker cuts its part
+into Lbin segments, computes the windowed PSDs of a batch of segments at
+once, scores every segment (band power per axis and band, excess kurtosis
+per axis, gaps inside the segment) and adds its PSD to running sums; only
+the sums and the small per-segment quality table leave the worker.
+
+Rejection rules are then applied to the whole campaign table in one
+vectorized pass (absolute kurtosis limit, band power above median + k MAD
+or below median - k MAD in log10, gap overlap). Inverse-power weights
+are bounded by the adc quantization noise of the band, and weights of the
+accepted segments are clamped at a multiple of their median, so no single
+segment (e.g. a flat stretch the rules let through) can carry the weighted
+mean.
+Segments rejected or clamped after the fact are recomputed, they are few,
+and subtracted from the sums, so the segment PSDs never have to be kept.
+The result is a plain mean and a weighted mean (inverse band power weights
+by default, quieter segments count more) of the accepted segments.
+"""
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import h5py
+import numpy as np
+from magcore import calibrate_data, gap_rows, adc_quantization_psd, VOLT_TO_UT, AXIS_COLUMNS
+from magio import load_gaps
+from blockreader import open_dataset, stored_rows
+from bandpower import band_matrix
+
+DEFAULT_BANDS = [(0.1, 1.), (1., 10.), (10., 100.)]
+DEFAULT_RULES = {
+    'kurtosis_max': 5.0,    # reject above this excess kurtosis on any axis
+    'band_mad': 5.0,        # reject band power above median + band_mad * MAD (log10)
+    'quiet_mad': 5.0,       # reject band power below median - quiet_mad * MAD (log10): flat, stuck segments
+    'weight_max': 10.0,     # clamp weights at this multiple of the median accepted weight per axis
+    'max_gaps': 0,          # reject segments containing more gaps
+}
+BATCH_BYTES = 64 * 1024**2  # calibrated samples a worker holds per batch
+
+
+def quality_dtype(naxes, nbands):
+    return np.dtype([
+        ('part', 'S128'),
+        ('start_row', 'i8'),
+        ('band_power', 'f8', (naxes, nbands)),
+        ('kurtosis', 'f8', (naxes,)),
+        ('gaps', 'i4'),
+        ('weight', 'f8', (naxes,)),
+        ('accepted', '?'),
+        ('reason', 'S16'),
+    ])
+
+
+def segment_psds(frames, fs):
+    """
+    Hamming-windowed one-sided PSDs of a batch of segments, normalised as compute_psd.
+
+    Args:
+        frames (numpy.ndarray): (nseg, L, naxes) calibrated samples.
+        fs (float): sample rate in Hz.
+
+    Returns:
+        numpy.ndarray: (nseg, naxes, nf) PSDs, DC included.
+    """
+    L = frames.shape[1]
+    w = np.hamming(L)
+    x = frames - frames.mean(axis=1, keepdims=True)
+    x *= w[None, :, None]
+    ak = np.fft.rfft(x, axis=1)
+    psd = (ak.real**2 + ak.imag**2) / (fs * np.sum(w**2))
+    psd[:, 1:] *= 2
+    if L % 2 == 0:
+        psd[:, -1] /= 2
+    return np.transpose(psd, (0, 2, 1))
+
+
+def excess_kurtosis(frames):
+    x = frames - frames.mean(axis=1, keepdims=True)
+    m2 = np.mean(x**2, axis=1)
+    m4 = np.mean(x**4, axis=1)
+    return m4 / np.maximum(m2, 1e-300)**2 - 3.
+
+
+def _part_setup(path, axes):
+    with h5py.File(path, 'r', swmr=True) as f:
+        data = f['voltage']
+        fs = float(data.attrs['sample_rate'])
+        nrows = stored_rows(data)
+        ncols = data.shape[1] if data.ndim > 1 else 1
+    cols = [0] if ncols == 1 else [AXIS_COLUMNS[a] for a in axes]
+    return fs, nrows, cols
+
+
+def _read_frames(dset, starts, L, cols):
+    '''
+    calibrated (nseg, L, naxes) frames of segments starting at sorted rows
+    '''
+    a, b = int(starts[0]), int(starts[-1]) + L
+    raw = dset[a:b]
+    raw = raw.reshape(len(raw), -1)[:, cols]
+    data = calibrate_data(raw)
+    data *= VOLT_TO_UT
+    idx = (starts - a)[:, None] + np.arange(L)[None, :]
+    return data[idx]
+
+
+def _weights(band_power, weighting, ref_band, floor=1e-300):
+    '''
+    segment weights; inverse band power is taken no lower than `floor`, the
+    adc quantization noise of the band, so a flat segment gets a finite weight
+    '''
+    if weighting == 'uniform':
+        return np.ones(band_power.shape[:2])
+    return 1. / np.maximum(band_power[:, :, ref_band], max(floor, 1e-300))
+
+
+def stack_part(path, Lbin, overlapratio=0.5, axes=('x', 'y', 'z'), bands=DEFAULT_BANDS,
+               max_gaps=0, weighting='inverse', ref_band=-1):
+    """
+    Score and accumulate all segments of one part (worker side).
+
+    Returns:
+        dict: 'f', 'sum' and 'wsum' (naxes, nf) plain and weighted PSD sums,
+        'weight' (naxes,) sum of weights, 'count', 'table' quality rows.
+    """
+    fs, nrows, cols = _part_setup(path, axes)
+    naxes = len(cols)
+    L = int(round(Lbin * fs))
+    hop = max(int(L * overlapratio), 1)
+    f = np.fft.rfftfreq(L, 1. / fs)
+    bmat = band_matrix(f, bands) * (fs / L)
+    nbands = bmat.shape[0]
+    floor = adc_quantization_psd(fs) * bmat[ref_band].sum()
+
+    starts = np.arange(0, max(nrows - L + 1, 0), hop)
+    table = np.zeros(len(starts), dtype=quality_dtype(naxes, nbands))
+    table['part'] = os.path.basename(path)
+    table['start_row'] = starts
+    rows = gap_rows(load_gaps(path))
+    table['gaps'] = np.searchsorted(rows, starts + L) - np.searchsorted(rows, starts, side='right')
+
+    res = {'f': f, 'sum': np.zeros((naxes, len(f))), 'wsum': np.zeros((naxes, len(f))),
+           'weight': np.zeros(naxes), 'count': 0, 'fs': fs}
+    use = np.flatnonzero(table['gaps'] <= max_gaps)
+    table['reason'][table['gaps'] > max_gaps] = 'gap'
+    batch = max(BATCH_BYTES // (8 * L * naxes), 1)
+    with h5py.File(path, 'r', swmr=True) as fh:
+        # batches end mid-chunk, the dataset cache keeps the edge chunk for the next batch
+        dset = open_dataset(fh)
+        for i in range(0, len(use), batch):
+            sel = use[i:i + batch]
+            frames = _read_frames(dset, starts[sel], L, cols)
+            psd = segment_psds(frames, fs)
+            bp = np.einsum('bf,saf->sab', bmat, psd)
+            w = _weights(bp, weighting, ref_band, floor)
+            table['band_power'][sel] = bp
+            table['kurtosis'][sel] = excess_kurtosis(frames)
+            table['weight'][sel] = w
+            res['sum'] += psd.sum(axis=0)
+            res['wsum'] += np.einsum('sa,saf->af', w, psd)
+            res['weight'] += w.sum(axis=0)
+            res['count'] += len(sel)
+    table['accepted'][use] = True
+    res['table'] = table
+    return res
+
+
+def recompute_part(path, start_rows, Lbin, axes=('x', 'y', 'z'), weights=None):
+    '''
+    plain and weighted PSD sums of selected segments of one part, for subtracting rejects
+    '''
+    fs, _, cols = _part_setup(path, axes)
+    L = int(round(Lbin * fs))
+    start_rows = np.sort(np.asarray(start_rows))
+    with h5py.File(path, 'r', swmr=True) as fh:
+        psd = segment_psds(_read_frames(open_dataset(fh), start_rows, L, cols), fs)
+    return psd.sum(axis=0), np.einsum('sa,saf->af', weights, psd)
+
+
+def apply_rules(table, rules=DEFAULT_RULES):
+    """
+    Mark outliers in a campaign quality table (in place) and return the
+    mask of segments newly rejected. Only rows still accepted are judged.
+    """
+    rules = {**DEFAULT_RULES, **(rules or {})}
+    acc = table['accepted'].copy()
+    newly = np.zeros(len(table), dtype=bool)
+
+    k = table['kurtosis']
+    bad = acc & np.any(k > rules['kurtosis_max'], axis=1)
+    table['reason'][bad] = 'kurtosis'
+    newly |= bad
+
+    if np.any(acc):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lbp = np.log10(table['band_power'])
+            med = np.median(lbp[acc], axis=0)
+            mad = np.maximum(np.median(np.abs(lbp[acc] - med), axis=0) * 1.4826, 1e-6)
+        if rules['band_mad'] is not None:
+            loud = np.any(lbp > med + rules['band_mad'] * mad, axis=(1, 2))
+            bad = acc & ~newly & loud
+            table['reason'][bad] = 'band_power'
+            newly |= bad
+        if rules['quiet_mad'] is not None:
+            # flat or stuck stretches would get huge inverse-power weights
+            quiet = np.any(lbp < med - rules['quiet_mad'] * mad, axis=(1, 2))
+            bad = acc & ~newly & quiet
+            table['reason'][bad] = 'quiet'
+            newly |= bad
+
+    table['accepted'][newly] = False
+    return newly
+
+
+def clamp_weights(table, weight_max):
+    '''
+    clamp the weights of accepted segments (in place) at weight_max x their
+    median per axis; returns the (nseg, naxes) weight taken off each segment
+    '''
+    delta = np.zeros(table['weight'].shape)
+    acc = table['accepted']
+    if weight_max is None or not np.any(acc):
+        return delta
+    cap = weight_max * np.median(table['weight'][acc], axis=0)
+    delta[acc] = np.maximum(table['weight'][acc] - cap, 0.)
+    table['weight'] -= delta
+    return delta
+
+
+def rule_corrections(table, rules, paths):
+    """
+    Apply the campaign rules to a quality table (in place): apply_rules,
+    then clamp_weights on the segments still accepted.
+
+    Args:
+        table (numpy.ndarray): campaign quality table.
+        rules (dict): overrides of DEFAULT_RULES.
+        paths (dict): part basename (bytes) -> path of the part.
+
+    Returns:
+        list[tuple]: (path, sorted start rows, weights, mask, plain) of the
+        segments to recompute and take out of the weighted sums with these
+        weights, and out of the plain sum and count too if plain.
+    """
+    rules = {**DEFAULT_RULES, **(rules or {})}
+    newly = apply_rules(table, rules)
+    rejected = table['weight'].copy()
+    delta = clamp_weights(table, rules['weight_max'])
+    clamped = np.any(delta > 0, axis=1)
+    jobs = []
+    for name, path in paths.items():
+        part = table['part'] == name
+        for sel, weights, plain in ((newly & part, rejected, True), (clamped & part, delta, False)):
+            if np.any(sel):
+                order = np.argsort(table['start_row'][sel])
+                jobs.append((path, table['start_row'][sel][order], weights[sel][order], sel, plain))
+    return jobs
+
+
+def subtract_correction(total, job, psum, wsum):
+    '''
+    take a rule_corrections job's recompute_part sums out of the totals
+    '''
+    _, _, weights, sel, plain = job
+    total['wsum'] -= wsum
+    total['weight'] -= weights.sum(axis=0)
+    if plain:
+        total['sum'] -= psum
+        total['count'] -= int(np.sum(sel))
+
+
+def stack_campaign(paths, Lbin, overlapratio=0.5, axes=('x', 'y', 'z'), bands=DEFAULT_BANDS,
+                   rules=None, weighting='inverse', ref_band=-1, workers=None):
+    """
+    Quality-gated PSD stack of many parts.
+
+    Args:
+        paths (list[str]): part files of the campaign (any runs, any order).
+        Lbin (float): segment length in seconds.
+        overlapratio (float): segment overlap.
+        axes (tuple): axes to stack.
+        bands (list[tuple]): (f_low, f_high) bands scored per segment.
+        rules (dict): overrides of DEFAULT_RULES.
+        weighting (str): 'inverse' (1 / band power of bands[ref_band]) or 'uniform'.
+        ref_band (int): band used for the weights.
+        workers (int): worker processes, default os.cpu_count().
+
+    Returns:
+        dict: 'f', 'psd' weighted mean and 'psd_mean' plain mean (naxes, nf)
+        of accepted segments (DC dropped), 'axes', 'count', 'rejected',
+        'table' per-segment quality table.
+    """
+    rules = {**DEFAULT_RULES, **(rules or {})}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(stack_part, p, Lbin, overlapratio, axes, bands,
+                               rules['max_gaps'], weighting, ref_band) for p in paths]
+        results = []
+        for p, fut in zip(paths, futures):
+            results.append(fut.result())
+            print('->scored ' + p, end='\r')
+
+        f = results[0]['f']
+        total = {key: sum(r[key] for r in results) for key in ('sum', 'wsum', 'weight', 'count')}
+        table = np.concatenate([r['table'] for r in results])
+
+        # subtract the segments rejected or clamped by campaign-level rules
+        jobs = rule_corrections(table, rules, {os.path.basename(p).encode(): p for p in paths})
+        futures = [pool.submit(recompute_part, job[0], job[1], Lbin, axes, job[2]) for job in jobs]
+        for job, fut in zip(jobs, futures):
+            subtract_correction(total, job, *fut.result())
+
+    n = max(total['count'], 1)
+    res = {}
+    res['f'] = f[1:]
+    res['axes'] = list(axes)
+    res['psd'] = (total['wsum'] / np.maximum(total['weight'], 1e-300)[:, None])[:, 1:]
+    res['psd_mean'] = (total['sum'] / n)[:, 1:]
+    res['count'] = total['count']
+    res['rejected'] = int(np.sum(~table['accepted']))
+    res['table'] = table
+    print(f"stacked {res['count']} segments, rejected {res['rejected']}          ")
+    return res
+
+
+def save_stack(res, outpath, **attrs):
+    with h5py.File(outpath, 'w') as out:
+        out.create_dataset('f', data=res['f'])
+        out.create_dataset('psd', data=res['psd'])
+        out.create_dataset('psd_mean', data=res['psd_mean'])
+        out.create_dataset('quality', data=res['table'])
+        out.attrs['axes'] = res['axes']
+        out.attrs['count'] = res['count']
+        out.attrs['rejected'] = res['rejected']
+        out.attrs['units'] = 'uT^2/Hz'
+        for key, value in attrs.items():
+            out.attrs[key] = value
+
+
+def load_stack(path):
+    '''
+    load a stack written by save_stack, psd per axis as dset[axis]
+    '''
+    with h5py.File(path, 'r') as f:
+        dset = {}
+        dset['f'] = f['f'][:]
+        dset['quality'] = f['quality'][:]
+        dset['count'] = int(f.attrs['count'])
+        psd, psd_mean = f['psd'][:], f['psd_mean'][:]
+        for i, ax in enumerate(f.attrs['axes']):
+            dset[str(ax)] = psd[i]
+            dset[str(ax) + '_mean'] = psd_mean[i]
+    return dset
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Campaign stack',
+        description='Quality-gated stacking of segment PSDs over many hdf5 parts.'
+    )
+    parser.add_argument('outfile', type=str, help='Output hdf5 file')
+    parser.add_argument('parts', type=str, nargs='+', help='Part files of the campaign')
+    parser.add_argument('-L', '--lbin', type=float, default=100., help='Segment length in s')
+    parser.add_argument('-o', '--overlap', type=float, default=0.5, help='Segment overlap ratio')
+    parser.add_argument('-b', '--band', type=float, nargs=2, action='append', metavar=('FLOW', 'FHIGH'),
+                        help='Scored band in Hz, may be repeated; the last one sets the weights')
+    parser.add_argument('-k', '--kurtosis', type=float, default=DEFAULT_RULES['kurtosis_max'],
+                        help='Reject segments above this excess kurtosis')
+    parser.add_argument('-m', '--mad', type=float, default=DEFAULT_RULES['band_mad'],
+                        help='Reject band power above median + MAD x this (log10)')
+    parser.add_argument('-q', '--quiet', type=float, default=DEFAULT_RULES['quiet_mad'],
+                        help='Reject band power below median - MAD x this (log10)')
+    parser.add_argument('-w', '--weight-max', type=float, default=DEFAULT_RULES['weight_max'],
+                        help='Clamp weights at this multiple of the median weight')
+    parser.add_argument('-u', '--uniform', action='store_true', help='Uniform instead of inverse-power weights')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='Worker processes')
+    args = parser.parse_args()
+
+    res = stack_campaign(args.parts, args.lbin, args.overlap, bands=args.band or DEFAULT_BANDS,
+                         rules={'kurtosis_max': args.kurtosis, 'band_mad': args.mad,
+                                'quiet_mad': args.quiet, 'weight_max': args.weight_max},
+                         weighting='uniform' if args.uniform else 'inverse', workers=args.workers)
+    save_stack(res, args.outfile, Lbin=args.lbin, overlapratio=args.overlap,
+               sources=[os.path.basename(p) for p in args.parts])
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+One process for acquisition, health logging and live analysis.
+
+Replaces the separate `scan_save_rawh5_fault_tolerant.py` and `monitorpi.py`
+screen sessions. The HAT drain and hdf5 writer run in a thread at normal (or
+raised, when permitted) priority; the health sampler is an asyncio task;
+live consumers (online PSD) each get a thread at lowered priority fed
+through a bounded queue that drops the oldest block when the consumer falls
+behind, so analysis can never stall the drain. All parts, the health log and
+the live outputs share one run clock (`TimeBase`), and SIGTERM/SIGINT/SIGPWR
+are handled here only: they set one stop event and every component winds
+down and closes its files.
+
+    python supervisor.py <save_dir> -s 1000 -t 86400 --health 1 --live-psd 10
+"""
+import os
+import sys
+import csv
+import time
+import signal
+import asyncio
+import argparse
+import threading
+from collections import deque
+import numpy as np
+
+ACQ_NICE = -5           # acquisition thread, needs CAP_SYS_NICE, ignored otherwise
+CONSUMER_NICE = 10      # live consumer threads
+QUEUE_BLOCKS = 64       # blocks a consumer may lag behind before dropping
+
+
+class TimeBase:
+    """
+    Run clock shared by all components: seconds since start on the
+    monotonic clock, anchored to unix time once.
+    """
+
+    def __init__(self):
+        self.unix0 = time.time()
+        self.mono0 = time.monotonic()
+
+    def now(self):
+        return time.monotonic() - self.mono0
+
+    def unix(self, t):
+        return self.unix0 + t
+
+
+def set_thread_nice(nice):
+    '''
+    niceness of the calling thread (Linux schedules threads individually)
+    '''
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+        return True
+    except (OSError, AttributeError):
+        return False
+
+
+class DropOldestQueue:
+    """
+    Bounded queue for handing blocks from the acquisition thread to a
+    consumer; put() never blocks and discards the oldest entry when full.
+    """
+
+    def __init__(self, maxlen=QUEUE_BLOCKS):
+        self._items = deque(maxlen=maxlen)
+        self._cond = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item):
+        with self._cond:
+            if len(self._items) == self._items.maxlen:
+                self.dropped += 1
+            self._items.append(item)
+            self._cond.notify()
+
+    def get(self, timeout=1.0):
+        '''
+        next item, None on timeout or once closed and empty
+        '''
+        with self._cond:
+            if not self._items and not self.closed:
+                self._cond.wait(timeout)
+            return self._items.popleft() if self._items else None
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class LiveConsumer(threading.Thread):
+    """
+    Base of the live consumers: runs handle(t, block) for every queued
+    block at CONSUMER_NICE until the queue is closed and drained, then
+    finish(). t is the run time the block was written.
+    """
+
+    def __init__(self, name, time_base):
+        super().__init__(name=name, daemon=True)
+        self.time_base = time_base
+        self.queue = DropOldestQueue()
+
+    def feed(self, block):
+        self.queue.put((self.time_base.now(), block))
+
+    def run(self):
+        set_thread_nice(CONSUMER_NICE)
+        while True:
+            item = self.queue.get()
+            if item is None:
+                if self.queue.closed:
+                    break
+                continue
+            self.handle(*item)
+        self.finish()
+        if self.queue.dropped:
+            print(f"{self.name}: dropped {self.queue.dropped} blocks")
+
+    def handle(self, t, block):
+        raise NotImplementedError
+
+    def finish(self):
+        pass
+
+    def stop(self):
+        self.queue.close()
+
+
+class OnlinePSD(LiveConsumer):
+    """
+    Running mean/median PSD of each axis (psdstats.SpectralStats), written
+    atomically to `path` every `interval` seconds of run time. A dropped
+    block restarts the segmentation instead of joining non-adjacent data.
+    """
+
+    def __init__(self, path, fs, Lbin, time_base, interval=60., percentiles=(10., 50., 90.)):
+        super().__init__('online-psd', time_base)
+        from psdstats import SpectralStats
+        self.path = path
+        self.fs = float(fs)
+        self.interval = interval
+        self.percentiles = percentiles
+        self.axes = ['x', 'y', 'z']
+        self.stats = [SpectralStats(fs, int(round(Lbin * fs)), dtype=np.float32) for _ in self.axes]
+        self._next = interval
+        self._dropped = 0
+
+    def handle(self, t, block):
+        from magcore import calibrate_data, VOLT_TO_UT, AXIS_COLUMNS
+        if self.queue.dropped != self._dropped:
+            self._dropped = self.queue.dropped
+            for s in self.stats:
+                s.reset()
+        data = calibrate_data(block, np.float32)
+        data *= np.float32(VOLT_TO_UT)
+        for ax, s in zip(self.axes, self.stats):
+            s.update(data[:, AXIS_COLUMNS[ax]])
+        if t >= self._next:
+            self._next = t + self.interval
+            self.write(t)
+
+    def write(self, t):
+        import h5py
+        tmp = self.path + '.tmp'
+        with h5py.File(tmp, 'w') as f:
+            f.attrs['time_base'] = self.time_base.unix0
+            f.attrs['run_time'] = t
+            f.attrs['sample_rate'] = self.fs
+            for ax, s in zip(self.axes, self.stats):
+                if s.count == 0:
+                    continue
+                res = s.result(self.percentiles)
+                g = f.create_group(ax)
+                g.attrs['count'] = res['count']
+                for key in ('f', 'mean', 'median'):
+                    g.create_dataset(key, data=res[key])
+                g.create_dataset('percentiles', data=np.array(self.percentiles))
+                g.create_dataset('percentile_psd',
+                                 data=np.array([res['percentiles'][q] for q in self.percentiles]))
+        os.replace(tmp, self.path)
+
+    def finish(self):
+        self.write(self.time_base.now())
+        print(f"online psd saved to {self.path}")
+
+
+async def health_task(savedir, interval, time_base, stop):
+    """
+    monitorpi sampling as a task; blocking sensor reads go to a worker thread
+    """
+    import monitorpi
+    try:
+        bme680 = await asyncio.to_thread(monitorpi.open_env_sensor)
+    except Exception as e:
+        print(f"Environment sensor unavailable ({e}), logging board health only")
+        bme680 = None
+    filename = monitorpi.health_log_path(savedir)
+    with open(filename, mode='w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(monitorpi.HEADER + ['runtime(s)'])
+        while not stop.is_set():
+            t = time_base.now()
+            row = await asyncio.to_thread(monitorpi.read_health, bme680)
+            writer.writerow(row + [round(t, 3)])
+            csvfile.flush()
+            # sleep until the next interval on the run clock, wake early on stop
+            await asyncio.to_thread(stop.wait, max(interval - (time_base.now() - t), 0.))
+    print('health log saved to ' + filename)
+
+
+def acquisition_thread(scan_kwargs, stop, done):
+    set_thread_nice(ACQ_NICE)
+    try:
+        from scan_save_rawh5_fault_tolerant import continuous_scan_with_rotation
+        continuous_scan_with_rotation(**scan_kwargs)
+    except Exception as e:
+        print(f"Acquisition failed: {e}")
+    finally:
+        stop.set()
+        done.set()
+
+
+async def supervise(savedir, scan_rate, total_time, health_interval=60., live_psd=None,
+                    live_interval=60., metrics_port=None, metrics_file=None, **scan_options):
+    """
+    Run acquisition, health logging and live consumers until the scan ends
+    or a signal arrives.
+
+    Args:
+        savedir (str): output directory (parts, logs/, live outputs).
+        scan_rate (float): samples per second per channel.
+        total_time (float): run time in seconds.
+        health_interval (float): seconds between health rows.
+        live_psd (float): segment length in s of the online PSD, None for off.
+        live_interval (float): seconds between online PSD snapshots.
+        metrics_port (int), metrics_file (str): publish AcquisitionMetrics.
+        scan_options: passed to continuous_scan_with_rotation (trigger,
+            tuned, resilient, chunksize, recover).
+    """
+    savedir = os.path.join(savedir, '')
+    os.makedirs(savedir, exist_ok=True)
+    time_base = TimeBase()
+    prefix = 'mag_' + time.strftime("%Y_%m_%d_%H_%M", time.localtime(time_base.unix0))
+    stop = threading.Event()
+    done = threading.Event()
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT, getattr(signal, 'SIGPWR', None)):
+        if sig is not None:
+            loop.add_signal_handler(sig, stop.set)
+
+    metrics = None
+    if metrics_port is not None or metrics_file is not None:
+        from metrics import AcquisitionMetrics, serve_metrics, MetricsFileWriter
+        metrics = AcquisitionMetrics(savedir)
+        if metrics_port is not None:
+            serve_metrics(metrics, metrics_port)
+        if metrics_file is not None:
+            MetricsFileWriter(metrics, metrics_file).start()
+
+    consumers = []
+    if live_psd:
+        consumers.append(OnlinePSD(os.path.join(savedir, f"{prefix}_live_psd.hdf5"),
+                                   scan_rate, live_psd, time_base, live_interval))
+    for c in consumers:
+        c.start()
+
+    def on_block(block):
+        for c in consumers:
+            c.feed(block)
+
+    scan_kwargs = dict(channels=[0, 1, 4], scan_rate=scan_rate, total_time=total_time,
+                       savedir=savedir, prefix=prefix, metrics=metrics, stop_event=stop,
+                       on_block=on_block if consumers else None, time_base=time_base,
+                       handle_signals=False, **scan_options)
+    acq = threading.Thread(target=acquisition_thread, args=(scan_kwargs, stop, done),
+                           name='acquisition')
+    acq.start()
+    health = asyncio.create_task(health_task(savedir, health_interval, time_base, stop))
+
+    await asyncio.to_thread(done.wait)
+    print(f"Stopping at run time {time_base.now():.1f} s")
+    await asyncio.to_thread(acq.join)
+    await health
+    for c in consumers:
+        c.stop()
+    for c in consumers:
+        await asyncio.to_thread(c.join)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Magnetometer supervisor',
+        description='Acquisition, health logging and live analysis in one process.'
+    )
+    parser.add_argument('savedir', type=str, help='Directory for output files')
+    parser.add_argument('-t', '--time', type=float, default=10.0, help='Total record time in seconds')
+    parser.add_argument('-s', '--scanrate', type=float, default=1000.0, help='Requested scan rate (S/s)')
+    parser.add_argument('--health', type=float, default=1.0,
+                        help='Health log rate (S/min), as monitorpi.py -s')
+    parser.add_argument('--live-psd', type=float, default=None, metavar='LBIN',
+                        help='Online PSD with segments of LBIN seconds')
+    parser.add_argument('--live-interval', type=float, default=60.0,
+                        help='Seconds between online PSD snapshots')
+    parser.add_argument('--trigger', action='store_true', help='Run the glitch trigger during acquisition')
+    parser.add_argument('--resilient', action='store_true', help='Restart the scan after overruns')
+    parser.add_argument('--tuned', action='store_true', help='Tuned scan buffer and read blocks')
+    parser.add_argument('--metrics-port', type=int, default=None, help='Serve live metrics on this port')
+    parser.add_argument('--metrics-file', type=str, default=None, help='Append metrics snapshots to this file')
+    parser.add_argument('--no-recover', action='store_true', help='Do not repair crashed parts before starting')
+    parser.add_argument('--simulate', action='store_true', help='Use the simulated HAT of simhat.py')
+    args = parser.parse_args()
+
+    if args.simulate:
+        import simhat
+        sys.modules['daqhats'] = simhat
+
+    asyncio.run(supervise(args.savedir, args.scanrate, args.time, 60.0 / args.health,
+                          args.live_psd, args.live_interval, args.metrics_port, args.metrics_file,
+                          trigger=args.trigger, resilient=args.resilient, tuned=args.tuned,
+                          recover=not args.no_recover))
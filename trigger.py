@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""
+Streaming transient/glitch trigger on raw uint16 codes.
+
+Blocks are compared against a running per-channel baseline (median of the
+recent block medians, spread from the median of the recent block MADs).
+Samples deviating by more than `threshold` robust sigmas form candidate
+events; runs closer than `holdoff` are merged. Every event is stored with a
+fixed-length raw snippet of all channels so later analysis can jump to it
+without rescanning the run.
+"""
+import os
+import queue
+import argparse
+import threading
+from collections import deque
+import h5py
+import numpy as np
+from magcore import _CODE_TO_VOLT, VOLT_TO_UT, AXIS_COLUMNS
+from magio import iter_hdf5_blocks
+
+MAD_TO_SIGMA = 1.4826
+DEFAULT_BLOCKSIZE = 65536
+QUEUE_BLOCKS = 64       # blocks TriggerThread may lag behind before feed() drops them
+
+EVENT_DTYPE = np.dtype([
+    ('id', 'i8'),
+    ('channel', 'i2'),
+    ('start', 'i8'),         # first sample above threshold, run sample index
+    ('stop', 'i8'),          # one past the last sample above threshold
+    ('peak_sample', 'i8'),
+    ('peak', 'f8'),          # signed deviation from baseline in codes
+    ('baseline', 'f8'),
+    ('sigma', 'f8'),
+    ('part', 'i4'),
+    ('row', 'i8'),           # start row inside the part file
+])
+
+
+def column_axes(ncols):
+    '''
+    axis name of each raw column, channel order 0, 1, 4 -> x, z, y
+    '''
+    if ncols == 1:
+        return ['x']
+    names = {col: ax for ax, col in AXIS_COLUMNS.items()}
+    return [names.get(c, f'ch{c}') for c in range(ncols)]
+
+
+class GlitchTrigger:
+    """
+    Trigger engine fed with consecutive raw blocks of shape (n, nch).
+
+    Args:
+        fs (float): sample rate in Hz.
+        nch (int): number of channels.
+        threshold (float): trigger level in robust sigmas.
+        baseline_blocks (int): number of past blocks in the running baseline.
+        holdoff (float): seconds below threshold before an event closes.
+        pre (float): snippet length before the event start in seconds.
+        post (float): snippet length after the event start in seconds.
+        min_sigma (float): floor of the robust sigma in codes (quantization).
+    """
+
+    def __init__(self, fs, nch, threshold=8.0, baseline_blocks=32, holdoff=0.05,
+                 pre=0.1, post=0.4, min_sigma=1.0):
+        self.fs = float(fs)
+        self.nch = nch
+        self.threshold = threshold
+        self.holdoff = max(int(round(holdoff * fs)), 1)
+        self.pre = int(round(pre * fs))
+        self.post = max(int(round(post * fs)), 1)
+        self.min_sigma = min_sigma
+
+        self._medians = deque(maxlen=baseline_blocks)
+        self._mads = deque(maxlen=baseline_blocks)
+        self._hist = np.zeros((0, nch), dtype=np.uint16)
+        self._open = [None] * nch
+        self._pending = []
+        self.nsamples = 0
+        self.nevents = 0
+
+    def baseline(self):
+        '''
+        current (median, sigma) per channel in codes
+        '''
+        med = np.median(np.array(self._medians), axis=0)
+        sigma = np.median(np.array(self._mads), axis=0) * MAD_TO_SIGMA
+        return med, np.maximum(sigma, self.min_sigma)
+
+    def update(self, block):
+        """
+        Process the next raw block.
+
+        Args:
+            block (numpy.ndarray): uint16 codes, shape (n, nch).
+
+        Returns:
+            list[tuple]: closed events as (record, snippet), record is a
+            numpy.void of EVENT_DTYPE and snippet a (pre+post, nch) uint16 array.
+        """
+        block = np.asarray(block).reshape(-1, self.nch)
+        start = self.nsamples
+        end = start + len(block)
+        codes = block.astype(np.int32)
+
+        blk_med = np.median(codes, axis=0)
+        blk_mad = np.median(np.abs(codes - blk_med), axis=0)
+        if not self._medians:
+            self._medians.append(blk_med)
+            self._mads.append(blk_mad)
+        med, sigma = self.baseline()
+
+        dev = codes - med
+        exceed = np.abs(dev) > self.threshold * sigma
+
+        for c in range(self.nch):
+            idx = np.flatnonzero(exceed[:, c])
+            if len(idx):
+                splits = np.flatnonzero(np.diff(idx) > self.holdoff) + 1
+                for run in np.split(idx, splits):
+                    self._add_run(c, start + run[0], start + run[-1] + 1,
+                                  start + run[np.argmax(np.abs(dev[run, c]))],
+                                  dev[run, c], med[c], sigma[c])
+
+        self._fill_snippets(block, start)
+
+        closed = []
+        for c in range(self.nch):
+            ev = self._open[c]
+            if ev is not None and end - ev['stop'] > self.holdoff:
+                self._pending.append(ev)
+                self._open[c] = None
+        still = []
+        for ev in self._pending:
+            if ev['filled'] >= ev['start'] + self.post:
+                closed.append(self._close(ev))
+            else:
+                still.append(ev)
+        self._pending = still
+
+        self._medians.append(blk_med)
+        self._mads.append(blk_mad)
+        if len(block) >= self.pre:
+            self._hist = block[len(block) - self.pre:].copy()
+        else:
+            self._hist = np.concatenate([self._hist, block])[-self.pre:]
+        self.nsamples = end
+        return closed
+
+    def flush(self):
+        '''
+        close all open and pending events at the end of the stream, snippets may be partially filled
+        '''
+        for c in range(self.nch):
+            if self._open[c] is not None:
+                self._pending.append(self._open[c])
+                self._open[c] = None
+        closed = [self._close(ev) for ev in self._pending]
+        self._pending = []
+        return closed
+
+    def skip(self, n):
+        '''
+        n samples were not seen (dropped blocks): close open and pending
+        events with their snippets as filled so far, forget the history and
+        advance the sample count so later events keep their run index
+        '''
+        closed = self.flush()
+        self._hist = self._hist[:0]
+        self.nsamples += int(n)
+        return closed
+
+    def _add_run(self, c, rstart, rstop, rpeak, rdev, med, sigma):
+        ev = self._open[c]
+        peak = rdev[np.argmax(np.abs(rdev))]
+        if ev is not None and rstart - ev['stop'] <= self.holdoff:
+            ev['stop'] = rstop
+            if abs(peak) > abs(ev['peak']):
+                ev['peak'], ev['peak_sample'] = float(peak), rpeak
+            return
+        if ev is not None:
+            self._pending.append(ev)
+
+        snip_start = rstart - self.pre
+        snippet = np.zeros((self.pre + self.post, self.nch), dtype=np.uint16)
+        # history rows immediately precede the current block
+        hstart = self.nsamples - len(self._hist)
+        lo = max(snip_start, hstart)
+        hi = min(rstart + self.post, self.nsamples)
+        if hi > lo:
+            snippet[lo - snip_start:hi - snip_start] = self._hist[lo - hstart:hi - hstart]
+        self._open[c] = dict(channel=c, start=rstart, stop=rstop, peak=float(peak),
+                             peak_sample=rpeak, baseline=float(med), sigma=float(sigma),
+                             snippet=snippet, snip_start=snip_start,
+                             filled=max(snip_start, self.nsamples))
+
+    def _fill_snippets(self, block, start):
+        end = start + len(block)
+        events = [ev for ev in self._open if ev is not None] + self._pending
+        for ev in events:
+            lo = max(ev['filled'], start)
+            hi = min(ev['start'] + self.post, end)
+            if hi > lo:
+                s0 = ev['snip_start']
+                ev['snippet'][lo - s0:hi - s0] = block[lo - start:hi - start]
+                ev['filled'] = hi
+
+    def _close(self, ev):
+        rec = np.zeros((), dtype=EVENT_DTYPE)
+        rec['id'] = self.nevents
+        rec['channel'] = ev['channel']
+        rec['start'] = ev['start']
+        rec['stop'] = ev['stop']
+        rec['peak_sample'] = ev['peak_sample']
+        rec['peak'] = ev['peak']
+        rec['baseline'] = ev['baseline']
+        rec['sigma'] = ev['sigma']
+        rec['part'] = -1
+        rec['row'] = ev['start']
+        self.nevents += 1
+        return rec, ev['snippet']
+
+
+class EventStore:
+    """
+    HDF5 event table with raw snippets, appended as events close.
+
+    Datasets:
+        events: EVENT_DTYPE records in order of closing.
+        snippets: (nevents, pre+post, nch) uint16 raw codes.
+        parts: run sample index of the first row of each part.
+        index: event ids sorted by start sample, written on close().
+    """
+
+    def __init__(self, path, trigger, sources=None):
+        self.trigger = trigger
+        self.f = h5py.File(path, 'w')
+        self.events = self.f.create_dataset('events', shape=(0,), maxshape=(None,),
+                                            dtype=EVENT_DTYPE, chunks=(1024,))
+        L = trigger.pre + trigger.post
+        self.snippets = self.f.create_dataset(
+            'snippets', shape=(0, L, trigger.nch), maxshape=(None, L, trigger.nch),
+            dtype='uint16', chunks=(16, L, trigger.nch)
+        )
+        self.parts = self.f.create_dataset('parts', shape=(0,), maxshape=(None,), dtype='i8')
+        self.f.attrs['sample_rate'] = trigger.fs
+        self.f.attrs['threshold'] = trigger.threshold
+        self.f.attrs['pre'] = trigger.pre
+        self.f.attrs['post'] = trigger.post
+        self.f.attrs['axes'] = column_axes(trigger.nch)
+        self.f.attrs['part_names'] = list(sources or [])
+        self._part_starts = []
+
+    def add_part(self, name, first_sample):
+        '''
+        register a part file starting at the given run sample index
+        '''
+        self._part_starts.append(first_sample)
+        self.parts.resize((len(self._part_starts),))
+        self.parts[-1] = first_sample
+        self.f.attrs['part_names'] = list(self.f.attrs['part_names']) + [name]
+
+    def append(self, closed):
+        if not closed:
+            return
+        recs = np.array([r for r, _ in closed], dtype=EVENT_DTYPE)
+        if self._part_starts:
+            starts = np.asarray(self._part_starts)
+            part = np.searchsorted(starts, recs['start'], side='right') - 1
+            recs['part'] = part
+            recs['row'] = recs['start'] - starts[np.maximum(part, 0)]
+        n = self.events.shape[0]
+        self.events.resize((n + len(recs),))
+        self.events[n:] = recs
+        self.snippets.resize((n + len(recs),) + self.snippets.shape[1:])
+        self.snippets[n:] = np.stack([s for _, s in closed])
+        self.f.flush()
+
+    def close(self):
+        self.append(self.trigger.flush())
+        starts = self.events['start'] if self.events.shape[0] else np.zeros(0, dtype='i8')
+        self.f.create_dataset('index', data=np.argsort(starts, kind='stable'))
+        self.f.close()
+
+
+class TriggerThread(threading.Thread):
+    """
+    Runs an EventStore and its trigger on their own thread, so the block
+    medians and event writes stay off the acquisition thread. feed() never
+    blocks: with `maxsize` blocks queued it drops the new block, counts it in
+    `dropped`, and the rows are skipped in the trigger's sample count
+    (GlitchTrigger.skip) before the next queued item, so events stay in step
+    with the parts. add_part() waits for a free slot. close() drains the
+    queue and closes the store.
+    """
+
+    def __init__(self, store, maxsize=QUEUE_BLOCKS):
+        super().__init__(name='trigger', daemon=True)
+        self.store = store
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.max_backlog = 0
+        self.dropped = 0
+        self.error = None
+        # rows dropped since the last queued item, only touched by the feeding thread
+        self._skip = 0
+
+    def feed(self, block):
+        if self.error is not None:
+            return
+        try:
+            self.queue.put_nowait(('block', block, self._skip))
+        except queue.Full:
+            self.dropped += 1
+            self._skip += len(block)
+            return
+        self._skip = 0
+        self.max_backlog = max(self.max_backlog, self.queue.qsize())
+
+    def add_part(self, name):
+        self.queue.put(('part', name, self._skip))
+        self._skip = 0
+
+    def run(self):
+        while True:
+            kind, item, skip = self.queue.get()
+            if kind is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                if skip:
+                    self.store.append(self.store.trigger.skip(skip))
+                if kind == 'part':
+                    self.store.add_part(item, self.store.trigger.nsamples)
+                else:
+                    self.store.append(self.store.trigger.update(item))
+            except Exception as e:
+                # acquisition goes on without events
+                print(f"\ntrigger stopped: {e}")
+                self.error = str(e)
+
+    def close(self):
+        self.queue.put((None, None, 0))
+        self.join()
+        self.store.close()
+        if self.dropped:
+            print(f"trigger dropped {self.dropped} blocks, max backlog {self.max_backlog}")
+
+
+def trigger_run(paths, outpath, threshold=8.0, holdoff=0.05, pre=0.1, post=0.4,
+                blocksize=DEFAULT_BLOCKSIZE, baseline_blocks=32):
+    """
+    Scan consecutive hdf5 parts of one run in exact blocks of `blocksize`
+    rows (the baseline spans `baseline_blocks` of them) and write the event
+    store.
+    """
+    with h5py.File(paths[0], 'r') as f:
+        fs = float(f['voltage'].attrs['sample_rate'])
+        nch = f['voltage'].shape[1] if f['voltage'].ndim > 1 else 1
+
+    trig = GlitchTrigger(fs, nch, threshold=threshold, baseline_blocks=baseline_blocks,
+                         holdoff=holdoff, pre=pre, post=post)
+    store = EventStore(outpath, trig)
+    try:
+        for path in paths:
+            print('->triggering ' + path, end='\r')
+            store.add_part(os.path.basename(path), trig.nsamples)
+            for _, raw in iter_hdf5_blocks(path, blocksize):
+                store.append(trig.update(raw))
+    finally:
+        store.close()
+    print(f"{trig.nevents} events saved to {outpath}")
+
+
+def load_events(path):
+    '''
+    load the event table sorted by start time, adds time (s) and peak in μT
+    '''
+    with h5py.File(path, 'r') as f:
+        events = f['events'][:][f['index'][:]]
+        fs = f.attrs['sample_rate']
+        axes = list(f.attrs['axes'])
+        parts = list(f.attrs['part_names'])
+    dset = {}
+    dset['events'] = events
+    dset['time'] = events['start'] / fs
+    dset['duration'] = (events['stop'] - events['start']) / fs
+    dset['axis'] = np.array([axes[c] for c in events['channel']])
+    # code deviation -> volts with the calibrate_data slope, then μT
+    dset['peak_ut'] = events['peak'] * (_CODE_TO_VOLT * VOLT_TO_UT)
+    dset['part_names'] = parts
+    return dset
+
+
+def load_event_snippet(path, event_id):
+    '''
+    raw uint16 snippet of one event, shape (pre+post, nch), first row at start - pre
+    '''
+    with h5py.File(path, 'r') as f:
+        return f['snippets'][event_id]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Glitch trigger',
+        description='Find magnetic transients in hdf5 parts and store them in an event table.'
+    )
+    parser.add_argument('outfile', type=str, help='Output event hdf5 file')
+    parser.add_argument('parts', type=str, nargs='+', help='Part files in acquisition order')
+    parser.add_argument('-k', '--threshold', type=float, default=8.0,
+                        help='Trigger level in robust sigmas')
+    parser.add_argument('--holdoff', type=float, default=0.05,
+                        help='Seconds below threshold before an event closes')
+    parser.add_argument('--pre', type=float, default=0.1, help='Snippet seconds before start')
+    parser.add_argument('--post', type=float, default=0.4, help='Snippet seconds after start')
+    parser.add_argument('-b', '--blocksize', type=int, default=DEFAULT_BLOCKSIZE,
+                        help='Rows per block, the baseline is updated once per block')
+    parser.add_argument('--baseline-blocks', type=int, default=32,
+                        help='Past blocks in the running baseline')
+    args = parser.parse_args()
+
+    trigger_run(args.parts, args.outfile, args.threshold, args.holdoff, args.pre, args.post,
+                blocksize=args.blocksize, baseline_blocks=args.baseline_blocks)
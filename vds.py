@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Stitch the hourly parts of a run into one HDF5 Virtual Dataset.
+
+The master file `<prefix>_run.hdf5` holds no sample data: its `voltage`
+dataset maps the `voltage` rows of `<prefix>_part0.hdf5 ... partN.hdf5` end
+to end, so `load_hdf5`, `iter_hdf5_blocks` or any h5py slice see one
+contiguous (N, nch) array. The `parts` table records where every part
+starts. Re-running the tool only opens parts that are new or may still be
+growing (the last known one) and rewrites the small master file atomically.
+
+Part files are referenced relative to the master, keep them in the same
+directory. While acquisition is running open the master with swmr=True.
+Gap tables of the parts are merged into `gaps` with run rows, so
+`load_gaps` and `compute_averaged_psd` work on the master as on a part.
+"""
+import os
+import re
+import glob
+import time
+import argparse
+import h5py
+import numpy as np
+from blockreader import stored_rows
+
+PART_DTYPE = np.dtype([
+    ('name', 'S128'),
+    ('first_sample', 'i8'),
+    ('rows', 'i8'),
+    ('start_time', 'S16'),
+    ('end_time', 'S16'),
+])
+
+# gaps of all parts (see the resilient scan), row is the run row of the discontinuity
+GAP_DTYPE = np.dtype([
+    ('row', 'i8'),
+    ('part', 'S128'),
+    ('part_row', 'i8'),
+    ('lost', 'i8'),
+    ('t_start', 'f8'),
+    ('t_end', 'f8'),
+    ('cause', 'S16'),
+])
+
+
+def find_parts(rundir, prefix):
+    '''
+    part files of a run sorted by part number
+    '''
+    pattern = re.compile(re.escape(prefix) + r'_part(\d+)\.hdf5$')
+    parts = []
+    for path in glob.glob(os.path.join(rundir, f"{prefix}_part*.hdf5")):
+        m = pattern.search(os.path.basename(path))
+        if m:
+            parts.append((int(m.group(1)), path))
+    return [path for _, path in sorted(parts)]
+
+
+def master_path(rundir, prefix):
+    return os.path.join(rundir, f"{prefix}_run.hdf5")
+
+
+def _as_str(value):
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def read_part_info(path):
+    '''
+    shape, dtype and metadata of one part without reading samples
+    '''
+    with h5py.File(path, 'r', swmr=True) as f:
+        data = f['voltage']
+        info = {}
+        info['name'] = os.path.basename(path)
+        info['rows'] = stored_rows(data)
+        info['shape'] = data.shape
+        info['dtype'] = data.dtype
+        info['sample_rate'] = float(data.attrs['sample_rate'])
+        info['start_time'] = _as_str(data.attrs.get('start_time', ''))
+        info['end_time'] = _as_str(data.attrs.get('end_time', ''))
+        info['gaps'] = f['gaps'][:] if 'gaps' in f else None
+    return info
+
+
+def read_parts_table(path):
+    '''
+    parts table of an existing master file, None if there is none
+    '''
+    if not os.path.exists(path):
+        return None
+    with h5py.File(path, 'r') as f:
+        return f['parts'][:] if 'parts' in f else None
+
+
+def read_gaps_table(path):
+    '''
+    merged gaps table of an existing master file, empty if there is none
+    '''
+    if not os.path.exists(path):
+        return np.zeros(0, dtype=GAP_DTYPE)
+    with h5py.File(path, 'r') as f:
+        return f['gaps'][:] if 'gaps' in f else np.zeros(0, dtype=GAP_DTYPE)
+
+
+def _run_gaps(part_gaps, name, first_sample):
+    gaps = np.zeros(0 if part_gaps is None else len(part_gaps), dtype=GAP_DTYPE)
+    if len(gaps):
+        gaps['row'] = part_gaps['row'] + first_sample
+        gaps['part'] = name
+        gaps['part_row'] = part_gaps['row']
+        gaps['lost'] = part_gaps['end_sample'] - part_gaps['start_sample']
+        gaps['t_start'] = part_gaps['t_start']
+        gaps['t_end'] = part_gaps['t_end']
+        gaps['cause'] = part_gaps['cause']
+    return gaps
+
+
+def build_run_vds(parts, outpath, known=None, known_gaps=None):
+    """
+    Write the master file mapping all parts into one `voltage` dataset.
+
+    Args:
+        parts (list[str]): part files in acquisition order.
+        outpath (str): master file path.
+        known (numpy.ndarray): parts table of the previous master; completed
+            parts listed there are not reopened.
+        known_gaps (numpy.ndarray): gaps table of the previous master.
+
+    Returns:
+        numpy.ndarray: the new parts table.
+    """
+    if known_gaps is None:
+        known_gaps = np.zeros(0, dtype=GAP_DTYPE)
+    cached = {}
+    if known is not None and len(known):
+        # every known part but the last has been closed by the writer
+        for row in known[:-1]:
+            cached[_as_str(row['name'])] = row
+
+    table = np.zeros(len(parts), dtype=PART_DTYPE)
+    gaps = []
+    first = read_part_info(parts[0])
+    shape1 = first['shape'][1:]
+    offset = 0
+    for i, path in enumerate(parts):
+        name = os.path.basename(path)
+        if name in cached:
+            row = cached[name]
+            rows, start, end = int(row['rows']), row['start_time'], row['end_time']
+            part_gaps = known_gaps[known_gaps['part'] == name.encode()].copy()
+            part_gaps['row'] += offset - row['first_sample']
+            gaps.append(part_gaps)
+        else:
+            info = first if i == 0 else read_part_info(path)
+            if info['shape'][1:] != shape1:
+                raise ValueError(f"{name}: shape {info['shape']} does not match {first['shape']}")
+            rows, start, end = info['rows'], info['start_time'], info['end_time']
+            gaps.append(_run_gaps(info['gaps'], name, offset))
+        table[i] = (name, offset, rows, start, end)
+        offset += rows
+
+    outdir = os.path.dirname(os.path.abspath(outpath))
+    layout = h5py.VirtualLayout(shape=(offset,) + shape1, dtype=first['dtype'])
+    for row, path in zip(table, parts):
+        rows = int(row['rows'])
+        if rows == 0:
+            continue
+        source = h5py.VirtualSource(os.path.relpath(os.path.abspath(path), outdir), 'voltage',
+                                    shape=(rows,) + shape1)
+        start = int(row['first_sample'])
+        layout[start:start + rows] = source[:rows]
+
+    tmppath = outpath + '.tmp'
+    with h5py.File(tmppath, 'w', libver='latest') as f:
+        dset = f.create_virtual_dataset('voltage', layout, fillvalue=0)
+        dset.attrs['dtype'] = str(first['dtype'])
+        dset.attrs['sample_rate'] = first['sample_rate']
+        dset.attrs['start_time'] = _as_str(table[0]['start_time'])
+        dset.attrs['end_time'] = _as_str(table[-1]['end_time'])
+        dset.attrs['measure_time'] = offset / first['sample_rate']
+        f.create_dataset('parts', data=table)
+        f.create_dataset('gaps', data=np.concatenate(gaps))
+        f.attrs['n_parts'] = len(parts)
+        f.attrs['updated'] = time.strftime("%Y_%m_%d_%H_%M_%S", time.localtime())
+    os.replace(tmppath, outpath)
+    return table
+
+
+def update_run_vds(rundir, prefix, outpath=None):
+    """
+    Create or refresh the master file of a run, reopening only new parts
+    and the last known one.
+
+    Returns:
+        str: master file path, None if the run has no parts yet.
+    """
+    outpath = outpath or master_path(rundir, prefix)
+    parts = find_parts(rundir, prefix)
+    if not parts:
+        return None
+    known = read_parts_table(outpath)
+    table = build_run_vds(parts, outpath, known, read_gaps_table(outpath))
+    print(f"{outpath}: {len(table)} parts, {int(table['rows'].sum())} samples")
+    return outpath
+
+
+def open_run(path, swmr=True):
+    '''
+    open a master file, returns (file, voltage dataset); the dataset is read lazily
+    '''
+    f = h5py.File(path, 'r', swmr=swmr)
+    return f, f['voltage']
+
+
+def part_of_sample(path, sample):
+    '''
+    (part name, row in part) of a run sample index
+    '''
+    table = read_parts_table(path)
+    i = np.searchsorted(table['first_sample'], sample, side='right') - 1
+    return _as_str(table[i]['name']), int(sample - table[i]['first_sample'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Run VDS',
+        description='Map all hdf5 parts of a run into one virtual voltage dataset.'
+    )
+    parser.add_argument('rundir', type=str, help='Directory with the part files')
+    parser.add_argument('prefix', type=str, help='Run prefix, e.g. mag_2025_07_16_12_00')
+    parser.add_argument('-o', '--out', type=str, default=None,
+                        help='Master file (default <rundir>/<prefix>_run.hdf5)')
+    parser.add_argument('-w', '--watch', type=float, default=None,
+                        help='Keep updating every WATCH seconds as new parts appear')
+    args = parser.parse_args()
+
+    while True:
+        update_run_vds(args.rundir, args.prefix, args.out)
+        if args.watch is None:
+            break
+        time.sleep(args.watch)